@@ -0,0 +1,493 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+
+Offline benchmark of the resource counter Lambda function.
+AWS API calls are answered locally by a botocore "before-call" handler, with synthetic responses generated
+from each resource configuration or with responses recorded from a real account, so no AWS account is needed.
+It reports duration, throughput, peak memory and API calls for main() and for each of its stages.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Any, Final
+from collections.abc import Callable, Iterator
+
+# Offline credentials and region, so botocore never looks for real ones
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_EC2_METADATA_DISABLED', 'true')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import boto3  # type: ignore
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+import resource_counter  # pylint: disable=wrong-import-position
+
+####
+
+CONST_DEFAULT_ITEMS: Final[str] = '10000,100000'
+CONST_DEFAULT_PAGE_SIZES: Final[str] = '100,1000'
+CONST_DEFAULT_GROUP_SIZE: Final[int] = 5
+CONST_DEFAULT_CARDINALITY: Final[int] = 10
+CONST_TOKEN_LENGTH: Final[int] = 40
+CONST_STAGES: Final[tuple[str, ...]] = ('config', 'collect', 'publish', 'main')
+# Default configuration with one resource of each type, nested like EC2 instances inside reservations
+CONST_SYNTHETIC_SERVICES: Final[dict[str, Any]] = {
+    'defaultNamespace': 'ResourceCounterBenchmark',
+    'defaultDimensionName': 'Per-Service Metrics',
+    'resources': [
+        {
+            'type': 'paginator',
+            'resource': {'client': 'ec2', 'method': 'describe_instances', 'iterateOver': ['Reservations', 'Instances']},
+            'count': {
+                'groupBy': {'element': ['InstanceType']},
+                'ifExists': {'element': 'EbsOptimized', 'existsSuffix': 'Ebs', 'notExistsSuffix': 'NoEbs'}
+            },
+            'metric': {'dimensionValue': 'EC2', 'metricName': 'Instance'}
+        },
+        {
+            'type': 'next-in-response',
+            'resource': {'client': 'rds', 'method': 'describe_db_instances', 'iterateOver': ['DBInstances'], 'nextInResponse': 'Marker', 'nextInRequest': 'Marker'},
+            'count': {'groupBy': {'element': ['Engine']}},
+            'metric': {'dimensionValue': 'RDS', 'metricName': 'DBInstance'}
+        },
+        {
+            'type': 'direct',
+            'resource': {'client': 'ec2', 'method': 'describe_addresses', 'iterateOver': ['Addresses']},
+            'count': {'groupBy': {'element': ['Domain']}},
+            'metric': {'dimensionValue': 'EC2', 'metricName': 'EIP'}
+        }
+    ]
+}
+
+
+#======================================================================================================================
+# Fake AWS API, answering calls from synthetic or recorded pages
+#======================================================================================================================
+
+class FakeApi:
+    """
+    Answer AWS API calls locally, counting calls and bytes by operation.
+    Each operation has a list of pages, and the page token is the page index.
+    """
+    def __init__(self):
+        self.pages: dict[str, Callable[[int, dict[str, Any]], tuple[dict[str, Any], bool]]] = {}
+        self.tokens: dict[str, tuple[str, str, str]] = {}
+        self.calls: dict[str, int] = {}
+        self.request_bytes: int = 0
+        self.items_read: int = 0
+        self.lock = threading.Lock()
+
+    def install(self, session: Any) -> None:
+        """
+        Register the event handlers on a boto3 session, so its clients don't send any request.
+        :param session: botocore session of the boto3 session
+        """
+        session.register('before-parameter-build', self.keep_params)
+        session.register('before-call', self.call)
+
+    @staticmethod
+    def keep_params(params: dict[str, Any], context: dict[str, Any], **_) -> None:
+        """
+        Keep the API parameters on request context, as "before-call" event only has the serialized request.
+        """
+        context['benchmark_params'] = dict(params)
+
+    def call(self, model: Any, context: dict[str, Any], **_) -> tuple[Any, dict[str, Any]]:
+        """
+        Answer an API call, returning a fake HTTP response and the parsed response.
+        :param model: botocore operation model
+        :param context: Request context, with the API parameters
+        :return: HTTP response and parsed response, empty for operations without pages
+        """
+        operation: str = f'{model.service_model.service_name}.{model.name}'
+        params: dict[str, Any] = context.get('benchmark_params', {})
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.request_bytes += len(json.dumps(params, default=str))
+        if operation not in self.pages:
+            return FakeHttpResponse(), {}
+
+        input_token, output_token, more_results = self.tokens.get(operation, ('', '', ''))
+        page_index: int = int(params.get(input_token) or 0) if input_token else 0
+        response, has_next = self.pages[operation](page_index, params)
+        if has_next and output_token:
+            # Token is padded, as some APIs validate its minimum length, like DynamoDB table names and ARNs
+            response = {**response, output_token: f'{page_index + 1:0{CONST_TOKEN_LENGTH}d}'}
+        if more_results:
+            # Some paginators only request the next page when this flag is true, like "IsTruncated" from IAM and Route 53
+            response = {**response, more_results: has_next}
+        return FakeHttpResponse(), response
+
+    def reset(self) -> None:
+        """
+        Reset call counters.
+        """
+        self.calls = {}
+        self.request_bytes = 0
+        self.items_read = 0
+
+
+class FakeHttpResponse:
+    """
+    Minimal HTTP response returned with the parsed response.
+    """
+    status_code: int = 200
+    headers: dict[str, str] = {}
+    content: bytes = b''
+
+
+def get_token_names(client: Any, config_service: dict[str, Any]) -> tuple[str, str, str]:
+    """
+    Get the request and response attributes with the next page token of a resource configuration.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :return: Request token, response token and more results flag names, empty if resource has just one page or doesn't have a flag
+    """
+    if config_service['type'] == 'next-in-response':
+        return config_service['resource']['nextInRequest'], config_service['resource']['nextInResponse'], ''
+    if config_service['type'] == 'paginator':
+        pagination_config: dict[str, Any] = client.get_paginator(config_service['resource']['method'])._pagination_cfg  # pylint: disable=protected-access
+        input_token, output_token = pagination_config['input_token'], pagination_config['output_token']
+        return get_token_name(input_token), get_token_name(output_token), get_token_name(pagination_config.get('more_results', ''))
+    return '', '', ''
+
+def get_token_name(token: str | list[str]) -> str:
+    """
+    Get the attribute name of a paginator token, the first one when it has several.
+    Expressions use their first attribute, like "NextMarker" from S3 "NextMarker || Contents[-1].Key".
+    :param token: Token from paginator configuration
+    :return: Attribute name
+    """
+    return (token[0] if isinstance(token, list) else token).split('||')[0].strip()
+
+def get_page_limit(client: Any, config_service: dict[str, Any], params: dict[str, Any], default: int) -> int:
+    """
+    Get the number of items of a page, from the page size argument of the request if it has one.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :param params: API parameters of the request
+    :param default: Page size used when the request doesn't set it
+    :return: Number of items on the page
+    """
+    for argument in resource_counter.CONST_PAGE_SIZE_ARGUMENTS:
+        if isinstance(params.get(argument), int):
+            return params[argument]
+    if config_service['type'] == 'paginator':
+        limit_key: str | None = client.get_paginator(config_service['resource']['method'])._pagination_cfg.get('limit_key')  # pylint: disable=protected-access
+        if limit_key and isinstance(params.get(limit_key), int):
+            return params[limit_key]
+    return default
+
+def get_key_path(path: Any) -> list[str]:
+    """
+    Get the attribute names of a path that only has attribute names.
+    :param path: Attribute path from configuration
+    :return: List of attribute names, empty if path has selectors
+    """
+    names: list[str] = []
+    for _, steps in resource_counter.parse_path(resource_counter.get_path_key(path)):
+        if any(step_type != resource_counter.CONST_PATH_KEY for step_type, _ in steps):
+            return []
+        names.extend(argument for _, argument in steps)
+    return names
+
+def get_path_value(item: dict[str, Any], names: list[str]) -> Any:
+    """
+    Get a value inside nested dictionaries.
+    :param item: Dictionary to get the value
+    :param names: Attribute names of the path
+    :return: Value, an empty list if it doesn't exist
+    """
+    for name in names:
+        if not isinstance(item, dict) or name not in item:
+            return []
+        item = item[name]
+    return item
+
+def set_path_value(item: dict[str, Any], names: list[str], value: Any) -> None:
+    """
+    Set a value inside nested dictionaries.
+    :param item: Dictionary to set the value
+    :param names: Attribute names of the path
+    :param value: Value to set
+    """
+    for name in names[:-1]:
+        item = item.setdefault(name, {})
+    item[names[-1]] = value
+
+def get_item_factory(config_services: list[dict[str, Any]], cardinality: int) -> Callable[[int], dict[str, Any]]:
+    """
+    Get the function that generates a synthetic resource with all attributes used by the resource configurations.
+    groupBy attributes and tags cycle over their configured values, or over "cardinality" values, and ifExists attributes exist on half of the items.
+    :param config_services: List of service configurations of the same operation
+    :param cardinality: Number of distinct values of each groupBy attribute without configured values
+    :return: Function to get the resource of a given index
+    """
+    group_by_paths: list[tuple[list[str], list[Any]]] = []
+    tag_paths: list[tuple[list[str], str, list[Any]]] = []
+    if_exists_paths: list[list[str]] = []
+    for config_service in config_services:
+        counts: Any = config_service.get('count', {})
+        for count in counts if isinstance(counts, list) else [counts]:
+            group_by: dict[str, Any] = count.get('groupBy', {})
+            default_values: list[str] = [f'value-{index}' for index in range(cardinality)]
+            if group_by.get('tag') and (names := get_key_path(group_by.get('tagsAttribute', 'Tags'))):
+                tag_paths.append((names, group_by['tag'], group_by.get('values') or default_values))
+            # Composite values have one value for each element, so each element cycles over its position of the values
+            for position, element in enumerate(group_by.get('elements', [])):
+                if names := get_key_path(element):
+                    group_by_paths.append((names, [value[position] for value in group_by.get('values', [])] or default_values))
+            if group_by.get('element') and (names := get_key_path(group_by['element'])):
+                group_by_paths.append((names, group_by.get('values') or default_values))
+            if 'ifExists' in count and (names := get_key_path(count['ifExists']['element'])):
+                if_exists_paths.append(names)
+
+    def get_item(index: int) -> dict[str, Any]:
+        item: dict[str, Any] = {'Id': f'resource-{index}'}
+        for names, values in group_by_paths:
+            set_path_value(item, names, values[index % len(values)])
+        for names, key, values in tag_paths:
+            set_path_value(item, names, [*get_path_value(item, names), {'Key': key, 'Value': values[index % len(values)]}])
+        for names in if_exists_paths:
+            if index % 2 == 0:
+                set_path_value(item, names, True)
+        return item
+    return get_item
+
+def get_page_body(names: list[str], items: list[dict[str, Any]], group_size: int) -> dict[str, Any]:
+    """
+    Nest page items following the iterateOver path, splitting each intermediate level in groups.
+    :param names: Attribute names of iterateOver path
+    :param items: Resources of the page
+    :param group_size: Number of resources in each intermediate group, like instances in a reservation
+    :return: Page response
+    """
+    if len(names) == 1:
+        return {names[0]: items}
+    return {names[0]: [get_page_body(names[1:], items[start:start + group_size], group_size) for start in range(0, len(items), group_size)]}
+
+def add_synthetic_pages(fake_api: FakeApi, config_services: list[dict[str, Any]], items: int, page_size: int, group_size: int, cardinality: int) -> None:
+    """
+    Add synthetic pages for each operation of the service configurations.
+    Operations used by several resource configurations share their pages, generated with the first iterateOver path.
+    :param fake_api: Fake AWS API
+    :param config_services: List of service configurations
+    :param items: Number of resources of each operation
+    :param page_size: Number of resources on each page, when the request doesn't set it
+    :param group_size: Number of resources in each intermediate group
+    :param cardinality: Number of distinct values of each groupBy attribute
+    """
+    session = boto3.DEFAULT_SESSION
+    by_operation: dict[str, list[dict[str, Any]]] = {}
+    for config_service in config_services:
+        if config_service['type'] not in ('paginator', 'next-in-response', 'direct'):
+            logging.warning('Type "%s" of "%s" is not supported by synthetic pages, it will be counted as empty', config_service['type'], config_service['resource']['method'])
+            continue
+        client = session.client(config_service['resource']['client'])
+        operation: str = f'{client.meta.service_model.service_name}.{client.meta.method_to_api_mapping[config_service["resource"]["method"]]}'
+        by_operation.setdefault(operation, []).append(config_service)
+        fake_api.tokens.setdefault(operation, get_token_names(client, config_service))
+
+    for operation, operation_services in by_operation.items():
+        config_service = operation_services[0]
+        names: list[str] = get_key_path(config_service['resource']['iterateOver'])
+        if not names:
+            logging.warning('Path "%s" of "%s" has selectors, it will be counted as empty', config_service['resource']['iterateOver'], operation)
+            continue
+        client = session.client(config_service['resource']['client'])
+        get_item = get_item_factory(operation_services, cardinality)
+
+        def get_page(page_index: int, params: dict[str, Any], config_service=config_service, client=client, names=names, get_item=get_item) -> tuple[dict[str, Any], bool]:
+            # Direct type has just one page, with all resources
+            limit: int = items if config_service['type'] == 'direct' else get_page_limit(client, config_service, params, page_size)
+            start: int = page_index * limit
+            page_items: list[dict[str, Any]] = [get_item(index) for index in range(start, min(start + limit, items))]
+            with fake_api.lock:
+                fake_api.items_read += len(page_items)
+            return get_page_body(names, page_items, group_size), start + limit < items
+        fake_api.pages[operation] = get_page
+
+def add_recorded_pages(fake_api: FakeApi, config_services: list[dict[str, Any]], recording: dict[str, list[dict[str, Any]]]) -> None:
+    """
+    Add recorded pages, replayed in order. Tokens of the recorded pages are replaced with page indexes.
+    :param fake_api: Fake AWS API
+    :param config_services: List of service configurations, to get token names
+    :param recording: Dictionary of list of pages by operation, like "ec2.DescribeInstances"
+    """
+    session = boto3.DEFAULT_SESSION
+    for config_service in config_services:
+        client = session.client(config_service['resource']['client'])
+        operation: str = f'{client.meta.service_model.service_name}.{client.meta.method_to_api_mapping[config_service["resource"]["method"]]}'
+        if operation in recording and operation not in fake_api.tokens:
+            fake_api.tokens[operation] = _, output_token, more_results = get_token_names(client, config_service)
+            pages: list[dict[str, Any]] = [{key: value for key, value in page.items() if key not in (output_token, more_results, 'ResponseMetadata')} for page in recording[operation]]
+            fake_api.pages[operation] = lambda page_index, _, pages=pages: (pages[page_index], page_index + 1 < len(pages))
+
+
+#======================================================================================================================
+# Benchmark runner
+#======================================================================================================================
+
+def measure(stage: str, function: Callable[[], Any], fake_api: FakeApi, memory: bool) -> tuple[Any, dict[str, Any]]:
+    """
+    Run a stage, measuring its duration, API calls and optionally its peak memory.
+    :param stage: Stage name
+    :param function: Function that runs the stage
+    :param fake_api: Fake AWS API, to count calls
+    :param memory: Bool to measure peak memory with tracemalloc, which makes the stage slower
+    :return: Stage return value and its measures
+    """
+    fake_api.reset()
+    if memory:
+        tracemalloc.start()
+    start: float = time.perf_counter()
+    try:
+        result: Any = function()
+    finally:
+        duration: float = time.perf_counter() - start
+        peak: int | None = tracemalloc.get_traced_memory()[1] if memory else None
+        if memory:
+            tracemalloc.stop()
+    return result, {
+        'stage': stage,
+        'seconds': round(duration, 4),
+        'peakMemoryMiB': round(peak / 2**20, 2) if peak is not None else None,
+        'apiCalls': sum(fake_api.calls.values()),
+        'requestBytes': fake_api.request_bytes,
+        'itemsRead': fake_api.items_read,
+        'callsByOperation': dict(sorted(fake_api.calls.items()))
+    }
+
+def count_metrics(metrics_by_namespace: dict[str, Any]) -> int:
+    """
+    Count the metrics of all namespaces.
+    :param metrics_by_namespace: Dictionary of metrics by namespace
+    :return: Number of metrics
+    """
+    return sum(len(metrics) for metrics in metrics_by_namespace.values())
+
+def run_scenario(services: dict[str, Any], items: int, page_size: int, args: argparse.Namespace, fake_api: FakeApi) -> list[dict[str, Any]]:
+    """
+    Run all stages for one scale and page size, from a temporary directory with the configuration file.
+    :param services: Dictionary of config file content
+    :param items: Number of resources of each operation
+    :param page_size: Number of resources on each page
+    :param args: Command line arguments
+    :param fake_api: Fake AWS API
+    :return: List of stage measures
+    """
+    # Benchmark runs offline, so accounts, state and sinks other than CloudWatch are removed
+    services = {key: value for key, value in services.items() if key not in ('accounts', 'state', 'sinks')}
+    fake_api.pages.clear()
+    fake_api.tokens.clear()
+    if args.recording:
+        with open(args.recording, encoding='utf-8') as recording_file:
+            add_recorded_pages(fake_api, services['resources'], json.load(recording_file))
+    else:
+        add_synthetic_pages(fake_api, services['resources'], items, page_size, args.group_size, args.cardinality)
+
+    directory: str = tempfile.mkdtemp(prefix='resource-counter-benchmark-')
+    current_directory: str = os.getcwd()
+    try:
+        with open(os.path.join(directory, resource_counter.CONST_SERVICE_FILE), 'w', encoding='utf-8') as services_file:
+            json.dump(services, services_file)
+        os.chdir(directory)
+        resource_counter.service_configuration_cache = None
+        resource_counter.max_page_sizes.clear()
+
+        (settings, config_services), config_measure = measure('config', resource_counter.get_service_configuration, fake_api, args.memory)
+        metrics_by_namespace: dict[str, Any] = resource_counter.initialize_metrics_by_namespace(config_services)
+        timestamp = resource_counter.datetime.utcnow()
+        clients = resource_counter.ClientPool(settings)
+        _, collect_measure = measure('collect', lambda: resource_counter.collect_metrics_by_namespace(clients, config_services, [], settings, metrics_by_namespace, timestamp), fake_api, args.memory)
+        _, publish_measure = measure('publish', lambda: resource_counter.publish_metrics_by_namespace(metrics_by_namespace, settings), fake_api, args.memory)
+        main_metrics, main_measure = measure('main', resource_counter.main, fake_api, args.memory)
+    finally:
+        os.chdir(current_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    stage_measures: list[dict[str, Any]] = [config_measure, collect_measure, publish_measure, main_measure]
+    for stage_measure in stage_measures:
+        stage_measure.update(items=items if not args.recording else None, pageSize=page_size if not args.recording else None, metrics=count_metrics(main_metrics))
+        if stage_measure['stage'] in ('collect', 'main') and not args.recording:
+            # Items actually returned by the fake API, as shared requests read their items once
+            stage_measure['itemsPerSecond'] = round(stage_measure['itemsRead'] / stage_measure['seconds']) if stage_measure['seconds'] else None
+    return [stage_measure for stage_measure in stage_measures if stage_measure['stage'] in args.stages]
+
+def get_scenarios(args: argparse.Namespace) -> Iterator[tuple[int, int]]:
+    """
+    Get the scales and page sizes to run, just one scenario when pages are recorded.
+    :param args: Command line arguments
+    :return: Generator of number of items and page size
+    """
+    if args.recording:
+        return iter([(0, 0)])
+    return itertools.product((int(value) for value in args.items.split(',')), (int(value) for value in args.page_sizes.split(',')))
+
+def print_table(measures: list[dict[str, Any]]) -> None:
+    """
+    Print stage measures as a text table.
+    :param measures: List of stage measures
+    """
+    columns: tuple[str, ...] = ('items', 'pageSize', 'stage', 'seconds', 'itemsPerSecond', 'peakMemoryMiB', 'apiCalls', 'requestBytes', 'metrics')
+    rows: list[list[str]] = [list(columns)] + [['' if measure.get(column) is None else str(measure[column]) for column in columns] for measure in measures]
+    widths: list[int] = [max(len(row[index]) for row in rows) for index in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+def get_arguments() -> argparse.Namespace:
+    """
+    Parse command line arguments.
+    :return: Command line arguments
+    """
+    parser = argparse.ArgumentParser(description='Offline benchmark of the resource counter Lambda function.')
+    parser.add_argument('--services', help='Config file with resources to benchmark, JSON or YAML. Default is a synthetic configuration with one resource of each type.')
+    parser.add_argument('--items', default=CONST_DEFAULT_ITEMS, help=f'Comma separated number of resources of each operation. Default is "{CONST_DEFAULT_ITEMS}".')
+    parser.add_argument('--page-sizes', default=CONST_DEFAULT_PAGE_SIZES, help=f'Comma separated number of resources of each page, when the request doesn\'t set it. Default is "{CONST_DEFAULT_PAGE_SIZES}".')
+    parser.add_argument('--group-size', type=int, default=CONST_DEFAULT_GROUP_SIZE, help=f'Number of resources of each intermediate level of nested iterateOver paths. Default is "{CONST_DEFAULT_GROUP_SIZE}".')
+    parser.add_argument('--cardinality', type=int, default=CONST_DEFAULT_CARDINALITY, help=f'Number of distinct values of groupBy attributes without configured values. Default is "{CONST_DEFAULT_CARDINALITY}".')
+    parser.add_argument('--recording', help='JSON file with recorded pages by operation, like {"ec2.DescribeInstances": [page, ...]}, replayed instead of synthetic pages.')
+    parser.add_argument('--stages', default=','.join(CONST_STAGES), type=lambda value: value.split(','), help=f'Comma separated stages to report. Default is "{",".join(CONST_STAGES)}".')
+    parser.add_argument('--memory', action='store_true', help='Measure peak memory with tracemalloc. Stages run slower.')
+    parser.add_argument('--json', action='store_true', help='Print measures as JSON lines instead of a table.')
+    return parser.parse_args()
+
+def main() -> None:
+    """
+    Benchmark entry point.
+    """
+    args: argparse.Namespace = get_arguments()
+    if args.services:
+        with open(args.services, 'rb') as services_file:
+            services: dict[str, Any] = resource_counter.load_service_file(args.services, services_file.read())
+    else:
+        services = CONST_SYNTHETIC_SERVICES
+
+    boto3.setup_default_session()
+    fake_api = FakeApi()
+    fake_api.install(boto3.DEFAULT_SESSION._session)  # pylint: disable=protected-access
+
+    measures: list[dict[str, Any]] = []
+    for items, page_size in get_scenarios(args):
+        for stage_measure in run_scenario(services, items, page_size, args, fake_api):
+            if args.json:
+                print(json.dumps(stage_measure))
+            measures.append(stage_measure)
+    if not args.json:
+        print_table(measures)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,20 +3,54 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: MIT-0
 """
 
+import time
+# Used to report import time on cold start, so it is imported first
+import_start: float = time.perf_counter()
+
+import cProfile
+import functools
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import logging
 import os
-from datetime import datetime
-from typing import Any, NamedTuple, TypedDict, Final
-from collections.abc import Callable
+import pstats
+import random
+import re
+import socket
+import sys
+import threading
+import tracemalloc
+import urllib.request
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Any, NamedTuple, TextIO, TypedDict, Final
+from array import array
+from collections.abc import Callable, Iterable, Iterator, Mapping
 
 import boto3  # type: ignore
+import botocore.session  # type: ignore
+from botocore.config import Config  # type: ignore
+from botocore.exceptions import ClientError  # type: ignore
+from botocore import xform_name  # type: ignore
 
 ####
 
 CONST_SERVICE_FILE: Final[str] = 'services.json'
+CONST_SERVICE_YAML_FILE: Final[str] = 'services.yaml'
 CONST_MAX_METRIC_DATA: Final[int] = 1000
+# PutMetricData request is limited to 1 MB. Size is estimated as JSON, so it leaves room for other protocol encodings.
+CONST_MAX_METRIC_DATA_BYTES: Final[int] = 500_000
+CONST_COMPRESSION_MIN_SIZE_BYTES: Final[int] = 1024
 CONST_ELEMENT: Final[str] = 'element'
+CONST_ELEMENTS: Final[str] = 'elements'
+CONST_TAG: Final[str] = 'tag'
+CONST_DEFAULT_TAGS_ATTRIBUTE: Final[str] = 'Tags'
+CONST_DEFAULT_OTHER_VALUE: Final[str] = 'Other'
+# With "maxValues", distinct groupBy values tracked are limited to this factor of it, the smallest ones are evicted to "Other"
+CONST_TRACKED_VALUES_FACTOR: Final[int] = 10
 CONST_RESOURCES: Final[str] = 'resources'
 CONST_COUNT: Final[str] = 'count'
 CONST_GROUP_BY: Final[str] = 'groupBy'
@@ -24,6 +58,106 @@ CONST_IF_EXISTS: Final[str] = 'ifExists'
 CONST_DEFAULT_NAMESPACE: Final[str] = 'defaultNamespace'
 CONST_DEFAULT_DIMENSION_NAME: Final[str] = 'defaultDimensionName'
 CONST_NEXT_IN_RESPONSE: Final[str] = 'next-in-response'
+CONST_DIRECT: Final[str] = 'direct'
+CONST_CONFIG_QUERY: Final[str] = 'config-query'
+CONST_RESOURCE_EXPLORER: Final[str] = 'resource-explorer'
+CONST_CHAIN: Final[str] = 'chain'
+CONST_DEFAULT_CHAIN_CONCURRENCY: Final[int] = 4
+CONST_FILTER: Final[str] = 'filter'
+CONST_DEFAULT_FILTER_ARGUMENT: Final[str] = 'Filters'
+CONST_PAGE_SIZE: Final[str] = 'pageSize'
+CONST_INTERVAL: Final[str] = 'interval'
+CONST_CHANGE_MARKER: Final[str] = 'changeMarker'
+CONST_STATE: Final[str] = 'state'
+CONST_DEFAULT_HEARTBEAT_SECONDS: Final[int] = 3600
+CONST_STATE_S3_PREFIX: Final[str] = 's3://'
+CONST_SCHEDULER: Final[str] = 'scheduler'
+# Time kept from Lambda function timeout to publish metrics and save state
+CONST_DEFAULT_RESERVE_SECONDS: Final[int] = 30
+# Maximum fraction of Lambda function remaining time kept by reserve, so short timeouts still have time to collect resources
+CONST_MAX_RESERVE_FRACTION: Final[float] = 0.5
+CONST_SELF_MONITORING: Final[str] = 'selfMonitoring'
+CONST_DEFAULT_SELF_NAMESPACE: Final[str] = 'ResourceCounter/Self'
+CONST_SELF_DIMENSION_NAME: Final[str] = 'Resource'
+CONST_PROFILE_LINES: Final[int] = 30
+# Before Python 3.12, cProfile only profiles the thread that enables it, so each worker thread has its own profiler
+CONST_PROFILE_WORKERS: Final[bool] = sys.version_info < (3, 12)
+# Method arguments used by AWS APIs to define the page size, in preference order
+CONST_PAGE_SIZE_ARGUMENTS: Final[tuple[str, ...]] = ('MaxResults', 'MaxRecords', 'MaxItems', 'Limit', 'PageSize', 'MaxKeys')
+# Maximum page size of methods whose botocore service model doesn't define it, from the API reference
+CONST_KNOWN_MAX_PAGE_SIZES: Final[dict[tuple[str, str], int]] = {
+    ('ec2', 'describe_instances'): 1000,
+    ('ec2', 'describe_images'): 1000,
+    ('ec2', 'describe_snapshots'): 1000,
+    ('ec2', 'describe_volumes'): 500
+}
+CONST_CONCURRENCY: Final[str] = 'concurrency'
+CONST_DEFAULT_MAX_WORKERS: Final[int] = 10
+CONST_DEFAULT_MAX_PER_CLIENT: Final[int] = 4
+CONST_REGIONS: Final[str] = 'regions'
+CONST_REGION_DIMENSION_NAME: Final[str] = 'regionDimensionName'
+CONST_DEFAULT_REGION_DIMENSION_NAME: Final[str] = 'Region'
+CONST_ACCOUNTS: Final[str] = 'accounts'
+CONST_DEFAULT_ACCOUNT_DIMENSION_NAME: Final[str] = 'Account'
+CONST_DEFAULT_ROLE_SESSION_NAME: Final[str] = 'ResourceCounter'
+CONST_CREDENTIALS_REFRESH_SECONDS: Final[int] = 300
+# Time the active accounts from AWS Organizations are kept across warm Lambda invocations
+CONST_ORGANIZATION_ACCOUNTS_SECONDS: Final[int] = 3600
+CONST_RATE_LIMITS: Final[str] = 'rateLimits'
+CONST_RETRY: Final[str] = 'retry'
+CONST_DEFAULT: Final[str] = 'default'
+CONST_DEFAULT_RATE: Final[int] = 20
+CONST_DEFAULT_BURST: Final[int] = 20
+CONST_MIN_RATE: Final[float] = 0.5
+CONST_RATE_INCREASE_FACTOR: Final[float] = 0.05
+CONST_DEFAULT_RETRY_MODE: Final[str] = 'adaptive'
+CONST_RETRY_MODES: Final[tuple[str, ...]] = ('legacy', 'standard', 'adaptive')
+CONST_DEFAULT_MAX_ATTEMPTS: Final[int] = 5
+CONST_DEFAULT_RESOURCE_ATTEMPTS: Final[int] = 3
+CONST_BACKOFF_BASE_SECONDS: Final[float] = 1.0
+CONST_CONNECTIONS: Final[str] = 'connections'
+CONST_DEFAULT_MAX_POOL_CONNECTIONS: Final[int] = 50
+CONST_DEFAULT_CONNECT_TIMEOUT: Final[int] = 10
+CONST_DEFAULT_READ_TIMEOUT: Final[int] = 60
+CONST_PUBLISHER: Final[str] = 'publisher'
+CONST_DEFAULT_PUBLISHER_MAX_WORKERS: Final[int] = 4
+CONST_DEFAULT_PUBLISHER_MAX_ATTEMPTS: Final[int] = 3
+CONST_SINKS: Final[str] = 'sinks'
+CONST_SINK_CLOUDWATCH: Final[str] = 'cloudwatch'
+CONST_SINK_EMF: Final[str] = 'emf'
+CONST_SINK_PROMETHEUS: Final[str] = 'prometheus'
+CONST_SINK_STATSD: Final[str] = 'statsd'
+CONST_SINK_FILE: Final[str] = 'file'
+# Sinks that add metrics on each call, so namespaces can be published one by one with streaming publish
+CONST_STREAMING_SINKS: Final[tuple[str, ...]] = (CONST_SINK_CLOUDWATCH, CONST_SINK_EMF, CONST_SINK_STATSD)
+CONST_DEFAULT_PROMETHEUS_JOB: Final[str] = 'resource_counter'
+CONST_DEFAULT_HTTP_TIMEOUT_SECONDS: Final[int] = 10
+CONST_DEFAULT_STATSD_PORT: Final[int] = 8125
+# StatsD metrics are batched in UDP packets up to the common Ethernet MTU payload
+CONST_STATSD_MAX_PACKET_BYTES: Final[int] = 1432
+CONST_DEFAULT_FILE_PATH: Final[str] = '/tmp/metrics.ndjson'
+CONST_FILE_FORMATS: Final[tuple[str, ...]] = ('ndjson', 'parquet')
+# Embedded Metric Format allows up to 100 metrics for each log line, and log event is limited to 256 KB
+CONST_EMF_MAX_METRICS: Final[int] = 100
+CONST_EMF_MAX_BYTES: Final[int] = 200_000
+CONST_EMF_METRIC_OVERHEAD_BYTES: Final[int] = 64
+# Attribute path syntax: "Name", "Name[0]", "Name[*]", "*" and "Name[?Key=='value']", joined by "." in a single string
+CONST_PATH_SEGMENT_PATTERN: Final[re.Pattern] = re.compile(r'(?:[^.\[]|\[[^\]]*\])+')
+CONST_PATH_NAME_PATTERN: Final[re.Pattern] = re.compile(r'([^.\[\]]*)((?:\[[^\]]*\])*)')
+CONST_PATH_SELECTOR_PATTERN: Final[re.Pattern] = re.compile(r'\[([^\]]*)\]')
+CONST_PATH_FILTER_PATTERN: Final[re.Pattern] = re.compile(r'\?\s*([^=\s]+)\s*==\s*(?:\'([^\']*)\'|"([^"]*)")\s*')
+CONST_PATH_KEY: Final[str] = 'key'
+CONST_PATH_INDEX: Final[str] = 'index'
+CONST_PATH_FILTER: Final[str] = 'filter'
+CONST_PATH_WILDCARD: Final[str] = 'wildcard'
+# Returned by path extractors when an attribute doesn't exist, as None can be a valid attribute value
+CONST_MISSING: Final[object] = object()
+CONST_THROTTLING_ERROR_CODES: Final[frozenset[str]] = frozenset({
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException', 'TooManyRequestsException',
+    'ProvisionedThroughputExceededException', 'TransactionInProgressException', 'RequestLimitExceeded',
+    'BandwidthLimitExceeded', 'LimitExceededException', 'RequestThrottled', 'SlowDown', 'PriorRequestNotComplete',
+    'EC2ThrottledException'
+})
 
 ####### Get values from environment variables  ######
 
@@ -45,8 +179,27 @@ if len(logging.getLogger().handlers) > 0:
 else:
     logging.basicConfig(level=LOG_LEVEL)
 
-
-cloudwatch_client = boto3.client('cloudwatch')
+# Opt-in profiling of each invocation, for deep dives: "cpu" uses cProfile and "memory" uses tracemalloc
+if (PROFILE := os.getenv('PROFILE', '').lower()) not in {'', 'cpu', 'memory'}:
+    logging.error('Environment variable "PROFILE" must be one of "cpu" or "memory", found "%s". Will not profile.', PROFILE)
+    PROFILE = ''
+
+
+# Clients and service names are created on first use and kept across warm Lambda invocations
+cloudwatch_client: Any = None
+cloudwatch_client_lock = threading.Lock()
+valid_service_names: set[str] | None = None
+# Page size argument and its maximum value from botocore service model, by service and method
+max_page_sizes: dict[tuple[str, str], tuple[str, int | None] | None] = {}
+# Configuration is parsed and validated once, then reused while the config file doesn't change
+service_configuration_cache: 'ServiceConfigurationCache | None' = None
+# Cold start is the first invocation of the Lambda execution environment
+cold_start: bool = True
+# Statistics of the resource collected by each worker thread, so API calls are counted for the resource that made them
+collection_context = threading.local()
+# CPU profilers of worker threads, merged with the invocation profiler
+worker_profilers: list[Any] = []
+worker_profilers_lock = threading.Lock()
 
 
 #======================================================================================================================
@@ -63,6 +216,7 @@ class MetricData(NamedTuple):
     metric_name: str
     metric_value: int
     timestamp: datetime
+    dimensions: tuple[tuple[str, str], ...] = ()
     def __iter__(self):
         yield self.namespace
         yield self.dimension_name
@@ -70,6 +224,9 @@ class MetricData(NamedTuple):
         yield self.metric_name
         yield self.metric_value
         yield self.timestamp.isoformat()
+        # Additional dimensions, like region, are only returned when defined
+        if self.dimensions:
+            yield dict(self.dimensions)
 
 
 class ResourceElement(TypedDict):
@@ -83,15 +240,48 @@ class ResourceElement(TypedDict):
     nextInResponse: str
     nextInRequest: str
     mustExists: bool
+    regions: list[str]
+    filter: 'FilterElement'
+    pageSize: int | None
+    interval: int | None
+    changeMarker: 'AttributePath'
+    chain: list['ChainElement']
+
+class ChainElement(TypedDict):
+    """
+    Chain level configuration, a child call made with the ids of the resources from the previous level
+    """
+    method: str
+    argument: str
+    kwargs: dict
+    iterateOver: 'AttributePath'
+    idPath: 'AttributePath'
+    batchSize: int | None
+    concurrency: int
+    inheritArguments: list[str]
+    ignoreErrors: list[str]
+
+class FilterElement(TypedDict):
+    """
+    Filter element configuration, to query each groupBy value on the service side
+    """
+    name: str
+    argument: str
 
 class GroupByElement(TypedDict):
     """
-    GroupBy element configuration
+    GroupBy element configuration. Resources are grouped by one element, by several elements or by a tag
     """
-    element: list[str]
-    values: list[str]
+    element: 'AttributePath'
+    elements: list['AttributePath']
+    tag: str
+    tagsAttribute: 'AttributePath'
+    values: list[Any]
+    maxValues: int | None
+    otherValue: str
     capitalize: bool
     customName: bool
+    default: str | None
 
 class IfExistsElement(TypedDict):
     """
@@ -105,9 +295,11 @@ class CountElement(TypedDict):
     """
     Count element configuration
     """
+    metricName: str
     generateTotal: bool
     groupBy: GroupByElement
     ifExists: IfExistsElement
+    weight: 'AttributePath'
 
 class MetricElement(TypedDict):
     """
@@ -118,6 +310,106 @@ class MetricElement(TypedDict):
     dimensionValue: str
     metricName: str
 
+class ConcurrencyElement(TypedDict):
+    """
+    Concurrency element configuration
+    """
+    maxWorkers: int
+    maxPerClient: int
+    clients: dict[str, int]
+
+class AccountsElement(TypedDict):
+    """
+    Accounts element configuration
+    """
+    ids: list[str]
+    organization: bool
+    excludeIds: list[str]
+    roleName: str
+    externalId: str
+    sessionName: str
+    dimensionName: str
+
+class RateLimitElement(TypedDict):
+    """
+    Rate limit element configuration
+    """
+    rate: int
+    burst: int
+
+class ConnectionElement(TypedDict):
+    """
+    HTTP connection element configuration
+    """
+    maxPoolConnections: int
+    tcpKeepalive: bool
+    connectTimeout: int
+    readTimeout: int
+
+class RetryElement(TypedDict):
+    """
+    Retry element configuration
+    """
+    mode: str
+    maxAttempts: int
+    resourceAttempts: int
+
+class PublisherElement(TypedDict):
+    """
+    Publisher element configuration
+    """
+    maxWorkers: int
+    maxAttempts: int
+    streaming: bool
+
+class SinkElement(TypedDict):
+    """
+    Sink element configuration
+    """
+    type: str
+    options: dict[str, Any]
+
+class StateElement(TypedDict):
+    """
+    State element configuration
+    """
+    location: str
+    endpointUrl: str
+    heartbeatSeconds: int
+    deltaPublish: bool
+
+class SchedulerElement(TypedDict):
+    """
+    Scheduler element configuration
+    """
+    reserveSeconds: int
+    maxSeconds: int
+
+class SelfMonitoringElement(TypedDict):
+    """
+    Self monitoring element configuration
+    """
+    metrics: bool
+    namespace: str
+    report: bool
+
+class SettingsConfiguration(TypedDict):
+    """
+    Global settings configuration
+    """
+    concurrency: ConcurrencyElement
+    regions: list[str]
+    regionDimensionName: str
+    accounts: AccountsElement
+    rateLimits: dict[str, RateLimitElement]
+    connections: dict[str, ConnectionElement]
+    retry: RetryElement
+    publisher: PublisherElement
+    sinks: list[SinkElement]
+    state: StateElement
+    scheduler: SchedulerElement
+    selfMonitoring: SelfMonitoringElement
+
 class ResourceConfiguration(TypedDict):
     """
     Resource configuration
@@ -126,6 +418,7 @@ class ResourceConfiguration(TypedDict):
     type: str
     resource: ResourceElement
     count: CountElement
+    counts: list[CountElement]
     metric: MetricElement
     """
     Dictionary of boto3 client.
@@ -134,284 +427,1198 @@ class ResourceConfiguration(TypedDict):
     """
 
 
-Boto3Clients = dict[str, Any]
+ClientKey = tuple[str, str, str]
+"""
+Key of boto3 client.
+Tuple of client resource name as defined on boto3, region name and account id, empty for the Lambda function ones
+"""
+Dimensions = tuple[tuple[str, str], ...]
+PathStep = tuple[str, Any]
+"""
+Step of a compiled attribute path.
+Tuple of step type (key, index, filter or wildcard) and its argument
+"""
+AttributePath = list[str] | str
+"""
+Attribute path from configuration, as a list of path segments or a single string with segments joined by "."
+"""
+
+
+class CollectionTask(NamedTuple):
+    """
+    Collection of one service configuration in one region and account.
+    """
+    config_service: ResourceConfiguration
+    region: str
+    account: str
+    dimensions: Dimensions
+    # GroupBy value queried with a service side filter, its metrics are added to the other values ones
+    filter_value: str | None = None
+    # Key on state and collection duration from the last run, set by the scheduler when state is configured
+    state_key: str = ''
+    estimated_seconds: float | None = None
+
+    @property
+    def client_key(self) -> ClientKey:
+        """Key of the boto3 client used by this task"""
+        return (self.config_service['resource']['client'], self.region, self.account)
+
+class AccountSession(NamedTuple):
+    """
+    boto3 session with assumed role credentials for one account.
+    """
+    session: Any
+    expiration: datetime
+
+class OrganizationAccounts(NamedTuple):
+    """
+    Active account ids from AWS Organizations, with the time, from time.monotonic, until they are reused.
+    """
+    account_ids: list[str]
+    expiration: float
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter shared by all workers calling the same boto3 client.
+    The rate is reduced by half when the API throttles and slowly increased back on each success.
+    """
+    def __init__(self, rate: int, burst: int):
+        self.max_rate: float = rate
+        self.rate: float = rate
+        self.burst: int = burst
+        self.tokens: float = burst
+        self.updated: float = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, **_) -> None:
+        """Wait until there is a token available to send a request. Used as botocore "before-send" event handler."""
+        while True:
+            with self.lock:
+                now: float = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait: float = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_response(self, response: Any = None, **_) -> None:
+        """Adapt the rate from the request response. Used as botocore "needs-retry" event handler."""
+        if response is None:
+            return
+        with self.lock:
+            if response[1].get('Error', {}).get('Code') in CONST_THROTTLING_ERROR_CODES:
+                self.rate = max(CONST_MIN_RATE, self.rate / 2)
+                self.tokens = 0
+                logging.warning('Request throttled, reducing rate to %.2f requests per second', self.rate)
+            elif self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * CONST_RATE_INCREASE_FACTOR)
+
+
+class ResourceUnchanged(Exception):
+    """
+    Raised when the change marker of a resource is the same from the previous run, so its previous metrics are reused.
+    """
+
+
+class ResourceSkipped(Exception):
+    """
+    Raised when a resource is not collected because it is not expected to finish inside the time budget.
+    """
+
+
+class ResourceStats:
+    """
+    Statistics of one collection task, logged as a single summary line instead of logging each resource.
+    """
+    __slots__ = ('pages', 'page_size', 'items', 'attempts', 'duration', 'marker', 'calls', 'retries', 'bytes', 'lock')
+
+    def __init__(self):
+        self.pages: int = 0
+        self.page_size: int | None = None
+        self.marker: Any = None
+        self.items: int = 0
+        self.attempts: int = 0
+        self.duration: float = 0.0
+        # API calls made by botocore, with its retries and response bytes
+        self.calls: int = 0
+        self.retries: int = 0
+        self.bytes: int = 0
+        # API calls can be counted by several threads, like chain level workers
+        self.lock = threading.Lock()
+
+    def add_api_call(self, retries: int, response_bytes: int) -> None:
+        """
+        Count an API call, with its retries and response bytes.
+        :param retries: Number of retries of the call
+        :param response_bytes: Size of the response
+        """
+        with self.lock:
+            self.calls += 1
+            self.retries += retries
+            self.bytes += response_bytes
+
+
+class CountDefinition:
+    """
+    Counters of one count definition. Resources are aggregated by their raw groupBy value and ifExists state,
+    so metric names are built once for each distinct value instead of once for each resource.
+    """
+    __slots__ = ('count', 'metric_name', 'get_group_by_value', 'get_if_exists_value', 'get_weight', 'max_tracked', 'total', 'group_by_count', 'other_count', 'if_exists_count', 'evict_heap', 'evict_sequence')
+
+    def __init__(self, count: 'CountElement', metric_name: str, get_weight: Callable[[Any], Any] | None = None):
+        self.count: CountElement = count
+        self.metric_name: str = count['metricName'] or metric_name
+        self.get_group_by_value: Callable[[Any], Any] | None = get_group_by_function(count['groupBy']) if has_group_by(count) else None
+        self.get_if_exists_value: Callable[[Any], Any] | None = None
+        if has_if_exists(count):
+            self.get_if_exists_value = compile_value_path(get_path_key(count['ifExists']['element']))
+        if get_weight is None and count['weight']:
+            get_weight = compile_value_path(get_path_key(count['weight']))
+        self.get_weight: Callable[[Any], Any] | None = get_weight
+        # Maximum number of distinct groupBy values tracked, so a high cardinality attribute doesn't grow counters without limit
+        self.max_tracked: int = sys.maxsize if count['groupBy']['maxValues'] is None else count['groupBy']['maxValues'] * CONST_TRACKED_VALUES_FACTOR
+        self.total: int = 0
+        self.group_by_count: dict[Any, int] = {}
+        self.other_count: int = 0
+        self.if_exists_count: dict[bool, int] = {}
+        # Min-heap of groupBy counts, built when the limit of distinct values is reached, to find the smallest one to evict
+        # Entries are updated lazily, so an entry is stale if its count is not the current one
+        self.evict_heap: list[tuple[int, int, Any]] = []
+        self.evict_sequence: int = 0
+
+    def add_untracked(self, attribute_value: Any, weight: int) -> None:
+        """
+        Count a resource with a groupBy value that is not tracked, when the limit of distinct values was reached.
+        Like Space-Saving algorithm, the value with the smallest count is evicted and counted as "Other", and the new value takes its place,
+        so the most frequent values are kept even when they first appear after the limit is reached.
+        Values that are ignored, like a value not in groupBy values, are not counted.
+        :param attribute_value: Value of groupBy element from the resource
+        :param weight: Number of resources it represents
+        """
+        group_by: GroupByElement = self.count['groupBy']
+        if get_metric_name_from_group_by(attribute_value, group_by, self.metric_name) is None:
+            return
+        # Heap is built on first eviction, and again when stale entries are more than the tracked values
+        if not self.evict_heap or len(self.evict_heap) > 2 * len(self.group_by_count):
+            self.evict_heap = [(value_count, sequence, value) for sequence, (value, value_count) in enumerate(self.group_by_count.items())]
+            self.evict_sequence = len(self.evict_heap)
+            heapq.heapify(self.evict_heap)
+
+        while True:
+            evicted_count, _, evicted_value = heapq.heappop(self.evict_heap)
+            if (current_count := self.group_by_count.get(evicted_value)) == evicted_count:
+                break
+            if current_count is not None:
+                self.push_evict_entry(evicted_value, current_count)
+        del self.group_by_count[evicted_value]
+        if get_metric_name_from_group_by(evicted_value, group_by, self.metric_name) is not None:
+            self.other_count += evicted_count
+        self.group_by_count[attribute_value] = weight
+        self.push_evict_entry(attribute_value, weight)
+
+    def push_evict_entry(self, attribute_value: Any, value_count: int) -> None:
+        """
+        Add a groupBy value count to the heap of values to evict. Sequence keeps heap order without comparing values.
+        :param attribute_value: Value of groupBy element
+        :param value_count: Current count of the value
+        """
+        heapq.heappush(self.evict_heap, (value_count, self.evict_sequence, attribute_value))
+        self.evict_sequence += 1
+
+    def get_group_by_metric_count(self, debug: bool = False) -> 'MetricCount':
+        """
+        Get groupBy metric count by metric name. Metric names are built for each distinct value,
+        several values can have the same metric name, like when customName is false.
+        With "maxValues", only the metric names with biggest counts are kept and the other ones are added together as "Other".
+        :param debug: Bool to indicate if it should log value details
+        :return: Dictionary of count by metric name
+        """
+        group_by: GroupByElement = self.count['groupBy']
+        metric_count: MetricCount = {}
+        for attribute_value, value_count in self.group_by_count.items():
+            if (metric_to_add := get_metric_name_from_group_by(attribute_value, group_by, self.metric_name, debug)) is not None:
+                metric_count[metric_to_add] = metric_count.get(metric_to_add, 0) + value_count
+        if (max_values := group_by['maxValues']) is None or (len(metric_count) <= max_values and not self.other_count):
+            return metric_count
+
+        # Ties keep the first value seen, as sort is stable
+        top_metrics: list[tuple[str, int]] = sorted(metric_count.items(), key=lambda metric: -metric[1])
+        other_name: str = f'{self.metric_name}-{group_by["otherValue"]}'
+        other_count: int = self.other_count + sum(value_count for _, value_count in top_metrics[max_values:])
+        logging.info('Metric "%s" has %s distinct groupBy values, or more, keeping %s and counting the other ones as "%s"', self.metric_name, len(metric_count), max_values, other_name)
+        metric_count = dict(top_metrics[:max_values])
+        metric_count[other_name] = metric_count.get(other_name, 0) + other_count
+        return metric_count
+
+
+class MetricCounter:
+    """
+    Counters of one service configuration, updated as resources are added, so resources can come from several pages or requests.
+    All count definitions are updated in a single pass, and attribute paths are compiled once, outside the resources loop.
+    """
+    __slots__ = ('config_service', 'debug', 'definitions', 'items')
+
+    def __init__(self, config_service: 'ResourceConfiguration', get_weight: Callable[[Any], Any] | None = None):
+        self.config_service: ResourceConfiguration = config_service
+        # Level is checked once, so each distinct value only logs its details at DEBUG level
+        self.debug: bool = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.definitions: list[CountDefinition] = [
+            CountDefinition(count, config_service['metric']['metricName'], get_weight) for count in config_service['counts']
+        ]
+        self.items: int = 0
+
+    def add(self, resources: Iterable[Any]) -> None:
+        """
+        Count resources, updating total, groupBy and ifExists counters of all count definitions in a single pass.
+        :param resources: Iterable of resources
+        """
+        counters = [
+            (definition, definition.get_weight, definition.get_group_by_value, definition.get_if_exists_value, definition.max_tracked, definition.group_by_count, definition.if_exists_count)
+            for definition in self.definitions
+        ]
+        totals: list[int] = [0] * len(counters)
+        items: int = 0
+        for resource in resources:
+            items += 1
+            for position, (definition, get_weight, get_group_by_value, get_if_exists_value, max_tracked, group_by_count, if_exists_count) in enumerate(counters):
+                weight: int = 1 if get_weight is None else get_resource_weight(get_weight(resource))
+                totals[position] += weight
+
+                # GroupBy values are aggregated as they are, values that can't be hashed, like lists, are aggregated by their text
+                if get_group_by_value is not None:
+                    attribute_value: Any = get_group_by_value(resource)
+                    try:
+                        value_count: int | None = group_by_count.get(attribute_value)
+                    except TypeError:
+                        value_count = group_by_count.get(attribute_value := str(attribute_value))
+                    if value_count is not None:
+                        group_by_count[attribute_value] = value_count + weight
+                    elif len(group_by_count) < max_tracked:
+                        group_by_count[attribute_value] = weight
+                    else:
+                        definition.add_untracked(attribute_value, weight)
+
+                # IfExists is aggregated by the attribute existence, an empty value counts as not existing
+                if get_if_exists_value is not None:
+                    exists: bool = bool(attribute_value) if (attribute_value := get_if_exists_value(resource)) is not CONST_MISSING else False
+                    if_exists_count[exists] = if_exists_count.get(exists, 0) + weight
+        self.items += items
+        for definition, total in zip(self.definitions, totals):
+            definition.total += total
+
+    def get_metric_data(self, dimensions: 'Dimensions' = (), timestamp: datetime | None = None, stats: 'ResourceStats | None' = None) -> 'Metric':
+        """
+        Get metric data from counters, in count definition order.
+        :param dimensions: Additional dimensions for all metrics, like region
+        :param timestamp: Timestamp for all metrics, usually the run timestamp. Current time is used if not informed
+        :param stats: Statistics to count items, if informed
+        :return: Dictionary of metric count for resources grouped by attribute, empty if there is no resource
+        """
+        timestamp = timestamp or datetime.utcnow()
+        namespace: str = self.config_service['metric']['namespace']
+        dimension_name: str = self.config_service['metric']['dimensionName']
+        dimension_value: str = self.config_service['metric']['dimensionValue']
+        if stats is not None:
+            stats.items = self.items
+        metric_data: Metric = {}
+        for definition in self.definitions:
+            if definition.total == 0:
+                continue
+            metric_count: MetricCount = {}
+
+            # Total metric
+            if definition.count['generateTotal']:
+                metric_count[definition.metric_name] = definition.total
+
+            for metric_to_add, value_count in definition.get_group_by_metric_count(self.debug).items():
+                metric_count[metric_to_add] = metric_count.get(metric_to_add, 0) + value_count
+            for exists, value_count in definition.if_exists_count.items():
+                metric_to_add = get_metric_name_from_if_exists(exists, definition.count['ifExists'], definition.metric_name, self.debug)
+                metric_count[metric_to_add] = metric_count.get(metric_to_add, 0) + value_count
+
+            # Add the metric count to the metric data
+            for metric_to_add, metric_value in metric_count.items():
+                metric_data[get_metric_key(metric_to_add, dimensions)] = MetricData(namespace, dimension_name, dimension_value, metric_to_add, metric_value, timestamp=timestamp, dimensions=dimensions)
+        return metric_data
+
+
+class MetricStore(Mapping):
+    """
+    Metrics of one namespace, stored as arrays instead of one MetricData for each metric.
+    Namespace, dimensions and timestamp are kept once, as all metrics of a run share the same timestamp,
+    and dimensions are shared by all metrics of a resource in one region and account.
+    It is read like a dictionary of MetricData by metric key, which is built for each metric when it is read.
+    """
+    def __init__(self, namespace: str, timestamp: datetime | None = None):
+        self.namespace: str = namespace
+        # Timestamp is the one from the first metric, if it is not informed
+        self.timestamp: datetime | None = timestamp
+        self.positions: dict[str, int] = {}
+        self.metric_names: list[str] = []
+        self.metric_values: array = array('q')
+        self.dimension_ids: array = array('I')
+        # Dimension name and value of the resource, with its additional dimensions, interned by the index of their first use
+        self.dimensions: list[tuple[str, str, Dimensions]] = []
+        self.dimension_index: dict[tuple[str, str, Dimensions], int] = {}
+
+    def __getitem__(self, metric_key: str) -> MetricData:
+        position: int = self.positions[metric_key]
+        dimension_name, dimension_value, dimensions = self.dimensions[self.dimension_ids[position]]
+        return MetricData(self.namespace, dimension_name, dimension_value, self.metric_names[position], self.metric_values[position], timestamp=self.timestamp, dimensions=dimensions)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.positions)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def set(self, metric_key: str, metric_data: MetricData, add: bool = False) -> None:
+        """
+        Set the value of a metric, adding it if it doesn't exist.
+        :param metric_key: Metric key
+        :param metric_data: Metric data, its namespace and timestamp are the ones from the store
+        :param add: Bool to indicate if metric value is added to the existing one, like filtered queries of the same resource
+        """
+        if self.timestamp is None:
+            self.timestamp = metric_data.timestamp
+        if (position := self.positions.get(metric_key)) is not None:
+            if add:
+                self.metric_values[position] += metric_data.metric_value
+                return
+            # Like a dictionary, the last metric set with the same key replaces the previous one, with its own dimensions
+            self.metric_names[position] = sys.intern(metric_data.metric_name)
+            self.metric_values[position] = metric_data.metric_value
+            self.dimension_ids[position] = self.get_dimension_id(metric_data)
+            return
+
+        self.positions[sys.intern(metric_key)] = len(self.metric_names)
+        self.metric_names.append(sys.intern(metric_data.metric_name))
+        self.metric_values.append(metric_data.metric_value)
+        self.dimension_ids.append(self.get_dimension_id(metric_data))
+
+    def get_dimension_id(self, metric_data: MetricData) -> int:
+        """
+        Get the index of metric dimensions, adding them if they are not used by any other metric yet.
+        :param metric_data: Metric data
+        :return: Index of dimension name, dimension value and additional dimensions
+        """
+        dimensions: tuple[str, str, Dimensions] = (metric_data.dimension_name, metric_data.dimension_value, metric_data.dimensions)
+        if (dimension_id := self.dimension_index.get(dimensions)) is None:
+            dimension_id = self.dimension_index[dimensions] = len(self.dimensions)
+            self.dimensions.append(dimensions)
+        return dimension_id
+
+
+class ServiceConfigurationCache(NamedTuple):
+    """Parsed and validated configuration, with the config file identity used to detect changes"""
+    file_name: str
+    file_stat: tuple[int, int]
+    file_hash: str
+    settings: 'SettingsConfiguration'
+    config_services: list['ResourceConfiguration']
+
+
+class ClientPool:
+    """
+    Pool of boto3 clients used by one invocation, shared by all resources with the same service, region and account.
+    Clients are taken from the registry kept across warm invocations, so their HTTP connections are reused,
+    and they are only created when missing, or when their session or settings changed.
+    Clients from the same account are created one at a time, as boto3 session is not thread safe.
+    """
+    def __init__(self, settings: SettingsConfiguration):
+        self.settings: SettingsConfiguration = settings
+        self.clients: dict[ClientKey, Any] = {}
+        self.sts_client: Any = None
+        self.failed_accounts: dict[str, Exception] = {}
+        self.account_locks: dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+        # HTTP counters of each client when this invocation started using it, to report connection reuse of this invocation only
+        self.http_counters: dict[ClientKey, tuple[int, int]] = {}
+        self.created: int = 0
+        self.reused: int = 0
+
+    def __getitem__(self, client_key: ClientKey) -> Any:
+        """Get the boto3 client, from the registry or creating it on first use"""
+        if (client := self.clients.get(client_key)) is not None:
+            return client
+
+        service_name, region, account_id = client_key
+        with self.get_account_lock(account_id):
+            if (client := self.clients.get(client_key)) is None:
+                session: Any = self.get_session(account_id)
+                client_settings: str = get_client_settings_key(service_name, self.settings)
+                with client_registry_lock:
+                    registered: RegisteredClient | None = client_registry.get(client_key)
+                if registered is not None and registered.session is session and registered.client_settings == client_settings:
+                    logging.info('Reusing client for service: %s, region: %s, account: %s', service_name, region or 'default', account_id or 'default')
+                    client = registered.client
+                    self.http_counters[client_key] = get_http_counters(client)
+                    self.reused += 1
+                else:
+                    client = create_boto3_client(session, service_name, region, account_id, self.settings)
+                    with client_registry_lock:
+                        client_registry[client_key] = RegisteredClient(client, session, client_settings)
+                    self.http_counters[client_key] = (0, 0)
+                    self.created += 1
+                self.clients[client_key] = client
+        return client
+
+    def get_account_lock(self, account_id: str) -> threading.Lock:
+        """Get the lock to create clients for the account"""
+        with self.lock:
+            return self.account_locks.setdefault(account_id, threading.Lock())
+
+    def get_session(self, account_id: str) -> Any:
+        """
+        Get the boto3 session for the account, it must be called holding the account lock.
+        An account where the role can't be assumed fails just once, then the same error is raised for all its clients.
+        """
+        if not account_id:
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            return boto3.DEFAULT_SESSION
+
+        if account_id in self.failed_accounts:
+            raise self.failed_accounts[account_id]
+        try:
+            # STS client is from the Lambda function account, so it is created holding its lock
+            if self.sts_client is None:
+                self.sts_client = self[('sts', '', '')]
+            return get_account_session(self.sts_client, account_id, self.settings['accounts'])
+        except Exception as error:
+            logging.error('Unable to assume role for account "%s", will ignore it: %s', account_id, error)
+            self.failed_accounts[account_id] = error
+            raise
+
+
+    def get_connection_stats(self) -> dict[str, Any]:
+        """
+        Get client and HTTP connection reuse statistics of this invocation.
+        A request that doesn't open a new connection reuses one from the client pool, kept from previous requests or invocations.
+        """
+        requests: int = 0
+        connections: int = 0
+        for client_key, client in list(self.clients.items()):
+            client_requests, client_connections = get_http_counters(client)
+            start_requests, start_connections = self.http_counters.get(client_key, (0, 0))
+            requests += client_requests - start_requests
+            connections += client_connections - start_connections
+        return {
+            'clientsCreated': self.created,
+            'clientsReused': self.reused,
+            'httpRequests': requests,
+            'newConnections': connections,
+            'connectionReuseRate': round(1 - connections / requests, 3) if requests else None
+        }
+
+
+class RegisteredClient(NamedTuple):
+    """boto3 client kept across warm invocations, with the session and settings used to create it"""
+    client: Any
+    session: Any
+    client_settings: str
+
+
+# boto3 clients by service, region and account. They are kept across warm Lambda invocations with their HTTP connection pools,
+# so warm invocations don't open new connections and TLS sessions to each endpoint.
+client_registry: dict[ClientKey, RegisteredClient] = {}
+client_registry_lock = threading.Lock()
+
+# Assumed role sessions by account id. It is kept across warm Lambda invocations until credentials are near expiry.
+account_sessions: dict[str, AccountSession] = {}
+account_sessions_lock = threading.Lock()
+
+# Active accounts from AWS Organizations, kept across warm Lambda invocations so they are not listed on each run
+organization_accounts: OrganizationAccounts | None = None
+
 Metric = dict[str, MetricData]
-Namespace = dict[str, Metric]
+Namespace = dict[str, Mapping[str, MetricData]]
 MetricCount = dict[str, int]
+State = dict[str, Any]
+"""
+State persisted between runs.
+:key metrics: Last published value and time by namespace and metric key
+:key resources: Last collection time, change marker and metrics by resource state key
+"""
 CloudWatchMetricData = dict[str, Any]
 CloudWatchMetricDataList = list[CloudWatchMetricData]
 
 #======================================================================================================================
-# Recursive function to iterate over a list of resources
+# Generator functions to iterate over a list of resources
 #======================================================================================================================
 
-# Recursive function to iterate over a list of dictionaries
-def list_from_paginator(clients: Boto3Clients, resources: list[Any], config_service: ResourceConfiguration) -> None:
+def list_from_paginator(client: Any, config_service: ResourceConfiguration) -> Iterator[Any]:
     """
     List resources from a paginated service method.
-    :param clients: Dictionary of boto3 clients
-    :param resources: List of resources to be filled. It must be an initialized list.
+    :param client: boto3 client of the service
     :param config_service: Dictionary of service config
+    :return: Generator of method responses, one for each page
     """
-    if resources is None:
-        raise ValueError('resources is not initialized')
-
     service_name: str = config_service['resource']['client']
     method: str = config_service['resource']['method']
     kwargs: dict[str, Any] = config_service['resource']['kwargs']
     iterate_over: list[str] = config_service['resource']['iterateOver']
-    must_exists: bool = config_service['resource']['mustExists']
-    client = clients[service_name]
+
+    # Request the biggest page allowed
+    if (page_size := get_page_size(client, config_service)) is not None:
+        kwargs = {**kwargs, 'PaginationConfig': {**kwargs.get('PaginationConfig', {}), 'PageSize': page_size[1]}}
 
     paginator = client.get_paginator(method)
     for page in paginator.paginate(**kwargs):
-        logging.info('Page for service: %s, method: %s, iterate_over: %s', service_name, method, iterate_over)
-        iterate_over_response_attribute(page, resources, iterate_over, must_exists)
+        logging.debug('Page for service: %s, method: %s, iterate_over: %s', service_name, method, iterate_over)
+        yield page
 
-# Recursive function to iterate over a list of dictionaries
-def list_next_in_response(clients: Boto3Clients, resources: list[Any], config_service: ResourceConfiguration) -> None:
+def list_next_in_response(client: Any, config_service: ResourceConfiguration) -> Iterator[Any]:
     """
     List resources from a service method that supports NextToken | NextHandler | NextMarker.
-    :param clients: Dictionary of boto3 clients
-    :param resources: List of resources
+    :param client: boto3 client of the service
     :param config_service: Dictionary of service config
+    :return: Generator of method responses, one for each "next" request
     """
-    if resources is None:
-        raise ValueError('resources is not initialized')
-
     service_name: str = config_service['resource']['client']
     method: str = config_service['resource']['method']
-    kwargs: dict[str, Any] = config_service['resource']['kwargs']
+    # Copy kwargs as the next token is added to it and configuration must not be changed
+    kwargs: dict[str, Any] = dict(config_service['resource']['kwargs'])
     iterate_over: list[str] = config_service['resource']['iterateOver']
-    must_exists: bool = config_service['resource']['mustExists']
     next_response: str = config_service['resource']['nextInResponse']
     next_request: str = config_service['resource']['nextInRequest']
-    client = clients[service_name]
+    if (page_size := get_page_size(client, config_service)) is not None:
+        kwargs[page_size[0]] = page_size[1]
 
     # Call method with defined argument
     response = getattr(client, method)(**kwargs)
     while True:
-        logging.info('Response for service: %s, method: %s, kwargs: %s, iterate_over: %s', service_name, method, kwargs, iterate_over)
-        iterate_over_response_attribute(response, resources, iterate_over, must_exists)
+        logging.debug('Response for service: %s, method: %s, kwargs: %s, iterate_over: %s', service_name, method, kwargs, iterate_over)
+        yield response
 
         if next_response not in response:
             break
 
         kwargs[next_request] = response[next_response]
-        logging.info('Found %s for service: %s, method: %s, kwargs: %s, iterate_over: %s', next_response, service_name, method, kwargs, iterate_over)
+        logging.debug('Found %s for service: %s, method: %s, kwargs: %s, iterate_over: %s', next_response, service_name, method, kwargs, iterate_over)
         response = getattr(client, method)(**kwargs)
 
-# Recursive function to iterate over a list of dictionaries
-def list_direct(clients: Boto3Clients, resources: list[Any], config_service: ResourceConfiguration) -> None:
+def get_page_size(client: Any, config_service: ResourceConfiguration) -> tuple[str, int] | None:
     """
-    List resources from a service method direct call without pagination or NextToken | NextHandler | NextMarker.
-    :param clients: Dictionary of boto3 clients
-    :param resources: List of resources
+    Get the page size argument and value for a service method, to reduce the number of requests.
+    Page size is the one configured on resource, or the maximum value allowed by botocore service model.
+    :param client: boto3 client of the service
     :param config_service: Dictionary of service config
+    :return: Tuple of method argument and page size, or None if method doesn't have a page size, its maximum is unknown
+        or it is already defined on method arguments
+    """
+    kwargs: dict[str, Any] = config_service['resource']['kwargs']
+    key: tuple[str, str] = (config_service['resource']['client'], config_service['resource']['method'])
+    if key not in max_page_sizes:
+        max_page_sizes[key] = get_max_page_size(client, config_service['resource']['method'])
+    if (max_page_size := max_page_sizes[key]) is None:
+        return None
+
+    argument, maximum = max_page_size
+    if argument in kwargs or 'PageSize' in kwargs.get('PaginationConfig', {}):
+        return None
+    if (page_size := config_service['resource']['pageSize']) is not None:
+        return argument, page_size
+    return (argument, maximum) if maximum is not None else None
+
+def get_max_page_size(client: Any, method: str) -> tuple[str, int | None] | None:
+    """
+    Get the page size argument and its maximum value from botocore service model.
+    Some models don't define the maximum value, like EC2 ones, so it is taken from known maximums, or only configured page size is used for them.
+    :param client: boto3 client of the service
+    :param method: boto3 method name
+    :return: Tuple of method argument and its maximum value, None if unknown, or None if method doesn't have a page size argument
+    """
+    operation_name: str = client.meta.method_to_api_mapping.get(method, '')
+    if (page_size := get_operation_page_size(client.meta.service_model, operation_name)) is None:
+        return None
+    argument, maximum = page_size
+    if maximum is None:
+        maximum = CONST_KNOWN_MAX_PAGE_SIZES.get((client.meta.service_model.service_name, method))
+    logging.info('Page size for method "%s": argument "%s", maximum %s', method, argument, maximum)
+    return argument, maximum
+
+def get_operation_page_size(service_model: Any, operation_name: str) -> tuple[str, int | None] | None:
     """
-    if resources is None:
-        raise ValueError('resources is not initialized')
+    Get the page size argument and its maximum value of an operation from botocore service model.
+    :param service_model: botocore service model
+    :param operation_name: API operation name, like "DescribeInstances"
+    :return: Tuple of method argument and its maximum value, None if unknown, or None if operation doesn't have a page size argument
+    """
+    input_shape = service_model.operation_model(operation_name).input_shape if operation_name else None
+    if input_shape is None:
+        return None
+    for argument in CONST_PAGE_SIZE_ARGUMENTS:
+        if argument in input_shape.members:
+            return argument, input_shape.members[argument].metadata.get('max')
+    return None
+
+def has_page_size_argument(service_name: str, method: str) -> bool | None:
+    """
+    Check if a service method has a page size argument, so a configured "pageSize" can be used.
+    :param service_name: boto3 service name
+    :param method: boto3 method name
+    :return: Bool to indicate if method has a page size argument, None if method is unknown
+    """
+    service_model, operation_names = get_service_operations(service_name)
+    if (operation_name := operation_names.get(method)) is None:
+        return None
+    return get_operation_page_size(service_model, operation_name) is not None
+
+@functools.lru_cache(maxsize=None)
+def get_service_operations(service_name: str) -> tuple[Any, dict[str, str]]:
+    """
+    Get botocore service model and its operation names by boto3 method name, without creating a client.
+    It loads botocore data directory, so it is done once for each service and kept across warm Lambda invocations.
+    :param service_name: boto3 service name
+    :return: Service model and dictionary of operation name by method name
+    """
+    service_model: Any = get_botocore_session().get_service_model(service_name)
+    return service_model, {xform_name(operation_name): operation_name for operation_name in service_model.operation_names}
+
+@functools.lru_cache(maxsize=None)
+def get_botocore_session() -> Any:
+    """
+    Get the botocore session used to load service models, so its loader cache is shared by all services.
+    :return: botocore session
+    """
+    return botocore.session.get_session()
 
+def list_direct(client: Any, config_service: ResourceConfiguration) -> Iterator[Any]:
+    """
+    List resources from a service method direct call without pagination or NextToken | NextHandler | NextMarker.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :return: Generator with the single method response
+    """
     service_name: str = config_service['resource']['client']
     method: str = config_service['resource']['method']
     kwargs: dict[str, Any] = config_service['resource']['kwargs']
     iterate_over: list[str] = config_service['resource']['iterateOver']
-    must_exists: bool = config_service['resource']['mustExists']
-    client = clients[service_name]
 
     # Call method with defined argument
     response = getattr(client, method)(**kwargs)
-    logging.info('Response for service: %s, method: %s, kwargs: %s, iterate_over: %s', service_name, method, kwargs, iterate_over)
-    iterate_over_response_attribute(response, resources, iterate_over, must_exists)
+    logging.debug('Response for service: %s, method: %s, kwargs: %s, iterate_over: %s', service_name, method, kwargs, iterate_over)
+    yield response
 
-def iterate_over_response_attribute(dict_object: Any, resources: list[Any], iterate_over: list[str], must_exists: bool) -> None:
+def list_config_query(client: Any, config_service: ResourceConfiguration) -> Iterator[Any]:
     """
-    Recursive function to iterate over a list of dictionaries.
-    :param dict_object: Dictionary to iterate over
-    :param resources: List of resources
-    :param iterate_over: List of attributes to iterate over
-    :param must_exists: Bool to indicate if iterate_over attribute must exists or not
+    List results from an AWS Config advanced query, like "select_resource_config" or "select_aggregate_resource_config".
+    Results are returned as JSON strings, so they are parsed to be counted like any other resource.
+    A query with "GROUP BY" returns aggregated counts, to be used with "weight" count attribute.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :return: Generator of method responses, one for each page
     """
-    logging.info('iterate_over: %s', iterate_over)
-    logging.info('Lenght of iterate_over: %s', len(iterate_over))
+    for page in list_from_paginator(client, config_service):
+        yield {**page, 'Results': [json.loads(result) for result in page.get('Results', [])]}
 
-    if (iterate_attribute := iterate_over[0]) not in dict_object:
-        if must_exists:
-            logging.error('Attribute %s not found. It must exists.', iterate_attribute)
-        else:
-            logging.warning('Attribute %s not found. It is optional.', iterate_attribute)
+def count_resource_explorer(client: Any, config_service: ResourceConfiguration) -> int | None:
+    """
+    Count resources from a Resource Explorer search without listing them, as the response has the total count.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :return: Number of resources, or None if the count is not complete and resources must be listed
+    """
+    response = getattr(client, config_service['resource']['method'])(**{**config_service['resource']['kwargs'], 'MaxResults': 1})
+    if not response.get('Count', {}).get('Complete', False):
+        logging.info('Resource Explorer count is not complete, will list all resources')
+        return None
+    return response['Count']['TotalResources']
+
+def list_chain(client: Any, config_service: ResourceConfiguration) -> Iterator[Any]:
+    """
+    List resources from a chain of calls, where the ids of the resources from one level are the arguments of the next level calls.
+    Like, ECS clusters from "list_clusters", services of each cluster from "list_services", and their details from "describe_services".
+    First level is the resource method, paginated when it supports it. Each parent page is processed through all levels before the next one,
+    so memory is bounded by the resources of one page.
+    Calls of each level run in parallel, limited by the level concurrency, and ids are batched when the method accepts several of them.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :return: Generator of last level responses, one for each page
+    """
+    levels: list[ChainElement] = config_service['resource']['chain']
+    list_parent: Callable[[Any, ResourceConfiguration], Iterator[Any]] = list_from_paginator if client.can_paginate(config_service['resource']['method']) else list_direct
+    iterate_over = compile_iterate_over(get_path_key(config_service['resource']['iterateOver']), config_service['resource']['mustExists'])
+    # Statistics are thread local, so calls from level workers are counted on the resource statistics
+    stats: ResourceStats | None = getattr(collection_context, 'stats', None)
+    executors: list[ThreadPoolExecutor] = [
+        ThreadPoolExecutor(max_workers=level['concurrency'], thread_name_prefix=f'chain-{index}') for index, level in enumerate(levels)
+    ]
+    try:
+        for page in list_parent(client, config_service):
+            parents: list[tuple[Any, dict[str, Any]]] = [(item, config_service['resource']['kwargs']) for item in iterate_over(page)]
+            yield from get_chain_responses(client, config_service, levels, executors, parents, stats)
+    finally:
+        # Calls not started yet are cancelled when collection stops before the last page, like on an error or when time budget ends
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+def get_chain_responses(client: Any, config_service: ResourceConfiguration, levels: list[ChainElement], executors: list[ThreadPoolExecutor], parents: list[tuple[Any, dict[str, Any]]], stats: 'ResourceStats | None') -> Iterator[Any]:
+    """
+    Get the last level responses of a chain for the resources of its previous level.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :param levels: Chain levels still to be called
+    :param executors: Thread pools of the levels still to be called
+    :param parents: Resources from the previous level with the arguments of the call that returned them
+    :param stats: Statistics to count API calls, if informed
+    :return: Generator of last level responses
+    """
+    level: ChainElement = levels[0]
+    calls: list[dict[str, Any]] = get_chain_calls(level, parents)
+    logging.debug('Chain level "%s" with %s calls for %s resources', level['method'], len(calls), len(parents))
+    level_responses: Iterator[list[Any]] = executors[0].map(functools.partial(call_chain_level, client, config_service, level, stats=stats), calls)
+    if len(levels) == 1:
+        for responses in level_responses:
+            yield from responses
         return
 
-    logging.info('Length of dict_object: %s', len(dict_object[iterate_attribute]))
-    logging.debug('dict_object: %s', dict_object[iterate_attribute])
+    iterate_over: Callable[[Any], Iterator[Any]] = get_chain_iterate_over(level, config_service['resource']['mustExists'])
+    children: list[tuple[Any, dict[str, Any]]] = [
+        (item, kwargs) for kwargs, responses in zip(calls, level_responses) for response in responses for item in iterate_over(response)
+    ]
+    yield from get_chain_responses(client, config_service, levels[1:], executors[1:], children, stats)
 
-    for item in dict_object[iterate_attribute]:
-        if len(iterate_over) > 1:
-            logging.info('Call recursively')
-            iterate_over_response_attribute(item, resources, iterate_over[1:], must_exists)
+def get_chain_calls(level: ChainElement, parents: list[tuple[Any, dict[str, Any]]]) -> list[dict[str, Any]]:
+    """
+    Get the arguments of each call of a chain level.
+    Ids are batched up to the level batch size, and only resources with the same inherited arguments are batched together.
+    :param level: Chain level configuration
+    :param parents: Resources from the previous level with the arguments of the call that returned them
+    :return: List of call arguments
+    """
+    get_id: Callable[[Any], Any] = compile_value_path(get_path_key(level['idPath'])) if level['idPath'] else lambda item: item
+    ids_by_arguments: dict[str, tuple[dict[str, Any], list[Any]]] = {}
+    for item, parent_kwargs in parents:
+        if (resource_id := get_id(item)) is CONST_MISSING:
+            logging.warning('Attribute "%s" not found on resource for chain level "%s", will ignore it', level['idPath'], level['method'])
+            continue
+        inherited: dict[str, Any] = {name: parent_kwargs[name] for name in level['inheritArguments'] if name in parent_kwargs}
+        ids_by_arguments.setdefault(json.dumps(inherited, sort_keys=True, default=str), (inherited, []))[1].append(resource_id)
+
+    calls: list[dict[str, Any]] = []
+    for inherited, ids in ids_by_arguments.values():
+        if level['batchSize'] is None:
+            calls.extend({**level['kwargs'], **inherited, level['argument']: resource_id} for resource_id in ids)
         else:
-            logging.info('Add item to resources')
-            resources.append(item)
-
+            calls.extend({**level['kwargs'], **inherited, level['argument']: ids[start:start + level['batchSize']]} for start in range(0, len(ids), level['batchSize']))
+    return calls
 
-#======================================================================================================================
-# Recursive function to group resources by dictionary attribute
-#======================================================================================================================
+def call_chain_level(client: Any, config_service: ResourceConfiguration, level: ChainElement, kwargs: dict[str, Any], stats: 'ResourceStats | None' = None) -> list[Any]:
+    """
+    Call the method of a chain level, with all pages when it supports pagination.
+    It runs inside a level worker thread.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :param level: Chain level configuration
+    :param kwargs: Call arguments
+    :param stats: Statistics to count API calls, if informed
+    :return: List of responses, one for each page, or an empty response if the call fails with an ignored error
+    """
+    level_config = ResourceConfiguration(**{**config_service, 'resource': ResourceElement(**{
+        **config_service['resource'], 'method': level['method'], 'kwargs': kwargs, 'iterateOver': level['iterateOver'], 'pageSize': None
+    })})
+    collection_context.stats = stats
+    try:
+        if client.can_paginate(level['method']):
+            return list(list_from_paginator(client, level_config))
+        return list(list_direct(client, level_config))
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') not in level['ignoreErrors']:
+            raise
+        logging.debug('Ignored error from chain level "%s", kwargs: %s: %s', level['method'], kwargs, error)
+        return [{}]
+    finally:
+        collection_context.stats = None
+
+def get_chain_iterate_over(level: ChainElement, must_exists: bool) -> Callable[[Any], Iterator[Any]]:
+    """
+    Get the function that iterates over the resources of a chain level response.
+    :param level: Chain level configuration
+    :param must_exists: Bool to indicate if iterateOver attributes must exists or not
+    :return: Function to get a generator of resources from a response, the response itself if level doesn't have iterateOver
+    """
+    if not level['iterateOver']:
+        return lambda response: iter((response,))
+    return compile_iterate_over(get_path_key(level['iterateOver']), must_exists)
 
-def get_metric_count(resources: list[Any], config_service: ResourceConfiguration) -> Metric:
+def get_resource_iterate_over(config_service: ResourceConfiguration) -> Callable[[Any], Iterator[Any]]:
     """
-    Count metric resources by the attributes defined on configuration.
-    :param resources: List of resources
+    Get the function that iterates over the resources of each page of a service configuration.
+    Pages of a chain are responses from its last level, so its resources are selected with the last level iterateOver.
     :param config_service: Dictionary of service config
-    :return: Dictionary of metric count for resources grouped by attribute
+    :return: Function to get a generator of resources from a page
     """
-    namespace: str = config_service['metric']['namespace']
-    dimension_name: str = config_service['metric']['dimensionName']
-    dimension_value: str = config_service['metric']['dimensionValue']
-    metric_name: str = config_service['metric']['metricName']
+    if config_service['resource']['chain']:
+        return get_chain_iterate_over(config_service['resource']['chain'][-1], config_service['resource']['mustExists'])
+    return compile_iterate_over(get_path_key(config_service['resource']['iterateOver']), config_service['resource']['mustExists'])
 
-    metric_data: Metric = {}
+def get_resources(client: Any, config_service: ResourceConfiguration, stats: 'ResourceStats | None' = None, previous_marker: Any = None, stop: threading.Event | None = None) -> tuple[Iterable[Any], Callable[[Any], int] | None]:
+    """
+    Get the resources to be counted for one service configuration.
+    When only the total is counted and the service returns the count itself, it is used instead of listing resources.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :param stats: Statistics to count pages, if informed
+    :param previous_marker: Change marker from the previous run, if any
+    :param stop: Event set when time budget ends, so no other page is requested, if informed
+    :return: Iterable of resources and the function to get the number of resources each one represents, None to use configuration
+    """
+    if (count_function := CONST_SERVICE_COUNT.get(config_service['type'])) is not None \
+        and not any(has_group_by(count) or has_if_exists(count) for count in config_service['counts']):
+        if (total := count_function(client, config_service)) is not None:
+            if stats is not None:
+                stats.pages += 1
+            return (total,), int
+    return iterate_over_resources(client, config_service, stats, previous_marker, stop), None
+
+def iterate_over_resources(client: Any, config_service: ResourceConfiguration, stats: 'ResourceStats | None' = None, previous_marker: Any = None, stop: threading.Event | None = None) -> Iterator[Any]:
+    """
+    Stream resources for one service configuration, page by page.
+    Each page is released as soon as its resources are consumed, so memory is bounded by the page size.
+    When resource has a change marker, it is read from the first page and the other pages are not requested if it didn't change.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :param stats: Statistics to count pages and keep the change marker, if informed
+    :param previous_marker: Change marker from the previous run, if any
+    :param stop: Event set when time budget ends, so no other page is requested, if informed
+    :return: Generator of resources
+    :raise ResourceUnchanged: If change marker is the same from the previous run
+    :raise ResourceSkipped: If time budget ends before the last page
+    """
+    iterate_over = get_resource_iterate_over(config_service)
+    for page in iterate_over_pages(client, config_service, stats, previous_marker, stop):
+        yield from iterate_over(page)
 
-    # Total metric
-    if config_service['count']['generateTotal']:
-        metric_data[metric_name] = MetricData(namespace, dimension_name, dimension_value, metric_name, len(resources), timestamp=datetime.utcnow())
+def iterate_over_pages(client: Any, config_service: ResourceConfiguration, stats: 'ResourceStats | None' = None, previous_marker: Any = None, stop: threading.Event | None = None) -> Iterator[Any]:
+    """
+    Stream the response pages for one service configuration.
+    :param client: boto3 client of the service
+    :param config_service: Dictionary of service config
+    :param stats: Statistics to count pages and keep the change marker, if informed
+    :param previous_marker: Change marker from the previous run, if any
+    :param stop: Event set when time budget ends, so no other page is requested, if informed
+    :return: Generator of pages
+    :raise ResourceUnchanged: If change marker is the same from the previous run
+    :raise ResourceSkipped: If time budget ends before the last page
+    """
+    get_marker: Callable[[Any], Any] | None = None
+    if config_service['resource']['changeMarker']:
+        get_marker = compile_value_path(get_path_key(config_service['resource']['changeMarker']))
+
+    for page in CONST_SERVICE_TYPE[config_service['type']](client, config_service):
+        if stats is not None:
+            if stats.pages == 0 and get_marker is not None and (marker := get_marker(page)) is not CONST_MISSING:
+                if previous_marker is not None and marker == previous_marker:
+                    raise ResourceUnchanged(marker)
+                stats.marker = marker
+            stats.pages += 1
+        yield page
+        # Main thread doesn't wait for running resources after time budget ends, so they stop before their next page
+        if stop is not None and stop.is_set():
+            raise ResourceSkipped('time budget ended before reading all pages')
 
-    metric_count: dict[str, int] = {}
-    # Metrics from GroupBy configuration
-    if has_group_by(config_service):
-        logging.info('Has groupBy')
-        metric_count.update(get_metric_count_from_group_by(resources, config_service))
-    else:
-        logging.info('No groupBy attribute for service: %s', config_service)
 
-    # Metrics from IfExists configuration
-    if has_if_exists(config_service):
-        logging.info('Has ifExists')
-        metric_count.update(get_metric_count_from_if_exists(resources, config_service))
-    else:
-        logging.info('No ifExists attribute for service: %s', config_service)
+#======================================================================================================================
+# Functions to compile attribute paths once, so resources are read without recursion or list slicing
+#======================================================================================================================
 
-    # Add the metric count to the metric data
-    for metric_to_add, metric_value in metric_count.items():
-        metric_data[metric_to_add] = MetricData(namespace, dimension_name, dimension_value, metric_to_add, metric_value, timestamp=datetime.utcnow())
-    return metric_data
+def get_path_key(path: AttributePath) -> tuple[str, ...] | str:
+    """
+    Get a hashable key of an attribute path, to be used with compiled paths cache.
+    :param path: Attribute path from configuration
+    :return: Tuple of path segments or path string
+    """
+    return tuple(path) if isinstance(path, list) else path
 
-def get_metric_count_from_group_by(resources: list[Any], config_service: ResourceConfiguration) -> MetricCount:
+def parse_path(path: tuple[str, ...] | str) -> list[tuple[str, tuple[PathStep, ...]]]:
     """
-    Group resources by dictionary attribute.
-    :param resources: List of resources
-    :param config_service: Dictionary of service config
-    :return: Dictionary of metric count for resources grouped by attribute
-    """
-    metric_name: str = config_service['metric']['metricName']
-    group_by: list[str] = config_service['count']['groupBy']['element']
-    group_by_values: list[str] = config_service['count']['groupBy'].get('values', [])
-    capitalize: bool = config_service['count']['groupBy']['capitalize']
-    custom_name: bool = config_service['count']['groupBy']['customName']
-    metric_count: MetricCount = {}
-
-    for resource in resources:
-        attribute_value = get_groupby_attribute_value(resource, group_by)
-        logging.info('Attribute value: %s', attribute_value)
-
-        # If group by values was defined and the attribute value is not in the group by values, ignore the resource
-        if len(group_by_values) > 0:
-            if attribute_value not in group_by_values:
-                logging.info('Attribute value "%s" not in group_by_values "%s"', attribute_value, group_by_values)
-                continue
+    Parse an attribute path into segments and their steps.
+    A segment is an attribute name followed by optional selectors: "[0]" index, "[*]" wildcard and "[?Key=='value']" filter.
+    Segment "*" selects all values from a dictionary.
+    :param path: Tuple of path segments or a single string with segments joined by "."
+    :return: List of segment text and its steps
+    :raise ValueError: If path is empty or has an invalid segment
+    """
+    segments: list[str] = CONST_PATH_SEGMENT_PATTERN.findall(path) if isinstance(path, str) else list(path)
+    if not segments:
+        raise ValueError(f'Attribute path "{path}" is empty')
+
+    parsed_segments: list[tuple[str, tuple[PathStep, ...]]] = []
+    for segment in segments:
+        if not isinstance(segment, str) or not segment or not (match := CONST_PATH_NAME_PATTERN.fullmatch(segment)):
+            raise ValueError(f'Attribute path segment "{segment}" is not valid')
+
+        steps: list[PathStep] = []
+        if (name := match[1]) == '*':
+            steps.append((CONST_PATH_WILDCARD, None))
+        elif name:
+            steps.append((CONST_PATH_KEY, name))
+        for selector in CONST_PATH_SELECTOR_PATTERN.findall(match[2]):
+            if (selector := selector.strip()) == '*':
+                steps.append((CONST_PATH_WILDCARD, None))
+            elif re.fullmatch(r'-?\d+', selector):
+                steps.append((CONST_PATH_INDEX, int(selector)))
+            elif filter_match := CONST_PATH_FILTER_PATTERN.fullmatch(selector):
+                steps.append((CONST_PATH_FILTER, (filter_match[1], filter_match[2] if filter_match[2] is not None else filter_match[3])))
+            else:
+                raise ValueError(f'Attribute path selector "[{selector}]" is not valid')
+        parsed_segments.append((segment, tuple(steps)))
+    return parsed_segments
 
-        # Define the metric name to add based on groupBy attribute value and customName attribute
-        # It captilize the attribute value if defined on configuration
-        if not custom_name:
-            metric_to_add = metric_name
-        elif capitalize:
-            metric_to_add = f'{metric_name}-{str(attribute_value).capitalize()}'
+def get_path_value(item: Any, steps: Iterable[PathStep]) -> Any:
+    """
+    Get the value of an attribute path. A filter selects its first match.
+    :param item: Object to get the value from
+    :param steps: Path steps, without wildcards
+    :return: Attribute value or CONST_MISSING if any step doesn't exist
+    """
+    for step_type, argument in steps:
+        if step_type == CONST_PATH_KEY:
+            if not isinstance(item, dict) or argument not in item:
+                return CONST_MISSING
+            item = item[argument]
+        elif step_type == CONST_PATH_INDEX:
+            if not isinstance(item, list) or not -len(item) <= argument < len(item):
+                return CONST_MISSING
+            item = item[argument]
         else:
-            metric_to_add = f'{metric_name}-{attribute_value}'
-        #if (metric_to_add := f'{metric_name}-{str(attribute_value).capitalize()}' if capitalize else f'{metric_name}-{attribute_value}') not in metric_count:
-        if metric_to_add not in metric_count:
-            metric_count[metric_to_add] = 0
-        metric_count[metric_to_add] += 1
-
-    return metric_count
+            if not isinstance(item, list):
+                return CONST_MISSING
+            key, value = argument
+            if (item := next((child for child in item if isinstance(child, dict) and child.get(key) == value), CONST_MISSING)) is CONST_MISSING:
+                return CONST_MISSING
+    return item
+
+@functools.lru_cache(maxsize=None)
+def compile_value_path(path: tuple[str, ...] | str) -> Callable[[Any], Any]:
+    """
+    Compile an attribute path into a function that gets a single value, like groupBy and ifExists elements.
+    :param path: Tuple of path segments or a single string with segments joined by "."
+    :return: Function to get the attribute value, or CONST_MISSING if it doesn't exist
+    :raise ValueError: If path is not valid or has a wildcard, as it selects several values
+    """
+    steps: tuple[PathStep, ...] = tuple(step for _, segment_steps in parse_path(path) for step in segment_steps)
+    if any(step_type == CONST_PATH_WILDCARD for step_type, _ in steps):
+        raise ValueError(f'Attribute path "{path}" must select a single value, wildcard is not supported')
+    return functools.partial(get_path_value, steps=steps)
 
-def get_metric_count_from_if_exists(resources: list[Any], config_service: ResourceConfiguration) -> MetricCount:
+@functools.lru_cache(maxsize=None)
+def compile_iterate_over(path: tuple[str, ...] | str, must_exists: bool) -> Callable[[Any], Iterator[Any]]:
     """
-    Group resources by dictionary attribute.
-    :param resources: List of resources
-    :param config_service: Dictionary of service config
-    :return: Dictionary of metric count for resources grouped by attribute
-    """
-    metric_name: str = config_service['metric']['metricName']
-    element: str = config_service['count']['ifExists']['element']
-    exists_suffix: str = config_service['count']['ifExists']['existsSuffix']
-    not_exists_suffix: str = config_service['count']['ifExists']['notExistsSuffix']
-
-
-    metric_count: MetricCount = {}
-    metric_to_add: str = ''
-    for resource in resources:
-        # Define the metric name to add based on ifExists attribute value
-        # If the attribute exists, add the metric name with the suffix from "existsSuffix" attribute
-        # If the attribute does not exists, add the metric name with the suffix from "notExistsSuffix" attribute
-        if element in resource:
-            if resource[element]:
-                logging.info('Attribute "%s" exists in resource, will use suffix "%s"', element, exists_suffix)
-                metric_to_add = f'{metric_name}-{exists_suffix}'
+    Compile an iterateOver path into a function that iterates over all resources of a response.
+    Each segment selects a list to iterate over, or the matches of its last filter or wildcard selector.
+    Segments are chained lazily, so resources are yielded without recursion.
+    :param path: Tuple of path segments or a single string with segments joined by "."
+    :param must_exists: Bool to indicate if iterateOver attributes must exists or not
+    :return: Function to get a generator of resources from a response
+    :raise ValueError: If path is not valid
+    """
+    selectors: list[Callable[[Any], Iterable[Any]]] = [
+        get_path_selector(segment, steps, must_exists) for segment, steps in parse_path(path)
+    ]
+
+    def iterate_over(response: Any) -> Iterator[Any]:
+        items: Iterable[Any] = (response,)
+        for selector in selectors:
+            items = itertools.chain.from_iterable(map(selector, items))
+        return iter(items)
+    return iterate_over
+
+def get_path_selector(segment: str, steps: tuple[PathStep, ...], must_exists: bool) -> Callable[[Any], Iterable[Any]]:
+    """
+    Get the function that selects the items of one iterateOver segment.
+    :param segment: Segment text, used on log messages
+    :param steps: Segment steps
+    :param must_exists: Bool to indicate if segment attribute must exists or not
+    :return: Function to get the iterable of items from an object
+    :raise ValueError: If wildcard is not the last selector of the segment
+    """
+    last_type, last_argument = steps[-1]
+    if last_type in (CONST_PATH_FILTER, CONST_PATH_WILDCARD):
+        steps = steps[:-1]
+    if any(step_type == CONST_PATH_WILDCARD for step_type, _ in steps):
+        raise ValueError(f'Attribute path segment "{segment}" supports wildcard only as the last selector')
+
+    def select(item: Any) -> Iterable[Any]:
+        if (value := get_path_value(item, steps)) is CONST_MISSING:
+            if must_exists:
+                logging.error('Attribute %s not found. It must exists.', segment)
             else:
-                logging.info('Attribute "%s" exists in resource, but it is empty, will use suffix "%s"', element, not_exists_suffix)
-                metric_to_add = f'{metric_name}-{not_exists_suffix}'
-        else:
-            logging.info('Attribute "%s" does not exist in resource, will use suffix "%s"', element, not_exists_suffix)
-            metric_to_add = f'{metric_name}-{not_exists_suffix}'
+                logging.warning('Attribute %s not found. It is optional.', segment)
+            return ()
+        if last_type == CONST_PATH_FILTER:
+            key, expected = last_argument
+            return [child for child in value if isinstance(child, dict) and child.get(key) == expected] if isinstance(value, list) else ()
+        if last_type == CONST_PATH_WILDCARD:
+            return value.values() if isinstance(value, dict) else value if isinstance(value, list) else ()
+        if last_type == CONST_PATH_INDEX:
+            return (value,)
+        return value
+    return select
 
-        if metric_to_add not in metric_count:
-            metric_count[metric_to_add] = 0
-        metric_count[metric_to_add] += 1
-    return metric_count
 
-def get_groupby_attribute_value(dict_object: Any, group_by: list[str]) -> Any:
+#======================================================================================================================
+# Functions to count resources, grouped by dictionary attribute
+#======================================================================================================================
+
+def get_metric_count(resources: Iterable[Any], config_service: ResourceConfiguration, dimensions: Dimensions = (), timestamp: datetime | None = None, stats: 'ResourceStats | None' = None, get_weight: Callable[[Any], Any] | None = None) -> Metric:
     """
-    Recursive function to get the value of dictionary attribute.
-    :param dict_object: Dictionary to iterate over 
-    :param group_by: List of attributes to iterate over
-    :return: Any
+    Count metric resources by the attributes defined on configuration.
+    Total, groupBy and ifExists counters are updated in a single pass over resources, so it can be used with a generator.
+    A resource counts as one, unless it has a weight, like aggregated results that represent several resources.
+    :param resources: Iterable of resources
+    :param config_service: Dictionary of service config
+    :param dimensions: Additional dimensions for all metrics, like region
+    :param timestamp: Timestamp for all metrics, usually the run timestamp. Current time is used if not informed
+    :param stats: Statistics to count items, if informed
+    :param get_weight: Function to get the number of resources each one represents. If not informed, "weight" from configuration is used
+    :return: Dictionary of metric count for resources grouped by attribute, empty if there is no resource
     """
-    logging.info('group_by: %s', group_by)
-    logging.info('Lenght of group_by: %s', len(group_by))
-    logging.info('dict_object: %s', dict_object[group_by[0]])
+    counter = MetricCounter(config_service, get_weight)
+    counter.add(resources)
+    return counter.get_metric_data(dimensions, timestamp, stats)
 
-    item = dict_object[group_by[0]]
-    if len(group_by) > 1:
-        logging.info('Call recursively')
-        return get_groupby_attribute_value(item, group_by[1:])
+def get_resource_weight(weight: Any) -> int:
+    """
+    Get the number of resources represented by one resource.
+    :param weight: Weight attribute value, or CONST_MISSING if it doesn't exist
+    :return: Weight as integer, 1 if it is missing or not a number
+    """
+    if isinstance(weight, int) and not isinstance(weight, bool):
+        return weight
+    try:
+        return int(weight)
+    except (TypeError, ValueError):
+        logging.warning('Weight "%s" is not a number, will count it as 1', weight)
+        return 1
 
-    logging.info('Return value %s', dict_object[group_by[0]])
-    return dict_object[group_by[0]]
+def get_metric_key(metric_name: str, dimensions: Dimensions) -> str:
+    """
+    Get the key of a metric inside its namespace.
+    Metric name is the key when there is no additional dimension, otherwise the dimension values are appended to it.
+    :param metric_name: Metric name
+    :param dimensions: Additional dimensions of the metric
+    :return: Metric key
+    """
+    if not dimensions:
+        return metric_name
+    return '|'.join([metric_name, *(dimension_value for _, dimension_value in dimensions)])
 
-def has_group_by(service_config: ResourceConfiguration) -> bool:
+def get_metric_name_from_group_by(attribute_value: Any, group_by: GroupByElement, metric_name: str, debug: bool = False) -> str | None:
+    """
+    Get the metric name to count a resource grouped by dictionary attribute.
+    Composite groupBy values are a tuple with one value for each element, and the metric name has one suffix for each of them.
+    :param attribute_value: Value of groupBy element from the resource to be counted, or CONST_MISSING if it doesn't exist
+    :param group_by: GroupBy element configuration
+    :param metric_name: Metric name of the count definition
+    :param debug: Bool to indicate if it should log value details, as it is called for each distinct value
+    :return: Metric name to be counted, or None if the resources with this value must be ignored
+    """
+    group_by_values: list[Any] = group_by.get('values', [])
+    capitalize: bool = group_by['capitalize']
+    custom_name: bool = group_by['customName']
+    default: str | None = group_by.get('default')
+
+    # Resources without groupBy element use the default value, or they are not grouped when there is no default
+    if isinstance(attribute_value, tuple):
+        if CONST_MISSING in attribute_value:
+            if default is None:
+                if debug:
+                    logging.debug('Attributes "%s" not found and there is no default value', group_by['elements'])
+                return None
+            attribute_value = tuple(default if value is CONST_MISSING else value for value in attribute_value)
+    elif attribute_value is CONST_MISSING:
+        if (attribute_value := default) is None:
+            if debug:
+                logging.debug('Attribute "%s" not found and there is no default value', group_by['tag'] or group_by['element'])
+            return None
+    if debug:
+        logging.debug('Attribute value: %s', attribute_value)
+
+    # If group by values was defined and the attribute value is not in the group by values, ignore the resource
+    if len(group_by_values) > 0:
+        if attribute_value not in group_by_values:
+            if debug:
+                logging.debug('Attribute value "%s" not in group_by_values "%s"', attribute_value, group_by_values)
+            return None
+
+    # Define the metric name to add based on groupBy attribute value and customName attribute
+    # It captilize the attribute value if defined on configuration
+    if not custom_name:
+        return metric_name
+    values: tuple[Any, ...] = attribute_value if isinstance(attribute_value, tuple) else (attribute_value,)
+    if capitalize:
+        return '-'.join([metric_name, *(str(value).capitalize() for value in values)])
+    return '-'.join([metric_name, *(str(value) for value in values)])
+
+def get_metric_name_from_if_exists(exists: bool, if_exists: IfExistsElement, metric_name: str, debug: bool = False) -> str:
     """
-    Check if service configuration has group_by attribute.
-    :param service_config: Dictionary of service configuration
-    :return: True if service configuration has group_by attribute, otherwise False
+    Get the metric name to count a resource based on dictionary attribute existence.
+    :param exists: Bool to indicate if ifExists element exists on the resources and it is not empty
+    :param if_exists: IfExists element configuration
+    :param metric_name: Metric name of the count definition
+    :param debug: Bool to indicate if it should log details
+    :return: Metric name to be counted
     """
-    if CONST_GROUP_BY in service_config['count']:
-        if CONST_ELEMENT in service_config['count']['groupBy']:
-            if service_config['count']['groupBy']['element']:
-                return True
-    return False
+    # Define the metric name to add based on ifExists attribute value
+    # If the attribute exists, add the metric name with the suffix from "existsSuffix" attribute
+    # If the attribute does not exists, or it is empty, add the metric name with the suffix from "notExistsSuffix" attribute
+    suffix: str = if_exists['existsSuffix'] if exists else if_exists['notExistsSuffix']
+    if debug:
+        logging.debug('Attribute "%s" %s in resources, will use suffix "%s"', if_exists['element'], 'exists' if exists else 'does not exist', suffix)
+    return f'{metric_name}-{suffix}'
+
+def get_group_by_function(group_by: GroupByElement) -> Callable[[Any], Any]:
+    """
+    Get the function that reads the groupBy value of a resource.
+    :param group_by: GroupBy element configuration
+    :return: Function to get the groupBy value, a tuple for composite groupBy, or CONST_MISSING if it doesn't exist
+    """
+    if group_by['tag']:
+        return functools.partial(get_tag_value, get_tags=compile_value_path(get_path_key(group_by['tagsAttribute'])), key=group_by['tag'])
+    if group_by['elements']:
+        getters: list[Callable[[Any], Any]] = [compile_value_path(get_path_key(element)) for element in group_by['elements']]
+        return lambda resource: tuple([getter(resource) for getter in getters])
+    return compile_value_path(get_path_key(group_by['element']))
+
+def get_tag_value(resource: Any, get_tags: Callable[[Any], Any], key: str) -> Any:
+    """
+    Get the value of a tag from a resource.
+    Tags can be a list of "Key" and "Value" pairs, with any case, like EC2 and ECS, or a dictionary, like Lambda.
+    :param resource: Resource to get the tag from
+    :param get_tags: Function to get the tags attribute
+    :param key: Tag key
+    :return: Tag value, or CONST_MISSING if the resource doesn't have the tag
+    """
+    if isinstance(tags := get_tags(resource), dict):
+        return tags.get(key, CONST_MISSING)
+    if isinstance(tags, list):
+        for tag in tags:
+            if isinstance(tag, dict) and tag.get('Key', tag.get('key')) == key:
+                return tag.get('Value', tag.get('value', CONST_MISSING))
+    return CONST_MISSING
+
+def has_group_by(count: CountElement) -> bool:
+    """
+    Check if count definition has groupBy attribute.
+    :param count: Count element configuration
+    :return: True if count definition has groupBy element, elements or tag, otherwise False
+    """
+    group_by: GroupByElement = count['groupBy']
+    return bool(group_by['element'] or group_by['elements'] or group_by['tag'])
 
-def has_if_exists(service_config: ResourceConfiguration) -> bool:
+def has_if_exists(count: CountElement) -> bool:
     """
-    Check if service configuration has ifExists attribute.
-    :param service_config: Dictionary of service configuration
-    :return: True if service configuration has ifExists attribute, otherwise False
+    Check if count definition has ifExists attribute.
+    :param count: Count element configuration
+    :return: True if count definition has ifExists element, otherwise False
     """
-    if CONST_IF_EXISTS in service_config['count']:
-        if CONST_ELEMENT in service_config['count']['ifExists']:
-            if service_config['count']['ifExists']['element']:
-                return True
-    return False
+    return bool(count['ifExists']['element'])
 
 
 #======================================================================================================================
@@ -420,22 +1627,83 @@ def has_if_exists(service_config: ResourceConfiguration) -> bool:
 CONST_SERVICE_TYPE: Final[dict[str, Callable]] = {
     'paginator': list_from_paginator,
     'next-in-response': list_next_in_response,
-    'direct': list_direct
+    'direct': list_direct,
+    'config-query': list_config_query,
+    'resource-explorer': list_from_paginator,
+    'chain': list_chain
+}
+# Service types that can return the number of resources without listing them
+CONST_SERVICE_COUNT: Final[dict[str, Callable[[Any, ResourceConfiguration], int | None]]] = {
+    'resource-explorer': count_resource_explorer
 }
 
-def get_service_configuration() -> list[ResourceConfiguration]:
+def get_service_configuration() -> tuple[SettingsConfiguration, list[ResourceConfiguration]]:
     """
-    Read config file to get service configurations.
-    :return: List of Dictionary of service configurations, just the valid ones
+    Get settings and service configurations from config file.
+    Configuration is kept across warm Lambda invocations and parsed again only when config file changes,
+    checking file modification time and size first, and file content hash when they differ.
+    Returned configuration is shared by all invocations, so it must not be changed.
+    :return: Settings configuration and List of Dictionary of service configurations, just the valid ones
     """
-    valid_config_services : list[ResourceConfiguration] = []
+    global service_configuration_cache  # pylint: disable=global-statement
+    cache: ServiceConfigurationCache | None = service_configuration_cache
+
+    file_name: str = get_service_file_name()
+    file_status = os.stat(file_name)
+    file_stat: tuple[int, int] = (file_status.st_mtime_ns, file_status.st_size)
+    if cache is not None and cache.file_name == file_name and cache.file_stat == file_stat:
+        logging.info('Using cached configuration from file "%s"', file_name)
+        return cache.settings, cache.config_services
+
+    with open(file_name, 'rb') as services_file:
+        content: bytes = services_file.read()
+    file_hash: str = hashlib.sha256(content).hexdigest()
+    if cache is not None and cache.file_name == file_name and cache.file_hash == file_hash:
+        logging.info('Using cached configuration from file "%s", content is unchanged', file_name)
+        service_configuration_cache = cache._replace(file_stat=file_stat)
+        return cache.settings, cache.config_services
+
+    logging.info('Reading file "%s"', file_name)
+    settings, config_services = parse_service_configuration(load_service_file(file_name, content))
+    service_configuration_cache = ServiceConfigurationCache(file_name, file_stat, file_hash, settings, config_services)
+    return settings, config_services
+
+def get_service_file_name() -> str:
+    """
+    Get the config file name. JSON file is used when it exists, otherwise YAML file.
+    :return: Config file name
+    """
+    if not os.path.exists(CONST_SERVICE_FILE) and os.path.exists(CONST_SERVICE_YAML_FILE):
+        return CONST_SERVICE_YAML_FILE
+    return CONST_SERVICE_FILE
 
-    # Read config file to get service configurations
-    logging.info('Reading file "services.json"')
-    with open(CONST_SERVICE_FILE, 'r', encoding='utf-8') as services_file:
-        config_services : dict[str, Any] = json.load(services_file)
+def load_service_file(file_name: str, content: bytes) -> dict[str, Any]:
+    """
+    Load config file content as JSON or YAML, based on file extension.
+    YAML file requires "pyyaml" package, which is not available on Lambda runtime by default.
+    :param file_name: Config file name
+    :param content: Config file content
+    :return: Dictionary of config file content
+    """
+    if file_name.endswith(('.yaml', '.yml')):
+        try:
+            import yaml  # type: ignore  # pylint: disable=import-outside-toplevel
+        except ImportError as error:
+            raise RuntimeError(f'Config file "{file_name}" requires package "pyyaml" packaged with Lambda function') from error
+        return yaml.safe_load(content)
+    return json.loads(content)
+
+def parse_service_configuration(config_services: dict[str, Any]) -> tuple[SettingsConfiguration, list[ResourceConfiguration]]:
+    """
+    Parse and validate config file content to get settings and service configurations.
+    :param config_services: Dictionary of config file content
+    :return: Settings configuration and List of Dictionary of service configurations, just the valid ones
+    """
+    valid_config_services : list[ResourceConfiguration] = []
     logging.info('Found services: %s', config_services)
 
+    settings: SettingsConfiguration = get_settings_configuration(config_services)
+
     for attribute in (CONST_DEFAULT_NAMESPACE, CONST_DEFAULT_DIMENSION_NAME, CONST_RESOURCES):
         if attribute not in config_services:
             logging.error('Attribute "%s" not found. Will ignore this file configuration.', attribute)
@@ -445,35 +1713,16 @@ def get_service_configuration() -> list[ResourceConfiguration]:
         default_dimension_name: str = config_services[CONST_DEFAULT_DIMENSION_NAME]
 
         # Get the list of service name available to be used with boto3
-        valid_service_names: set[str] = set(boto3.Session().get_available_services())
+        service_names: set[str] = get_valid_service_names()
 
         count: int = 0
         for resource in config_services[CONST_RESOURCES]:
             count += 1
 
-            if validate_resource_configuration(resource, valid_service_names):
+            if validate_resource_configuration(resource, service_names):
                 service_type: str = str(resource['type']).lower()
 
-                resource_count_element = CountElement(
-                    generateTotal=True,
-                    groupBy=GroupByElement(element=[], values=[], capitalize=True, customName=True),
-                    ifExists=IfExistsElement(element='', existsSuffix='', notExistsSuffix='')
-                )
-                if CONST_COUNT in resource:
-                    resource_count_element['generateTotal'] = resource[CONST_COUNT].get('generateTotal', True)
-                    if CONST_GROUP_BY in resource[CONST_COUNT]:
-                        resource_count_element['groupBy'] = GroupByElement(
-                            element=resource[CONST_COUNT][CONST_GROUP_BY]['element'],
-                            values=resource[CONST_COUNT][CONST_GROUP_BY].get('values', []),
-                            capitalize=resource[CONST_COUNT][CONST_GROUP_BY].get('capitalize', True),
-                            customName=resource[CONST_COUNT][CONST_GROUP_BY].get('customName', True)
-                        )
-                    if CONST_IF_EXISTS in resource[CONST_COUNT]:
-                        resource_count_element['ifExists'] = IfExistsElement(
-                            element=resource[CONST_COUNT][CONST_IF_EXISTS]['element'],
-                            existsSuffix=resource[CONST_COUNT][CONST_IF_EXISTS]['existsSuffix'],
-                            notExistsSuffix=resource[CONST_COUNT][CONST_IF_EXISTS]['notExistsSuffix']
-                        )
+                counts: list[CountElement] = [get_count_element(count_definition) for count_definition in get_count_definitions(resource)]
 
                 resource_config = ResourceConfiguration(
                     index=count,
@@ -485,9 +1734,19 @@ def get_service_configuration() -> list[ResourceConfiguration]:
                         iterateOver=resource['resource']['iterateOver'],
                         nextInResponse=resource['resource'].get('nextInResponse', ''),
                         nextInRequest=resource['resource'].get('nextInRequest', ''),
-                        mustExists=resource['resource'].get('mustExists', True)
+                        mustExists=resource['resource'].get('mustExists', True),
+                        regions=resource['resource'].get(CONST_REGIONS, settings['regions']),
+                        pageSize=resource['resource'].get(CONST_PAGE_SIZE),
+                        interval=resource['resource'].get(CONST_INTERVAL),
+                        changeMarker=resource['resource'].get(CONST_CHANGE_MARKER, ''),
+                        chain=[get_chain_element(level) for level in resource['resource'].get(CONST_CHAIN, [])] if service_type == CONST_CHAIN else [],
+                        filter=FilterElement(
+                            name=resource['resource'].get(CONST_FILTER, {}).get('name', ''),
+                            argument=resource['resource'].get(CONST_FILTER, {}).get('argument', CONST_DEFAULT_FILTER_ARGUMENT)
+                        )
                     ),
-                    count=resource_count_element,
+                    count=counts[0],
+                    counts=counts,
                     metric=MetricElement(
                         namespace=resource['metric'].get('namespace', default_namespace),
                         dimensionName=resource['metric'].get('dimensionName', default_dimension_name),
@@ -496,7 +1755,220 @@ def get_service_configuration() -> list[ResourceConfiguration]:
                     )
                 )
                 valid_config_services.append(resource_config)
-    return valid_config_services
+    return settings, valid_config_services
+
+def get_chain_element(level: dict[str, Any]) -> ChainElement:
+    """
+    Get the configuration of one chain level, with default values for missing attributes.
+    :param level: Dictionary of chain level, already validated
+    :return: Chain level configuration
+    """
+    return ChainElement(
+        method=level['method'],
+        argument=level['argument'],
+        kwargs=level.get('kwargs', {}),
+        iterateOver=level.get('iterateOver', []),
+        idPath=level.get('idPath', []),
+        batchSize=level.get('batchSize'),
+        concurrency=level.get('concurrency', CONST_DEFAULT_CHAIN_CONCURRENCY),
+        inheritArguments=level.get('inheritArguments', []),
+        ignoreErrors=level.get('ignoreErrors', [])
+    )
+
+def get_count_definitions(resource: dict[str, Any]) -> list[Any]:
+    """
+    Get the count definitions of a resource configuration, as "count" can be a single definition or a list of them.
+    :param resource: Dictionary of service configuration
+    :return: List of count definitions, with an empty one if "count" is not defined
+    """
+    count_definitions: Any = resource.get(CONST_COUNT, {})
+    return count_definitions if isinstance(count_definitions, list) else [count_definitions]
+
+def get_count_element(count_definition: dict[str, Any]) -> CountElement:
+    """
+    Get the count element of one count definition, with default values for missing attributes.
+    Composite groupBy values are converted to tuples, to compare them with resource values.
+    :param count_definition: Dictionary of count definition, already validated
+    :return: Count element configuration
+    """
+    count_element = CountElement(
+        metricName=count_definition.get('metricName', ''),
+        generateTotal=count_definition.get('generateTotal', True),
+        groupBy=GroupByElement(element=[], elements=[], tag='', tagsAttribute=CONST_DEFAULT_TAGS_ATTRIBUTE, values=[], maxValues=None, otherValue=CONST_DEFAULT_OTHER_VALUE, capitalize=True, customName=True, default=None),
+        ifExists=IfExistsElement(element='', existsSuffix='', notExistsSuffix=''),
+        weight=count_definition.get('weight', '')
+    )
+    if CONST_GROUP_BY in count_definition:
+        group_by: dict[str, Any] = count_definition[CONST_GROUP_BY]
+        count_element['groupBy'] = GroupByElement(
+            element=group_by.get(CONST_ELEMENT, []),
+            elements=group_by.get(CONST_ELEMENTS, []),
+            tag=group_by.get(CONST_TAG, ''),
+            tagsAttribute=group_by.get('tagsAttribute', CONST_DEFAULT_TAGS_ATTRIBUTE),
+            values=[tuple(value) for value in group_by.get('values', [])] if group_by.get(CONST_ELEMENTS) else group_by.get('values', []),
+            maxValues=group_by.get('maxValues'),
+            otherValue=group_by.get('otherValue', CONST_DEFAULT_OTHER_VALUE),
+            capitalize=group_by.get('capitalize', True),
+            customName=group_by.get('customName', True),
+            default=group_by.get('default')
+        )
+    if CONST_IF_EXISTS in count_definition:
+        count_element['ifExists'] = IfExistsElement(
+            element=count_definition[CONST_IF_EXISTS]['element'],
+            existsSuffix=count_definition[CONST_IF_EXISTS]['existsSuffix'],
+            notExistsSuffix=count_definition[CONST_IF_EXISTS]['notExistsSuffix']
+        )
+    return count_element
+
+def get_positive_int(element: dict[str, Any], attribute: str, default: int) -> int:
+    """
+    Get a positive integer attribute from a configuration element.
+    :param element: Dictionary of configuration element
+    :param attribute: Attribute name
+    :param default: Value to be used if the attribute is missing or invalid
+    :return: Attribute value or default value
+    """
+    value = element.get(attribute, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        logging.error('Attribute "%s" must be a positive integer, found "%s". Will use default value "%s".', attribute, value, default)
+        return default
+    return value
+
+def is_list_of_str(value: Any) -> bool:
+    """
+    Check if a configuration value is a list of strings.
+    :param value: Configuration value
+    :return: True if it is a list of strings, otherwise False
+    """
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+def get_settings_configuration(config_services: dict[str, Any]) -> SettingsConfiguration:
+    """
+    Get global settings from config file, using default values for the missing ones.
+    :param config_services: Dictionary of config file content
+    :return: Settings configuration
+    """
+    concurrency: dict[str, Any] = config_services.get(CONST_CONCURRENCY, {})
+    max_per_client: int = get_positive_int(concurrency, 'maxPerClient', CONST_DEFAULT_MAX_PER_CLIENT)
+
+    # Empty list of regions means the Lambda function region only
+    if not is_list_of_str(regions := config_services.get(CONST_REGIONS, [])):
+        logging.error('Attribute "%s" must be a list of region names, found "%s". Will use Lambda function region only.', CONST_REGIONS, regions)
+        regions = []
+
+    accounts: dict[str, Any] = config_services.get(CONST_ACCOUNTS, {})
+    for attribute in ('ids', 'excludeIds'):
+        if not is_list_of_str(accounts.get(attribute, [])):
+            logging.error('Attribute "%s" must be a list of account ids, found "%s". Will ignore it.', attribute, accounts[attribute])
+            accounts = {**accounts, attribute: []}
+    if (accounts.get('ids') or accounts.get('organization')) and not accounts.get('roleName'):
+        logging.error('Attribute "roleName" not found. It is mandatory to assume role on accounts. Will use Lambda function account only.')
+        accounts = {}
+
+    rate_limits: dict[str, RateLimitElement] = {}
+    for service_name, rate_limit in config_services.get(CONST_RATE_LIMITS, {}).items():
+        rate_limits[service_name] = RateLimitElement(
+            rate=get_positive_int(rate_limit, 'rate', CONST_DEFAULT_RATE),
+            burst=get_positive_int(rate_limit, 'burst', CONST_DEFAULT_BURST)
+        )
+    if CONST_DEFAULT not in rate_limits:
+        rate_limits[CONST_DEFAULT] = RateLimitElement(rate=CONST_DEFAULT_RATE, burst=CONST_DEFAULT_BURST)
+
+    # Services without connection settings use the "default" ones, which use the default values for their missing attributes
+    connection_settings: dict[str, Any] = config_services.get(CONST_CONNECTIONS, {})
+    default_connection: dict[str, Any] = connection_settings.get(CONST_DEFAULT, {})
+    connections: dict[str, ConnectionElement] = {}
+    for service_name in {CONST_DEFAULT, *connection_settings}:
+        connection: dict[str, Any] = {**default_connection, **connection_settings.get(service_name, {})}
+        connections[service_name] = ConnectionElement(
+            maxPoolConnections=get_positive_int(connection, 'maxPoolConnections', CONST_DEFAULT_MAX_POOL_CONNECTIONS),
+            tcpKeepalive=connection.get('tcpKeepalive', True),
+            connectTimeout=get_positive_int(connection, 'connectTimeout', CONST_DEFAULT_CONNECT_TIMEOUT),
+            readTimeout=get_positive_int(connection, 'readTimeout', CONST_DEFAULT_READ_TIMEOUT)
+        )
+
+    retry: dict[str, Any] = config_services.get(CONST_RETRY, {})
+    if (retry_mode := retry.get('mode', CONST_DEFAULT_RETRY_MODE)) not in CONST_RETRY_MODES:
+        logging.error('Retry mode "%s" not valid, expecting one of "%s". Will use default value "%s".', retry_mode, CONST_RETRY_MODES, CONST_DEFAULT_RETRY_MODE)
+        retry_mode = CONST_DEFAULT_RETRY_MODE
+
+    publisher: dict[str, Any] = config_services.get(CONST_PUBLISHER, {})
+
+    state: dict[str, Any] = config_services.get(CONST_STATE, {})
+    if not isinstance(location := state.get('location', ''), str):
+        logging.error('Attribute "location" must be a file path or S3 URL, found "%s". Will not persist state.', location)
+        location = ''
+
+    self_monitoring: dict[str, Any] = config_services.get(CONST_SELF_MONITORING, {})
+
+    # Zero maxSeconds means the time budget is only limited by the Lambda function timeout
+    scheduler: dict[str, Any] = config_services.get(CONST_SCHEDULER, {})
+    max_seconds: int = get_positive_int(scheduler, 'maxSeconds', 0) if 'maxSeconds' in scheduler else 0
+
+    # Sink can be just the sink type, or a dictionary with the type and its options
+    sinks: list[SinkElement] = []
+    for sink in config_services.get(CONST_SINKS, [CONST_SINK_CLOUDWATCH]):
+        sink_options: dict[str, Any] = dict(sink) if isinstance(sink, dict) else {'type': sink}
+        if (sink_type := sink_options.pop('type', None)) not in CONST_SINK_TYPE:
+            logging.error('Sink "%s" not valid, expecting one of "%s". Will ignore it.', sink_type, sorted(CONST_SINK_TYPE.keys()))
+        elif sink_type == CONST_SINK_PROMETHEUS and 'url' not in sink_options:
+            logging.error('Attribute "url" not found. It is mandatory for sink "%s". Will ignore it.', sink_type)
+        elif sink_type == CONST_SINK_STATSD and 'host' not in sink_options:
+            logging.error('Attribute "host" not found. It is mandatory for sink "%s". Will ignore it.', sink_type)
+        elif sink_type == CONST_SINK_FILE and sink_options.get('format', CONST_FILE_FORMATS[0]) not in CONST_FILE_FORMATS:
+            logging.error('File format "%s" not valid, expecting one of "%s". Will ignore it.', sink_options['format'], CONST_FILE_FORMATS)
+        else:
+            sinks.append(SinkElement(type=sink_type, options=sink_options))
+
+    return SettingsConfiguration(
+        concurrency=ConcurrencyElement(
+            maxWorkers=get_positive_int(concurrency, 'maxWorkers', CONST_DEFAULT_MAX_WORKERS),
+            maxPerClient=max_per_client,
+            clients={
+                service_name: get_positive_int(concurrency.get('clients', {}), service_name, max_per_client)
+                for service_name in concurrency.get('clients', {})
+            }
+        ),
+        regions=regions,
+        regionDimensionName=config_services.get(CONST_REGION_DIMENSION_NAME, CONST_DEFAULT_REGION_DIMENSION_NAME),
+        accounts=AccountsElement(
+            ids=accounts.get('ids', []),
+            organization=accounts.get('organization', False),
+            excludeIds=accounts.get('excludeIds', []),
+            roleName=accounts.get('roleName', ''),
+            externalId=accounts.get('externalId', ''),
+            sessionName=accounts.get('sessionName', CONST_DEFAULT_ROLE_SESSION_NAME),
+            dimensionName=accounts.get('dimensionName', CONST_DEFAULT_ACCOUNT_DIMENSION_NAME)
+        ),
+        rateLimits=rate_limits,
+        connections=connections,
+        retry=RetryElement(
+            mode=retry_mode,
+            maxAttempts=get_positive_int(retry, 'maxAttempts', CONST_DEFAULT_MAX_ATTEMPTS),
+            resourceAttempts=get_positive_int(retry, 'resourceAttempts', CONST_DEFAULT_RESOURCE_ATTEMPTS)
+        ),
+        publisher=PublisherElement(
+            maxWorkers=get_positive_int(publisher, 'maxWorkers', CONST_DEFAULT_PUBLISHER_MAX_WORKERS),
+            maxAttempts=get_positive_int(publisher, 'maxAttempts', CONST_DEFAULT_PUBLISHER_MAX_ATTEMPTS),
+            streaming=publisher.get('streaming', False)
+        ),
+        sinks=sinks,
+        state=StateElement(
+            location=location,
+            endpointUrl=state.get('endpointUrl', ''),
+            heartbeatSeconds=get_positive_int(state, 'heartbeatSeconds', CONST_DEFAULT_HEARTBEAT_SECONDS),
+            deltaPublish=state.get('deltaPublish', True)
+        ),
+        scheduler=SchedulerElement(
+            reserveSeconds=get_positive_int(scheduler, 'reserveSeconds', CONST_DEFAULT_RESERVE_SECONDS),
+            maxSeconds=max_seconds
+        ),
+        selfMonitoring=SelfMonitoringElement(
+            metrics=self_monitoring.get('metrics', False),
+            namespace=self_monitoring.get('namespace', CONST_DEFAULT_SELF_NAMESPACE),
+            report=self_monitoring.get('report', False)
+        )
+    )
 
 def validate_resource_configuration(resource: Any, valid_service_names: set[str]) -> bool:
     """
@@ -524,12 +1996,81 @@ def validate_resource_configuration(resource: Any, valid_service_names: set[str]
     if (service_name := resource['resource']['client']) not in valid_service_names:
         logging.error('Invalid service name "%s". Will ignore this service configuration.', service_name)
         return False
+    # Check if regions, when defined, is a list of region names
+    if CONST_REGIONS in resource['resource'] and not is_list_of_str(resource['resource'][CONST_REGIONS]):
+        logging.error('Attribute "%s" must be a list of region names. Will ignore this service configuration.', CONST_REGIONS)
+        return False
     if service_type == CONST_NEXT_IN_RESPONSE:
         for attribute in ('nextInResponse', 'nextInRequest'):
             if attribute not in resource['resource']:
                 logging.error('Attribute "%s" not found. It is mandatory as type is configured as "next-in-response". Will ignore this service configuration.', attribute)
                 return False
 
+    # Check if count definitions have all required attributes
+    if not (count_definitions := get_count_definitions(resource)) or not all(isinstance(count_definition, dict) for count_definition in count_definitions):
+        logging.error('Attribute "%s" must be a count definition or a non-empty list of them. Will ignore this service configuration.', CONST_COUNT)
+        return False
+    for count_definition in count_definitions:
+        if CONST_GROUP_BY in count_definition:
+            group_by: Any = count_definition[CONST_GROUP_BY]
+            if not isinstance(group_by, dict) or not any(group_by.get(attribute) for attribute in (CONST_ELEMENT, CONST_ELEMENTS, CONST_TAG)):
+                logging.error('Attribute "%s" requires "%s", "%s" or "%s". Will ignore this service configuration.', CONST_GROUP_BY, CONST_ELEMENT, CONST_ELEMENTS, CONST_TAG)
+                return False
+            if CONST_TAG in group_by and not isinstance(group_by[CONST_TAG], str):
+                logging.error('Attribute "%s" must be a tag key. Will ignore this service configuration.', CONST_TAG)
+                return False
+            if 'maxValues' in group_by and (isinstance(value := group_by['maxValues'], bool) or not isinstance(value, int) or value < 1):
+                logging.error('Attribute "maxValues" must be a positive integer, found "%s". Will ignore this service configuration.', value)
+                return False
+            if CONST_ELEMENTS in group_by:
+                if not isinstance(elements := group_by[CONST_ELEMENTS], list) \
+                    or not all(isinstance(value, list) and len(value) == len(elements) for value in group_by.get('values', [])):
+                    logging.error('Attribute "%s" must be a list of elements, and each groupBy value a list with one value for each element. Will ignore this service configuration.', CONST_ELEMENTS)
+                    return False
+        if CONST_IF_EXISTS in count_definition:
+            for attribute in (CONST_ELEMENT, 'existsSuffix', 'notExistsSuffix'):
+                if not isinstance(count_definition[CONST_IF_EXISTS], dict) or attribute not in count_definition[CONST_IF_EXISTS]:
+                    logging.error('Attribute "%s" not found on "%s". Will ignore this service configuration.', attribute, CONST_IF_EXISTS)
+                    return False
+
+    # Check if attribute paths are valid, so they are compiled just once while counting resources
+    try:
+        compile_iterate_over(get_path_key(resource['resource']['iterateOver']), resource['resource'].get('mustExists', True))
+        for count_definition in count_definitions:
+            group_by = count_definition.get(CONST_GROUP_BY, {})
+            for path in (group_by.get(CONST_ELEMENT), group_by.get('tagsAttribute'), *group_by.get(CONST_ELEMENTS, []),
+                         count_definition.get(CONST_IF_EXISTS, {}).get(CONST_ELEMENT), count_definition.get('weight')):
+                if path:
+                    compile_value_path(get_path_key(path))
+        if path := resource['resource'].get(CONST_CHANGE_MARKER):
+            compile_value_path(get_path_key(path))
+    except (TypeError, ValueError) as error:
+        logging.error('Invalid attribute path: %s. Will ignore this service configuration.', error)
+        return False
+
+    # Check if page size and interval, when defined, are positive integers
+    for attribute in (CONST_PAGE_SIZE, CONST_INTERVAL):
+        if attribute in resource['resource']:
+            if isinstance(value := resource['resource'][attribute], bool) or not isinstance(value, int) or value < 1:
+                logging.error('Attribute "%s" must be a positive integer, found "%s". Will ignore this service configuration.', attribute, value)
+                return False
+    # Page size is only used by methods that have a page size argument
+    if CONST_PAGE_SIZE in resource['resource'] and has_page_size_argument(service_name, resource['resource']['method']) is False:
+        logging.error('Method "%s" doesn\'t have a page size argument, so attribute "%s" can\'t be used. Will ignore this service configuration.', resource['resource']['method'], CONST_PAGE_SIZE)
+        return False
+
+    if service_type == CONST_CHAIN and not validate_chain_configuration(resource['resource'].get(CONST_CHAIN)):
+        return False
+
+    # Check if filter has a name and groupBy values, as each value is queried with the filter
+    if CONST_FILTER in resource['resource']:
+        if not isinstance(resource['resource'][CONST_FILTER], dict) or not resource['resource'][CONST_FILTER].get('name'):
+            logging.error('Attribute "name" not found on "%s". Will ignore this service configuration.', CONST_FILTER)
+            return False
+        if not (group_by := count_definitions[0].get(CONST_GROUP_BY, {})).get('values') or not group_by.get(CONST_ELEMENT):
+            logging.error('Attribute "%s" requires groupBy "element" and "values" on the first count definition to filter. Will ignore this service configuration.', CONST_FILTER)
+            return False
+
     # Check if "metric" element has all required attributes
     for attribute in ('dimensionValue', 'metricName'):
         if attribute not in resource['metric']:
@@ -538,29 +2079,220 @@ def validate_resource_configuration(resource: Any, valid_service_names: set[str]
 
     return True
 
-def instantiate_boto3_client_for_service(config_services: list[ResourceConfiguration]) -> Boto3Clients:
+def validate_chain_configuration(chain: Any) -> bool:
     """
-    Instantiate boto3 client for each service configuration.
-    :param config_services: Dictionary of service configurations
-    :return: Dictionary of boto3 clients
+    Validate the levels of a chain resource.
+    :param chain: List of chain levels from configuration
+    :return: Boolean to indicate if it is valid or not
     """
-    clients: Boto3Clients = {}
+    if not isinstance(chain, list) or not chain or not all(isinstance(level, dict) for level in chain):
+        logging.error('Attribute "%s" must be a non-empty list of levels, as type is configured as "chain". Will ignore this service configuration.', CONST_CHAIN)
+        return False
+    for level in chain:
+        for attribute in ('method', 'argument'):
+            if not isinstance(level.get(attribute), str) or not level[attribute]:
+                logging.error('Attribute "%s" not found on "%s" level. Will ignore this service configuration.', attribute, CONST_CHAIN)
+                return False
+        for attribute in ('batchSize', 'concurrency'):
+            if attribute in level and (isinstance(value := level[attribute], bool) or not isinstance(value, int) or value < 1):
+                logging.error('Attribute "%s" must be a positive integer, found "%s". Will ignore this service configuration.', attribute, value)
+                return False
+        for attribute in ('inheritArguments', 'ignoreErrors'):
+            if attribute in level and not is_list_of_str(level[attribute]):
+                logging.error('Attribute "%s" must be a list of strings. Will ignore this service configuration.', attribute)
+                return False
+        if not isinstance(level.get('kwargs', {}), dict):
+            logging.error('Attribute "kwargs" of "%s" level must be a dictionary. Will ignore this service configuration.', CONST_CHAIN)
+            return False
+        try:
+            if level.get('iterateOver'):
+                compile_iterate_over(get_path_key(level['iterateOver']), True)
+            if level.get('idPath'):
+                compile_value_path(get_path_key(level['idPath']))
+        except (TypeError, ValueError) as error:
+            logging.error('Invalid attribute path on "%s" level: %s. Will ignore this service configuration.', CONST_CHAIN, error)
+            return False
+    return True
 
-    # Instantiate boto3 client for each service configuration.
-    # The client attribute, which is the service name, must be a valid one for boto3,
-    # otherwise it will raise an exception.
-    # The valid ones are defined on variable "valid_service_names".
-    for resource in config_services:
-        if (service_name := resource['resource']['client']) not in clients:
-            logging.info('Creating client for service: %s', service_name)
-            clients[service_name] = boto3.client(service_name)
-    logging.debug('Clients: %s', clients)
-    return clients
+def get_valid_service_names() -> set[str]:
+    """
+    Get the list of service name available to be used with boto3.
+    It loads botocore data directory, so it is done once and kept across warm Lambda invocations.
+    :return: Set of valid service names
+    """
+    global valid_service_names  # pylint: disable=global-statement
+    if valid_service_names is None:
+        valid_service_names = set(boto3.Session().get_available_services())
+    return valid_service_names
 
-def initialize_metrics_by_namespace(config_services: list[ResourceConfiguration]) -> Namespace:
+def get_cloudwatch_client() -> Any:
+    """
+    Get CloudWatch client, creating it on first use.
+    PutMetricData supports gzip request body, which boto3 applies for payloads bigger than the minimum size.
+    :return: boto3 CloudWatch client
+    """
+    global cloudwatch_client  # pylint: disable=global-statement
+    with cloudwatch_client_lock:
+        if cloudwatch_client is None:
+            cloudwatch_client = boto3.client('cloudwatch', config=Config(request_min_compression_size_bytes=CONST_COMPRESSION_MIN_SIZE_BYTES, disable_request_compression=False))
+    return cloudwatch_client
+
+def create_boto3_client(session: Any, service_name: str, region: str, account_id: str, settings: SettingsConfiguration) -> Any:
+    """
+    Create boto3 client for the service and region from the account session.
+    Each client has its own rate limiter, as API limits are applied by account and region.
+    The client attribute, which is the service name, must be a valid one for boto3, otherwise it will raise an exception.
+    :param session: boto3 session of the account
+    :param service_name: boto3 service name
+    :param region: Region name, empty for the Lambda function region
+    :param account_id: Account id, empty for the Lambda function account
+    :param settings: Settings configuration
+    :return: boto3 client
+    """
+    logging.info('Creating client for service: %s, region: %s, account: %s', service_name, region or 'default', account_id or 'default')
+    connection: ConnectionElement = settings['connections'].get(service_name, settings['connections'][CONST_DEFAULT])
+    config = Config(
+        retries={'mode': settings['retry']['mode'], 'max_attempts': settings['retry']['maxAttempts']},
+        max_pool_connections=connection['maxPoolConnections'],
+        tcp_keepalive=connection['tcpKeepalive'],
+        connect_timeout=connection['connectTimeout'],
+        read_timeout=connection['readTimeout']
+    )
+    client = session.client(service_name, region_name=region or None, config=config)
+
+    rate_limit: RateLimitElement = settings['rateLimits'].get(service_name, settings['rateLimits'][CONST_DEFAULT])
+    token_bucket = TokenBucket(rate_limit['rate'], rate_limit['burst'])
+    client.meta.events.register('before-send', token_bucket.acquire)
+    client.meta.events.register('needs-retry', token_bucket.on_response)
+    client.meta.events.register('after-call', count_api_call)
+    return client
+
+def get_client_settings_key(service_name: str, settings: SettingsConfiguration) -> str:
+    """
+    Get the key of the settings used to create a client, so a client from a previous invocation is only reused if they didn't change.
+    :param service_name: boto3 service name
+    :param settings: Settings configuration
+    :return: Client settings key
     """
-    Initialize metrics_by_namespace dictionary.
+    return json.dumps([
+        settings['retry']['mode'], settings['retry']['maxAttempts'],
+        settings['rateLimits'].get(service_name, settings['rateLimits'][CONST_DEFAULT]),
+        settings['connections'].get(service_name, settings['connections'][CONST_DEFAULT])
+    ], sort_keys=True)
+
+def get_http_counters(client: Any) -> tuple[int, int]:
+    """
+    Get the number of HTTP requests and new connections of a client, from its urllib3 connection pools.
+    botocore doesn't expose its connection pools, so they are read from its HTTP session, and counters are zero if it is not available.
+    :param client: boto3 client
+    :return: Number of requests and number of connections opened
+    """
+    try:
+        http_session: Any = client._endpoint.http_session  # pylint: disable=protected-access
+        managers: list[Any] = [http_session._manager, *http_session._proxy_managers.values()]  # pylint: disable=protected-access
+        pools: list[Any] = [pool for manager in managers for key in manager.pools.keys() if (pool := manager.pools.get(key)) is not None]
+    except AttributeError:
+        return 0, 0
+    return sum(getattr(pool, 'num_requests', 0) for pool in pools), sum(getattr(pool, 'num_connections', 0) for pool in pools)
+
+def count_api_call(http_response: Any, parsed: dict[str, Any], **_) -> None:
+    """
+    Count an API call on the statistics of the resource collected by the current thread, if any.
+    It is called by botocore after each call, with the response of its last attempt.
+    :param http_response: botocore HTTP response
+    :param parsed: Parsed response
+    """
+    if (stats := getattr(collection_context, 'stats', None)) is not None:
+        stats.add_api_call(parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0), len(http_response.content or b'') if http_response is not None else 0)
+
+def get_account_ids(accounts: AccountsElement, clients: 'ClientPool') -> list[str]:
+    """
+    Get the list of account ids to collect resources from.
+    If active accounts can't be listed from AWS Organizations, only the configured account ids are used.
+    :param accounts: Accounts configuration
+    :param clients: Pool of boto3 clients, to get AWS Organizations client with retry and rate limit settings
+    :return: List of account ids, empty to use the Lambda function account only
+    """
+    account_ids: list[str] = list(accounts['ids'])
+
+    # Get the active accounts from AWS Organizations, it requires permission on management or delegated administrator account
+    if accounts['organization']:
+        try:
+            account_ids.extend(get_organization_account_ids(clients))
+        except Exception as error:
+            logging.error('Unable to list accounts from AWS Organizations, will use only configured account ids: %s', error)
+
+    return [account_id for account_id in dict.fromkeys(account_ids) if account_id not in accounts['excludeIds']]
+
+def get_organization_account_ids(clients: 'ClientPool') -> list[str]:
+    """
+    Get the active account ids from AWS Organizations.
+    They are cached and reused across warm Lambda invocations for CONST_ORGANIZATION_ACCOUNTS_SECONDS.
+    :param clients: Pool of boto3 clients
+    :return: List of active account ids
+    """
+    global organization_accounts  # pylint: disable=global-statement
+    if organization_accounts is not None and organization_accounts.expiration > time.monotonic():
+        logging.info('Reusing cached accounts from AWS Organizations: %s accounts', len(organization_accounts.account_ids))
+        return organization_accounts.account_ids
+
+    account_ids: list[str] = []
+    paginator = clients[('organizations', '', '')].get_paginator('list_accounts')
+    for page in paginator.paginate():
+        account_ids.extend(account['Id'] for account in page['Accounts'] if account.get('Status') == 'ACTIVE')
+    organization_accounts = OrganizationAccounts(account_ids, time.monotonic() + CONST_ORGANIZATION_ACCOUNTS_SECONDS)
+    return account_ids
+
+def get_account_session(sts_client: Any, account_id: str, accounts: AccountsElement) -> Any:
+    """
+    Get a boto3 session for the account, assuming the configured role.
+    Credentials are cached and reused across warm Lambda invocations until they are near expiry.
+    :param sts_client: boto3 STS client
+    :param account_id: Account id
+    :param accounts: Accounts configuration
+    :return: boto3 session of the account
+    """
+    with account_sessions_lock:
+        account_session: AccountSession | None = account_sessions.get(account_id)
+    if account_session and (account_session.expiration - datetime.now(timezone.utc)).total_seconds() > CONST_CREDENTIALS_REFRESH_SECONDS:
+        logging.info('Reusing cached credentials for account: %s', account_id)
+        return account_session.session
+
+    partition: str = sts_client.meta.partition
+    kwargs: dict[str, Any] = {
+        'RoleArn': f'arn:{partition}:iam::{account_id}:role/{accounts["roleName"]}',
+        'RoleSessionName': accounts['sessionName']
+    }
+    if accounts['externalId']:
+        kwargs['ExternalId'] = accounts['externalId']
+
+    logging.info('Assuming role "%s"', kwargs['RoleArn'])
+    credentials: dict[str, Any] = sts_client.assume_role(**kwargs)['Credentials']
+    account_session = AccountSession(
+        session=boto3.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        ),
+        expiration=credentials['Expiration']
+    )
+    with account_sessions_lock:
+        account_sessions[account_id] = account_session
+    return account_session.session
+
+def get_resource_regions(config_service: ResourceConfiguration) -> list[str]:
+    """
+    Get the list of regions to collect a resource from.
+    :param config_service: Service configuration
+    :return: List of region names, where empty string is the Lambda function region
+    """
+    return config_service['resource']['regions'] or ['']
+
+def initialize_metrics_by_namespace(config_services: list[ResourceConfiguration], timestamp: datetime | None = None) -> Namespace:
+    """
+    Initialize metrics_by_namespace dictionary, with a metric store for each namespace.
     :param config_services: List of Dictionary of service configurations
+    :param timestamp: Run timestamp, shared by all metrics. If not informed, the one from the first metric is used
     :return: Dictionary of metrics_by_namespace
     """
     metrics_by_namespace : Namespace = {}
@@ -568,28 +2300,619 @@ def initialize_metrics_by_namespace(config_services: list[ResourceConfiguration]
     for resource in config_services:
         if (namespace := resource['metric']['namespace']) not in metrics_by_namespace:
             logging.info('Initializing namespace: %s', namespace)
-            metrics_by_namespace[namespace] = {}
+            metrics_by_namespace[namespace] = MetricStore(namespace, timestamp)
 
     return metrics_by_namespace
 
-def set_metrics_by_namespace(resources: list[Any], config_service: ResourceConfiguration, metrics_by_namespace: Namespace) -> None:
+def set_metrics_by_namespace(metric_count: Metric, config_service: ResourceConfiguration, metrics_by_namespace: Namespace, add: bool = False) -> None:
     """
     Set metrics_by_namespace dictionary from each resource.
-    :param resources: List of resources
+    :param metric_count: Dictionary of metric count for the resource
     :param config_service: Service configuration
     :param metrics_by_namespace: Dictionary of metrics_by_namespace
+    :param add: Bool to indicate if metric values are added to existing ones, like filtered queries of the same resource
     """
-    if resources:
-        namespace: str = config_service['metric']['namespace']
-        metric_count: dict[str, MetricData] = get_metric_count(resources, config_service)
-        for metric_name, metric_value in metric_count.items():
-            metrics_by_namespace[namespace][metric_name] = metric_value
+    metric_store: MetricStore = metrics_by_namespace[config_service['metric']['namespace']]
+    for metric_key, metric_data in metric_count.items():
+        metric_store.set(metric_key, metric_data, add)
 
-def add_metric_to_cloudwatch(namespace: str, metrics: Metric) -> None:
+def collect_resources(clients: ClientPool, tasks: list[CollectionTask], client_semaphores: dict[ClientKey, threading.BoundedSemaphore], resource_attempts: int, timestamp: datetime, state: State | None = None, deadline: float | None = None, task_stats: list[tuple[CollectionTask, ResourceStats]] | None = None, stop: threading.Event | None = None) -> list[Metric]:
     """
-    Add metric to CloudWatch.
-    :param namespace: Namespace of the metric
-    :param metrics: Dictionary of metrics where key is the metric name
+    Stream the resources of one request, in one region and account, and count them for each service configuration that shares it.
+    Service configurations with the same request share its pages, so resources are listed once and counted by all of them.
+    It runs inside a worker thread, limited by the semaphore of its client.
+    :param clients: Pool of boto3 clients
+    :param tasks: Service configurations with the same request, region and account to collect
+    :param client_semaphores: Dictionary of semaphores by client to limit concurrent calls for each one
+    :param resource_attempts: Maximum number of attempts to collect the resource when it is throttled
+    :param timestamp: Run timestamp, shared by all metrics
+    :param state: State from previous runs, to reuse metrics of unchanged resources and save collection time, if any
+    :param deadline: Time, from time.monotonic, until a resource can be collected, None if there is no time budget
+    :param task_stats: List where statistics of the collected resource are added, if informed
+    :param stop: Event set when time budget ends, so the resource stops before its next page, if informed
+    :return: List of dictionary of metric count for each task, empty if there is no resource
+    :raise ResourceSkipped: If the resource is not expected to finish before deadline, or it doesn't finish
+    """
+    task: CollectionTask = tasks[0]
+    config_service: ResourceConfiguration = task.config_service
+    service_type: str = config_service['type']
+    resource_client: str = config_service['resource']['client']
+    resource_method: str = config_service['resource']['method']
+    # Only tasks that don't share their request have change marker
+    previous: dict[str, Any] = state['resources'].get(task.state_key, {}) if state is not None else {}
+    run_time: float = timestamp.replace(tzinfo=timezone.utc).timestamp()
+    estimated_seconds: float = max(shared_task.estimated_seconds or 0.0 for shared_task in tasks)
+
+    attempt: int = 1
+    while True:
+        try:
+            with client_semaphores[task.client_key]:
+                # Time budget is checked after waiting for the client, just before the first request
+                if deadline is not None and time.monotonic() + estimated_seconds > deadline:
+                    raise ResourceSkipped(f'estimated {estimated_seconds:.1f} seconds, time budget has {deadline - time.monotonic():.1f} seconds left')
+
+                logging.info('Get resources from "%s", "%s", region "%s", account "%s", using type "%s"', resource_client, resource_method, task.region or 'default', task.account or 'default', service_type)
+                if len(tasks) > 1:
+                    logging.info('Pages from "%s", "%s" are shared by %s resource configurations', resource_client, resource_method, len(tasks))
+                # Statistics are from the last attempt, as a retry reads all pages again
+                # API calls are counted on the first task, as the other ones share them
+                all_stats: list[ResourceStats] = [ResourceStats() for _ in tasks]
+                start: float = time.perf_counter()
+                collection_context.stats = all_stats[0]
+                try:
+                    client = clients[task.client_key]
+                    if service_type != CONST_DIRECT and (page_size := get_page_size(client, config_service)) is not None:
+                        for stats in all_stats:
+                            stats.page_size = page_size[1]
+                    if len(tasks) == 1:
+                        resources, get_weight = get_resources(client, config_service, all_stats[0], previous.get('marker'), stop)
+                        metric_counts: list[Metric] = [get_metric_count(resources, config_service, task.dimensions, timestamp, all_stats[0], get_weight)]
+                    else:
+                        metric_counts = get_shared_metric_counts(client, tasks, timestamp, all_stats, stop)
+                finally:
+                    collection_context.stats = None
+                # Main thread already counted it as skipped, so its state and statistics are not changed
+                if stop is not None and stop.is_set():
+                    raise ResourceSkipped('time budget ended before resource finished')
+                duration: float = time.perf_counter() - start
+                for shared_task, stats, metric_count in zip(tasks, all_stats, metric_counts):
+                    stats.duration = duration
+                    stats.attempts = attempt
+                    log_resource_summary(shared_task, stats)
+                    if task_stats is not None:
+                        task_stats.append((shared_task, stats))
+                    if state is not None:
+                        state['resources'][shared_task.state_key] = get_resource_state(shared_task, metric_count, stats, run_time)
+                return metric_counts
+        except ResourceUnchanged as unchanged:
+            logging.info('Change marker "%s" from "%s", "%s" is unchanged, reusing previous metrics', unchanged, resource_client, resource_method)
+            state['resources'][task.state_key] = {**previous, 'collected': run_time}
+            return [get_state_metric_count(previous, timestamp)]
+        except ClientError as error:
+            # botocore already retried each request, so retry the whole resource with exponential backoff and jitter
+            if error.response.get('Error', {}).get('Code') not in CONST_THROTTLING_ERROR_CODES or attempt >= resource_attempts:
+                raise
+            backoff: float = random.uniform(0, CONST_BACKOFF_BASE_SECONDS * 2 ** attempt)
+            if deadline is not None and time.monotonic() + backoff > deadline:
+                raise ResourceSkipped('time budget ends before retrying throttled resource') from error
+            logging.warning('Throttled getting resources from "%s", "%s", retrying in %.2f seconds: %s', resource_client, resource_method, backoff, error)
+            time.sleep(backoff)
+            attempt += 1
+
+def get_shared_metric_counts(client: Any, tasks: list[CollectionTask], timestamp: datetime, all_stats: list[ResourceStats], stop: threading.Event | None = None) -> list[Metric]:
+    """
+    Count the resources of one request for each service configuration that shares it, reading each page once.
+    Each configuration selects its resources from the page with its own iterateOver, and counts them with its own counter.
+    :param client: boto3 client of the service
+    :param tasks: Service configurations with the same request, region and account
+    :param timestamp: Run timestamp, shared by all metrics
+    :param all_stats: Statistics of each task
+    :param stop: Event set when time budget ends, so no other page is requested, if informed
+    :return: List of dictionary of metric count for each task
+    :raise ResourceSkipped: If time budget ends before the last page
+    """
+    counters: list[tuple[Callable[[Any], Iterator[Any]], MetricCounter]] = [
+        (get_resource_iterate_over(task.config_service), MetricCounter(task.config_service))
+        for task in tasks
+    ]
+    for page in iterate_over_pages(client, tasks[0].config_service, all_stats[0], None, stop):
+        for iterate_over, counter in counters:
+            counter.add(iterate_over(page))
+
+    for stats in all_stats[1:]:
+        stats.pages = all_stats[0].pages
+    return [counter.get_metric_data(task.dimensions, timestamp, stats) for task, (_, counter), stats in zip(tasks, counters, all_stats)]
+
+def get_request_key(task: CollectionTask) -> str | None:
+    """
+    Get the key of the request made by a collection task, so tasks with the same request share its pages.
+    Tasks with change marker, or with a type that can count resources on the service side, don't share their request.
+    :param task: Collection task
+    :return: Request key, None if the task doesn't share its request
+    """
+    config_service: ResourceConfiguration = task.config_service
+    if config_service['resource']['changeMarker'] or config_service['type'] in CONST_SERVICE_COUNT:
+        return None
+    resource: ResourceElement = config_service['resource']
+    return json.dumps([
+        config_service['type'], resource['client'], resource['method'], resource['kwargs'], resource.get('nextInResponse'), resource.get('nextInRequest'),
+        resource['pageSize'], resource['chain'], task.region, task.account
+    ], sort_keys=True, default=str)
+
+def schedule_tasks(tasks: list[CollectionTask], state: State | None, timestamp: datetime) -> tuple[list[CollectionTask], list[int], dict[int, Metric]]:
+    """
+    Decide which collection tasks are due on this run and the order to run them, based on state from previous runs.
+    Tasks inside their resource interval reuse the metrics from the last collection.
+    Due tasks run from the most expensive one to the cheapest one, using the last collection duration as cost,
+    so long tasks don't start last and cheap ones still fit in the remaining time budget.
+    Tasks skipped on the last run and tasks never collected run first, so every resource is eventually collected.
+    :param tasks: List of collection tasks in configuration order
+    :param state: State from previous runs, None to run all tasks in configuration order
+    :param timestamp: Run timestamp, shared by all metrics
+    :return: List of collection tasks with state key and estimated cost, positions of due tasks in run order
+        and reused metrics by task position
+    """
+    if state is None:
+        return tasks, list(range(len(tasks))), {}
+
+    run_time: float = timestamp.replace(tzinfo=timezone.utc).timestamp()
+    scheduled_tasks: list[CollectionTask] = []
+    due_positions: list[int] = []
+    reused_metrics: dict[int, Metric] = {}
+    for position, task in enumerate(tasks):
+        state_key: str = get_task_state_key(task)
+        previous: dict[str, Any] = state['resources'].get(state_key, {})
+        task = task._replace(state_key=state_key, estimated_seconds=previous.get('duration'))
+        scheduled_tasks.append(task)
+
+        interval: int = task.config_service['resource']['interval'] or 0
+        if 'metrics' in previous and run_time - previous['collected'] < interval:
+            logging.info('Reusing metrics from "%s", "%s", region "%s", account "%s", collected %.0f seconds ago', task.config_service['resource']['client'], task.config_service['resource']['method'], task.region or 'default', task.account or 'default', run_time - previous['collected'])
+            reused_metrics[position] = get_state_metric_count(previous, timestamp)
+        else:
+            due_positions.append(position)
+
+    due_positions.sort(key=lambda position: (
+        'skipped' not in state['resources'].get(scheduled_tasks[position].state_key, {}),
+        -(scheduled_tasks[position].estimated_seconds if scheduled_tasks[position].estimated_seconds is not None else float('inf'))
+    ))
+    logging.info('Scheduled %s due tasks, reusing %s tasks inside their interval', len(due_positions), len(reused_metrics))
+    return scheduled_tasks, due_positions, reused_metrics
+
+def load_state(state_settings: StateElement) -> State:
+    """
+    Load state persisted by the previous run, from a local file or an S3 object.
+    A missing or invalid state is not an error, the run just starts without state.
+    :param state_settings: State settings
+    :return: State from previous run, or an empty one
+    """
+    location: str = state_settings['location']
+    content: bytes | None = None
+    try:
+        if location.startswith(CONST_STATE_S3_PREFIX):
+            bucket, key = get_state_s3_object(location)
+            content = get_state_s3_client(state_settings).get_object(Bucket=bucket, Key=key)['Body'].read()
+        elif os.path.exists(location):
+            with open(location, 'rb') as state_file:
+                content = state_file.read()
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            raise
+    if content is None:
+        logging.info('State not found on "%s", starting without state', location)
+        return {'metrics': {}, 'resources': {}}
+
+    try:
+        state: State = json.loads(content)
+    except ValueError as error:
+        logging.error('Invalid state on "%s", starting without state: %s', location, error)
+        return {'metrics': {}, 'resources': {}}
+    logging.info('Loaded state from "%s" with %s metrics and %s resources', location, sum(len(metrics) for metrics in state.get('metrics', {}).values()), len(state.get('resources', {})))
+    return {'metrics': state.get('metrics', {}), 'resources': state.get('resources', {})}
+
+def save_state(state_settings: StateElement, state: State) -> None:
+    """
+    Save state to be used by the next run, to a local file or an S3 object.
+    :param state_settings: State settings
+    :param state: State to be saved
+    """
+    location: str = state_settings['location']
+    content: bytes = json.dumps(state, separators=(',', ':'), default=str).encode('utf-8')
+    if location.startswith(CONST_STATE_S3_PREFIX):
+        bucket, key = get_state_s3_object(location)
+        get_state_s3_client(state_settings).put_object(Bucket=bucket, Key=key, Body=content, ContentType='application/json')
+    else:
+        # Replace the file at once, so a failure doesn't leave a partial state
+        with open(f'{location}.tmp', 'wb') as state_file:
+            state_file.write(content)
+        os.replace(f'{location}.tmp', location)
+    logging.info('Saved state to "%s", size: %s bytes', location, len(content))
+
+def get_state_s3_object(location: str) -> tuple[str, str]:
+    """
+    Get bucket and key from an S3 URL.
+    :param location: S3 URL, like "s3://bucket/key"
+    :return: Tuple of bucket and key
+    """
+    bucket, _, key = location[len(CONST_STATE_S3_PREFIX):].partition('/')
+    return bucket, key
+
+def get_state_s3_client(state_settings: StateElement) -> Any:
+    """
+    Get S3 client to persist state. Endpoint URL can be configured to use an S3 compatible storage.
+    :param state_settings: State settings
+    :return: boto3 S3 client
+    """
+    return boto3.client('s3', endpoint_url=state_settings['endpointUrl'] or None)
+
+def get_task_state_key(task: CollectionTask) -> str:
+    """
+    Get the key of a collection task on state. It changes when resource configuration changes, so old metrics are not reused.
+    :param task: Collection task
+    :return: State key
+    """
+    config_hash: str = hashlib.sha256(json.dumps(task.config_service, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return '|'.join((config_hash, task.region, task.account))
+
+def get_resource_state(task: CollectionTask, metric_count: Metric, stats: ResourceStats, run_time: float) -> dict[str, Any]:
+    """
+    Get the state of a resource to be persisted.
+    Collection time and duration are kept for all resources, to schedule them.
+    Metrics and change marker are only kept for resources with interval or change marker, which reuse them.
+    :param task: Collection task
+    :param metric_count: Dictionary of metric count for the resource
+    :param stats: Statistics of the collection
+    :param run_time: Run time as seconds since epoch
+    :return: Dictionary of resource state
+    """
+    resource_state: dict[str, Any] = {'collected': run_time, 'duration': round(stats.duration, 3)}
+    if task.config_service['resource']['interval'] or task.config_service['resource']['changeMarker']:
+        resource_state['marker'] = stats.marker
+        resource_state['metrics'] = [
+            [metric_data.namespace, metric_data.dimension_name, metric_data.dimension_value, metric_data.metric_name, metric_data.metric_value, metric_data.dimensions]
+            for metric_data in metric_count.values()
+        ]
+    return resource_state
+
+def get_state_metric_count(resource_state: dict[str, Any], timestamp: datetime) -> Metric:
+    """
+    Get the metric count of a resource from its persisted state, with the current run timestamp.
+    :param resource_state: Dictionary of resource state
+    :param timestamp: Run timestamp, shared by all metrics
+    :return: Dictionary of metric count for the resource
+    """
+    metric_count: Metric = {}
+    for namespace, dimension_name, dimension_value, metric_name, metric_value, dimensions in resource_state['metrics']:
+        dimensions = tuple((name, value) for name, value in dimensions)
+        metric_count[get_metric_key(metric_name, dimensions)] = MetricData(namespace, dimension_name, dimension_value, metric_name, metric_value, timestamp=timestamp, dimensions=dimensions)
+    return metric_count
+
+def log_resource_summary(task: CollectionTask, stats: ResourceStats) -> None:
+    """
+    Log one structured line with the collection summary of a resource, so log volume doesn't depend on the number of resources.
+    :param task: Service configuration, region and account collected
+    :param stats: Statistics of the collection
+    """
+    logging.info('Resource summary: %s', json.dumps(get_resource_summary(task, stats)))
+
+def get_resource_summary(task: CollectionTask, stats: ResourceStats) -> dict[str, Any]:
+    """
+    Get the collection summary of a resource.
+    :param task: Service configuration, region and account collected
+    :param stats: Statistics of the collection
+    :return: Dictionary of resource summary
+    """
+    return {
+        'client': task.config_service['resource']['client'],
+        'method': task.config_service['resource']['method'],
+        'metricName': task.config_service['metric']['metricName'],
+        'region': task.region or 'default',
+        'account': task.account or 'default',
+        'filterValue': task.filter_value,
+        'items': stats.items,
+        'pages': stats.pages,
+        'pageSize': stats.page_size,
+        'attempts': stats.attempts,
+        'apiCalls': stats.calls,
+        'retries': stats.retries,
+        'responseBytes': stats.bytes,
+        'durationSeconds': round(stats.duration, 3)
+    }
+
+def get_self_metrics(task_stats: list[tuple[CollectionTask, ResourceStats]], durations: dict[str, float], namespace: str, timestamp: datetime, connection_stats: dict[str, Any] | None = None) -> Metric:
+    """
+    Get self monitoring metrics, with collection statistics added by resource configuration and duration of each stage.
+    Resource dimension is the namespace and metric name of the resource configuration, like "ResourceCounter/Instance".
+    Client and connection reuse statistics use "Connections" as resource dimension.
+    :param task_stats: List of collection task and its statistics
+    :param durations: Dictionary of duration in seconds by stage
+    :param namespace: Self monitoring namespace
+    :param timestamp: Run timestamp, shared by all metrics
+    :param connection_stats: Client and connection reuse statistics, if any
+    :return: Dictionary of self monitoring metrics
+    """
+    totals: dict[str, dict[str, int]] = {}
+    for task, stats in task_stats:
+        resource: str = f'{task.config_service["metric"]["namespace"]}/{task.config_service["metric"]["metricName"]}'
+        resource_totals: dict[str, int] = totals.setdefault(resource, dict.fromkeys(('DurationMilliseconds', 'Pages', 'ApiCalls', 'Retries', 'Items', 'ResponseBytes'), 0))
+        resource_totals['DurationMilliseconds'] += round(stats.duration * 1000)
+        resource_totals['Pages'] += stats.pages
+        resource_totals['ApiCalls'] += stats.calls
+        resource_totals['Retries'] += stats.retries + stats.attempts - 1
+        resource_totals['Items'] += stats.items
+        resource_totals['ResponseBytes'] += stats.bytes
+    for stage, duration in durations.items():
+        totals[f'Stage/{stage}'] = {'DurationMilliseconds': round(duration * 1000)}
+    if connection_stats is not None:
+        totals['Connections'] = {
+            'ClientsCreated': connection_stats['clientsCreated'],
+            'ClientsReused': connection_stats['clientsReused'],
+            'HttpRequests': connection_stats['httpRequests'],
+            'NewConnections': connection_stats['newConnections']
+        }
+
+    return {
+        f'{resource}|{metric_name}': MetricData(namespace, CONST_SELF_DIMENSION_NAME, resource, metric_name, metric_value, timestamp=timestamp)
+        for resource, resource_totals in totals.items()
+        for metric_name, metric_value in resource_totals.items()
+    }
+
+def get_run_report(task_stats: list[tuple[CollectionTask, ResourceStats]], durations: dict[str, float], sink_stats: dict[str, dict[str, Any]], connection_stats: dict[str, Any] | None = None) -> dict[str, Any]:
+    """
+    Get the run report, with the summary of each collected resource, duration of each stage, statistics of each sink
+    and client and connection reuse.
+    Resources are sorted from the slowest one, so it shows which resource configuration makes a run slow.
+    :param task_stats: List of collection task and its statistics
+    :param durations: Dictionary of duration in seconds by stage
+    :param sink_stats: Dictionary of statistics by sink type
+    :param connection_stats: Client and connection reuse statistics, if any
+    :return: Dictionary of run report
+    """
+    return {
+        'durationSeconds': {stage: round(duration, 3) for stage, duration in durations.items()},
+        'resources': [get_resource_summary(task, stats) for task, stats in sorted(task_stats, key=lambda task_stat: -task_stat[1].duration)],
+        'sinks': sink_stats,
+        'connections': connection_stats or {}
+    }
+
+def run_profiled(function: Callable[..., Any], *args: Any) -> Any:
+    """
+    Run a function in a worker thread with its own CPU profiler, merged later with the invocation profiler.
+    :param function: Function to be run
+    :param args: Function arguments
+    :return: Function return value
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        with worker_profilers_lock:
+            worker_profilers.append(profiler)
+
+def profile_invocation(function: Callable[..., Any], *args: Any) -> Any:
+    """
+    Run a function with the profiler selected by "PROFILE" environment variable, logging its results.
+    "cpu" logs the functions with the highest cumulative time, and "memory" logs peak memory and the lines that allocated most.
+    :param function: Function to be run
+    :param args: Function arguments
+    :return: Function return value
+    """
+    if PROFILE == 'cpu':
+        worker_profilers.clear()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return function(*args)
+        finally:
+            profiler.disable()
+            stream = io.StringIO()
+            profile_stats = pstats.Stats(profiler, stream=stream)
+            for worker_profiler in worker_profilers:
+                profile_stats.add(worker_profiler)
+            profile_stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(CONST_PROFILE_LINES)
+            logging.info('CPU profile:\n%s', stream.getvalue())
+    if PROFILE == 'memory':
+        tracemalloc.start()
+        try:
+            return function(*args)
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            logging.info('Memory profile: current %.2f MiB, peak %.2f MiB, top allocations:\n%s', current / 2**20, peak / 2**20,
+                '\n'.join(str(statistic) for statistic in snapshot.statistics('lineno')[:CONST_PROFILE_LINES]))
+    return function(*args)
+
+def get_collection_tasks(config_services: list[ResourceConfiguration], account_ids: list[str], settings: SettingsConfiguration) -> list[CollectionTask]:
+    """
+    Get the list of collection tasks, one for each service configuration, account and region, in configuration order.
+    :param config_services: List of Dictionary of service configurations
+    :param account_ids: List of account ids, empty to use the Lambda function account only
+    :param settings: Settings configuration
+    :return: List of collection tasks
+    """
+    tasks: list[CollectionTask] = []
+    for config_service in config_services:
+        for account_id in account_ids or ['']:
+            for region in get_resource_regions(config_service):
+                # Account and region dimensions are only added when they are explicitly configured
+                dimensions: Dimensions = ()
+                if account_id:
+                    dimensions += ((settings['accounts']['dimensionName'], account_id),)
+                if region:
+                    dimensions += ((settings['regionDimensionName'], region),)
+                if not config_service['resource']['filter']['name']:
+                    tasks.append(CollectionTask(config_service, region, account_id, dimensions))
+                    continue
+                # Each groupBy value is queried with a service side filter, so only matching resources are returned
+                for value in config_service['count']['groupBy']['values']:
+                    tasks.append(CollectionTask(get_filtered_configuration(config_service, value), region, account_id, dimensions, value))
+    return tasks
+
+def get_filtered_configuration(config_service: ResourceConfiguration, value: str) -> ResourceConfiguration:
+    """
+    Get a copy of service configuration with method arguments filtering resources by one groupBy value.
+    Filter is added to "Filters" list, like EC2 filters, or appended as "name:value" to a string argument, like Resource Explorer query.
+    :param config_service: Dictionary of service config
+    :param value: GroupBy value to filter
+    :return: Dictionary of service config with filtered method arguments
+    """
+    name: str = config_service['resource']['filter']['name']
+    argument: str = config_service['resource']['filter']['argument']
+    kwargs: dict[str, Any] = dict(config_service['resource']['kwargs'])
+    if isinstance(current := kwargs.get(argument), str):
+        kwargs[argument] = f'{current} {name}:{value}'
+    else:
+        kwargs[argument] = [*(current or []), {'Name': name, 'Values': [value]}]
+    return ResourceConfiguration(**{**config_service, 'resource': ResourceElement(**{**config_service['resource'], 'kwargs': kwargs})})
+
+def collect_metrics_by_namespace(clients: ClientPool, config_services: list[ResourceConfiguration], account_ids: list[str], settings: SettingsConfiguration, metrics_by_namespace: Namespace, timestamp: datetime, state: State | None = None, deadline: float | None = None, namespace_complete: Callable[[str], None] | None = None, task_stats: list[tuple[CollectionTask, ResourceStats]] | None = None) -> None:
+    """
+    Collect resources for all service configurations, accounts and regions concurrently, using a bounded thread pool.
+    Results are merged into metrics_by_namespace in configuration order, so the result is the same as a sequential run.
+    When time budget ends, tasks not started yet are cancelled and running ones are not waited for, they stop before their next page.
+    Partial counts are never published, skipped resources keep their last metrics from state, if any, and are recorded on it to run first next time.
+    :param clients: Pool of boto3 clients
+    :param config_services: List of Dictionary of service configurations
+    :param account_ids: List of account ids, empty to use the Lambda function account only
+    :param settings: Settings configuration
+    :param metrics_by_namespace: Dictionary of metrics_by_namespace
+    :param timestamp: Run timestamp, shared by all metrics
+    :param state: State from previous runs, if it is configured
+    :param deadline: Time, from time.monotonic, until a resource can be collected, None if there is no time budget
+    :param namespace_complete: Function called with each namespace as soon as all its resources are merged, if any
+    :param task_stats: List where statistics of each collected resource are added, if informed
+    """
+    concurrency: ConcurrencyElement = settings['concurrency']
+    tasks, due_positions, reused_metrics = schedule_tasks(get_collection_tasks(config_services, account_ids, settings), state, timestamp)
+    # Due tasks with the same request share its pages, the first one in run order collects them for the group
+    shared_positions: dict[str, list[int]] = {}
+    groups: dict[int, list[int]] = {}
+    for position in due_positions:
+        if (request_key := get_request_key(tasks[position])) is not None and request_key in shared_positions:
+            shared_positions[request_key].append(position)
+        else:
+            groups[position] = shared_positions.setdefault(request_key or f'task:{position}', [position])
+    group_results: dict[int, tuple[int, int]] = {
+        position: (leader, index) for leader, positions in groups.items() for index, position in enumerate(positions)
+    }
+    if (shared_tasks := len(due_positions) - len(groups)) > 0:
+        logging.info('Sharing requests: %s tasks reuse pages from another task with the same request', shared_tasks)
+
+    # API limits are applied by account and region, so each client has its own semaphore
+    client_semaphores: dict[ClientKey, threading.BoundedSemaphore] = {
+        tasks[position].client_key: threading.BoundedSemaphore(concurrency['clients'].get(tasks[position].client_key[0], concurrency['maxPerClient']))
+        for position in due_positions
+    }
+
+    # Submit tasks interleaving clients, so workers don't block on the same client semaphore
+    # Each client keeps the scheduled order of its tasks
+    tasks_by_client: dict[ClientKey, list[int]] = {}
+    for position in groups:
+        tasks_by_client.setdefault(tasks[position].client_key, []).append(position)
+    submit_order: list[int] = []
+    while tasks_by_client:
+        for client_key in list(tasks_by_client):
+            submit_order.append(tasks_by_client[client_key].pop(0))
+            if not tasks_by_client[client_key]:
+                del tasks_by_client[client_key]
+
+    logging.info('Collecting %s resources in %s tasks with %s workers', len(config_services), len(submit_order), concurrency['maxWorkers'])
+    # Set when time budget ends, so running tasks stop before their next page
+    stop: threading.Event = threading.Event()
+    cancelled: bool = False
+    executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=concurrency['maxWorkers'], thread_name_prefix='collector')
+    try:
+        collect: Callable[..., list[Metric]] = functools.partial(run_profiled, collect_resources) if PROFILE == 'cpu' and CONST_PROFILE_WORKERS else collect_resources
+        futures: dict[int, Future] = {
+            position: executor.submit(collect, clients, [tasks[shared_position] for shared_position in groups[position]], client_semaphores, settings['retry']['resourceAttempts'], timestamp, state, deadline, task_stats, stop)
+            for position in submit_order
+        }
+        # Number of tasks to be merged for each namespace, to know when it is complete
+        pending_tasks: dict[str, int] = {}
+        for task in tasks:
+            pending_tasks[task.config_service['metric']['namespace']] = pending_tasks.get(task.config_service['metric']['namespace'], 0) + 1
+        failed_tasks: int = 0
+        skipped_tasks: list[CollectionTask] = []
+        for position, task in enumerate(tasks):
+            if position in reused_metrics:
+                set_metrics_by_namespace(reused_metrics[position], task.config_service, metrics_by_namespace, task.filter_value is not None)
+            else:
+                leader, index = group_results[position]
+                # Running tasks are waited only until time budget ends, so results are published before Lambda function timeout
+                if deadline is not None and not cancelled and not wait([futures[leader]], timeout=max(deadline - time.monotonic(), 0)).done:
+                    cancelled = True
+                    stop.set()
+                    logging.warning('Time budget ended, cancelling %s tasks not started yet and stopping running ones', sum(future.cancel() for future in futures.values()))
+                try:
+                    if cancelled and not futures[leader].done():
+                        raise ResourceSkipped('time budget ended before resource finished')
+                    metric_count: Metric = futures[leader].result()[index]
+                    logging.info('Set metrics for namespace "%s"', task.config_service['metric']['namespace'])
+                    set_metrics_by_namespace(metric_count, task.config_service, metrics_by_namespace, task.filter_value is not None)
+                except (ResourceSkipped, CancelledError) as skipped:
+                    # Skipped resources keep publishing their last metrics, when they are on state
+                    skipped_tasks.append(task)
+                    logging.warning('Skipped resources from "%s", "%s", region "%s", account "%s" because of time budget: %s', task.config_service['resource']['client'], task.config_service['resource']['method'], task.region or 'default', task.account or 'default', str(skipped) or 'cancelled before start')
+                    if state is not None:
+                        previous: dict[str, Any] = state['resources'].get(task.state_key, {})
+                        state['resources'][task.state_key] = {**previous, 'skipped': timestamp.replace(tzinfo=timezone.utc).timestamp()}
+                        if 'metrics' in previous:
+                            set_metrics_by_namespace(get_state_metric_count(previous, timestamp), task.config_service, metrics_by_namespace, task.filter_value is not None)
+                except Exception as error:
+                    # A resource that fails must not lose the metrics from the other ones
+                    failed_tasks += 1
+                    logging.error('Unable to get resources from "%s", "%s", region "%s", account "%s", will ignore it: %s', task.config_service['resource']['client'], task.config_service['resource']['method'], task.region or 'default', task.account or 'default', error)
+
+            namespace: str = task.config_service['metric']['namespace']
+            pending_tasks[namespace] -= 1
+            if pending_tasks[namespace] == 0 and namespace_complete is not None:
+                namespace_complete(namespace)
+    finally:
+        # After time budget ends, running tasks are not waited for and stop by themselves before their next page
+        executor.shutdown(wait=not cancelled, cancel_futures=True)
+
+    if skipped_tasks:
+        logging.warning('Skipped %s of %s tasks because of time budget: %s', len(skipped_tasks), len(tasks), json.dumps([
+            {'client': task.config_service['resource']['client'], 'method': task.config_service['resource']['method'], 'metricName': task.config_service['metric']['metricName'], 'region': task.region or 'default', 'account': task.account or 'default', 'filterValue': task.filter_value}
+            for task in skipped_tasks
+        ]))
+    if failed_tasks:
+        logging.error('Failed to get resources for %s of %s tasks', failed_tasks, len(tasks))
+
+def get_cloudwatch_metric_data(metrics: Metric) -> Iterator[CloudWatchMetricData]:
+    """
+    Get CloudWatch metric data, one for each metric.
+    :param metrics: Dictionary of metrics where key is the metric key
+    :return: Generator of CloudWatch metric data
+    """
+    for metric_key, metric_data in metrics.items():
+        logging.debug('Adding metric %s: %s', metric_key, metric_data)
+        yield {
+            'MetricName': metric_data.metric_name,
+            'Dimensions': get_cloudwatch_dimensions(metric_data),
+            'Timestamp': metric_data.timestamp,
+            'Value': metric_data.metric_value,
+            'Unit': 'Count',
+            'StorageResolution': 60
+        }
+
+def get_cloudwatch_dimensions(metric_data: MetricData) -> list[dict[str, str]]:
+    """
+    Get CloudWatch dimensions of a metric.
+    :param metric_data: Metric data
+    :return: List of CloudWatch dimensions
+    """
+    return [
+        {'Name': metric_data.dimension_name, 'Value': metric_data.dimension_value},
+        *({'Name': name, 'Value': value} for name, value in metric_data.dimensions)
+    ]
+
+def get_metric_data_batches(metrics: Metric) -> list[CloudWatchMetricDataList]:
+    """
+    Split metrics into PutMetricData batches, limited by number of metrics and payload size.
+    :param metrics: Dictionary of metrics where key is the metric key
+    :return: List of batches of CloudWatch metric data
     """
     metric_data_batch: list[CloudWatchMetricDataList] = []
     metric_data_list: CloudWatchMetricDataList = []
@@ -597,76 +2920,485 @@ def add_metric_to_cloudwatch(namespace: str, metrics: Metric) -> None:
     # Each PutMetricData request is limited to 1 MB in size for HTTP POST requests.
     # You can send a payload compressed by gzip.
     # Each request is also limited to no more than 1000 different metrics.
-    # So, it is required to batch the metrics in no more than 1000 metrics!
-    count: int = 0
-    for metric_name, metric_data in metrics.items():
-        logging.info('Adding metric %s: %s', metric_name, metric_data)
-        metric_data_list.append(
-            {
-                'MetricName': metric_name,
-                'Dimensions': [ {'Name': metric_data.dimension_name, 'Value': metric_data.dimension_value} ],
-                'Timestamp': metric_data.timestamp,
-                'Value': metric_data.metric_value,
-                'Unit': 'Count',
-                'StorageResolution': 60
-            }
-        )
-        count +=1
-        if count == CONST_MAX_METRIC_DATA:
-            logging.info('Adding batch of metric data, count: %s', count)
+    # So, it is required to batch the metrics in no more than 1000 metrics and 1 MB!
+    size: int = 0
+    for cloudwatch_metric_data in get_cloudwatch_metric_data(metrics):
+        metric_data_size: int = len(json.dumps(cloudwatch_metric_data, default=str))
+
+        if len(metric_data_list) == CONST_MAX_METRIC_DATA or size + metric_data_size > CONST_MAX_METRIC_DATA_BYTES:
+            logging.info('Adding batch of metric data, count: %s, size: %s', len(metric_data_list), size)
             metric_data_batch.append(metric_data_list)
             metric_data_list = []
-            count = 0
+            size = 0
+        metric_data_list.append(cloudwatch_metric_data)
+        size += metric_data_size
     # Add the remaining metric data list as a batch
     if metric_data_list:
         metric_data_batch.append(metric_data_list)
 
-    logging.info('Length of metric_data_batch: %s', len(metric_data_batch))
-    for batch in metric_data_batch:
-        kwargs: dict[str, Any] = {
-            'Namespace': namespace,
-            'MetricData': batch
+    return metric_data_batch
+
+def put_metric_data_batch(namespace: str, batch: CloudWatchMetricDataList, max_attempts: int) -> int:
+    """
+    Put one batch of metric data to CloudWatch, retrying it with exponential backoff when it fails.
+    :param namespace: Namespace of the metrics
+    :param batch: Batch of CloudWatch metric data
+    :param max_attempts: Maximum number of attempts
+    :return: Number of attempts
+    """
+    attempt: int = 1
+    while True:
+        try:
+            logging.info('put_metric_data %s: %s metrics', namespace, len(batch))
+            get_cloudwatch_client().put_metric_data(Namespace=namespace, MetricData=batch)
+            return attempt
+        except ClientError as error:
+            if attempt >= max_attempts:
+                raise
+            backoff: float = random.uniform(0, CONST_BACKOFF_BASE_SECONDS * 2 ** attempt)
+            logging.warning('Unable to put metric data for namespace "%s", retrying in %.2f seconds: %s', namespace, backoff, error)
+            time.sleep(backoff)
+            attempt += 1
+
+def add_metric_to_cloudwatch(metrics_by_namespace: Namespace, settings: SettingsConfiguration, sink: SinkElement) -> dict[str, Any]:
+    """
+    Add metric to CloudWatch.
+    Batches from all namespaces are sent concurrently, and only the failed ones are retried.
+    :param metrics_by_namespace: Dictionary of metrics by namespace, where metric key is the key
+    :param settings: Settings configuration
+    :param sink: Sink configuration
+    :return: Dictionary of publish statistics
+    """
+    publisher: PublisherElement = settings['publisher']
+    batches: list[tuple[str, CloudWatchMetricDataList]] = [
+        (namespace, batch)
+        for namespace, metrics in metrics_by_namespace.items()
+        for batch in get_metric_data_batches(metrics)
+    ]
+    logging.info('Length of metric_data_batch: %s', len(batches))
+
+    failed_batches: int = 0
+    api_calls: int = 0
+    with ThreadPoolExecutor(max_workers=publisher['maxWorkers'], thread_name_prefix='publisher') as executor:
+        futures: list[tuple[str, Future]] = [
+            (namespace, executor.submit(put_metric_data_batch, namespace, batch, publisher['maxAttempts']))
+            for namespace, batch in batches
+        ]
+        for namespace, future in futures:
+            try:
+                api_calls += future.result()
+            except Exception as error:
+                failed_batches += 1
+                api_calls += publisher['maxAttempts']
+                logging.error('Unable to put metric data for namespace "%s": %s', namespace, error)
+
+    if failed_batches:
+        raise RuntimeError(f'Failed to put {failed_batches} of {len(batches)} metric data batches')
+    publish_stats: dict[str, Any] = {
+        'batches': len(batches),
+        'metricData': sum(len(batch) for _, batch in batches),
+        'apiCalls': api_calls,
+        'retries': api_calls - len(batches),
+        'requestBytes': sum(len(json.dumps(batch, default=str)) for _, batch in batches)
+    }
+    logging.info('CloudWatch publish summary: %s', json.dumps(publish_stats))
+    return publish_stats
+
+def write_metric_to_emf(metrics_by_namespace: Namespace, settings: SettingsConfiguration, sink: SinkElement, stream: TextIO | None = None) -> None:
+    """
+    Write metrics as CloudWatch Embedded Metric Format (EMF) log lines.
+    Lambda sends stdout to CloudWatch Logs asynchronously, which creates the metrics without PutMetricData calls.
+    Metrics with the same dimensions are written in the same line, up to the EMF limits.
+    :param metrics_by_namespace: Dictionary of metrics by namespace, where metric key is the key
+    :param settings: Settings configuration
+    :param sink: Sink configuration
+    :param stream: Text stream to write log lines, stdout by default
+    """
+    stream = stream or sys.stdout
+    lines: int = 0
+    for namespace, metrics in metrics_by_namespace.items():
+        # Group metrics by dimensions and timestamp, as each line has one set of dimension values
+        metrics_by_dimensions: dict[tuple[Dimensions, datetime], list[MetricData]] = {}
+        for metric_data in metrics.values():
+            dimensions: Dimensions = ((metric_data.dimension_name, metric_data.dimension_value), *metric_data.dimensions)
+            metrics_by_dimensions.setdefault((dimensions, metric_data.timestamp), []).append(metric_data)
+
+        for (dimensions, timestamp), metric_data_list in metrics_by_dimensions.items():
+            line_metrics: dict[str, int] = {}
+            size: int = 0
+            for metric_data in metric_data_list:
+                metric_size: int = len(metric_data.metric_name) * 2 + CONST_EMF_METRIC_OVERHEAD_BYTES
+                if len(line_metrics) == CONST_EMF_MAX_METRICS or size + metric_size > CONST_EMF_MAX_BYTES or metric_data.metric_name in line_metrics:
+                    stream.write(get_emf_line(namespace, dimensions, timestamp, line_metrics) + '\n')
+                    lines += 1
+                    line_metrics = {}
+                    size = 0
+                line_metrics[metric_data.metric_name] = metric_data.metric_value
+                size += metric_size
+            if line_metrics:
+                stream.write(get_emf_line(namespace, dimensions, timestamp, line_metrics) + '\n')
+                lines += 1
+    stream.flush()
+    logging.info('Wrote %s EMF lines', lines)
+
+def get_emf_line(namespace: str, dimensions: Dimensions, timestamp: datetime, metrics: dict[str, int]) -> str:
+    """
+    Get one Embedded Metric Format (EMF) log line.
+    :param namespace: Namespace of the metrics
+    :param dimensions: Dimensions of all metrics
+    :param timestamp: Timestamp of all metrics, in UTC
+    :param metrics: Dictionary of metric value by metric name
+    :return: JSON log line
+    """
+    return json.dumps({
+        '_aws': {
+            'Timestamp': int(timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000),
+            'CloudWatchMetrics': [
+                {
+                    'Namespace': namespace,
+                    'Dimensions': [[name for name, _ in dimensions]],
+                    'Metrics': [{'Name': metric_name, 'Unit': 'Count', 'StorageResolution': 60} for metric_name in metrics]
+                }
+            ]
+        },
+        **dict(dimensions),
+        **metrics
+    })
+
+def push_metric_to_prometheus(metrics_by_namespace: Namespace, settings: SettingsConfiguration, sink: SinkElement) -> None:
+    """
+    Push metrics to Prometheus Pushgateway, using text exposition format.
+    Metric name is the namespace and metric name, and dimensions are labels.
+    :param metrics_by_namespace: Dictionary of metrics by namespace, where metric key is the key
+    :param settings: Settings configuration
+    :param sink: Sink configuration, with "url" of Pushgateway and optional "job" and "timeout"
+    """
+    # Group samples by metric name, as each metric has just one TYPE line
+    samples_by_metric: dict[str, list[str]] = {}
+    for namespace, metrics in metrics_by_namespace.items():
+        for metric_data in metrics.values():
+            prometheus_name: str = get_prometheus_name(f'{namespace}_{metric_data.metric_name}')
+            labels: str = ','.join(
+                f'{get_prometheus_name(name)}="{get_prometheus_label_value(value)}"'
+                for name, value in ((metric_data.dimension_name, metric_data.dimension_value), *metric_data.dimensions)
+            )
+            samples_by_metric.setdefault(prometheus_name, []).append(f'{prometheus_name}{{{labels}}} {metric_data.metric_value}')
+
+    body: str = ''.join(
+        f'# TYPE {prometheus_name} gauge\n' + ''.join(f'{sample}\n' for sample in samples)
+        for prometheus_name, samples in samples_by_metric.items()
+    )
+    url: str = f'{str(sink["options"]["url"]).rstrip("/")}/metrics/job/{sink["options"].get("job", CONST_DEFAULT_PROMETHEUS_JOB)}'
+    request = urllib.request.Request(url, data=body.encode('utf-8'), method='PUT', headers={'Content-Type': 'text/plain; version=0.0.4'})
+    logging.info('Pushing %s metrics to Prometheus: %s', len(samples_by_metric), url)
+    with urllib.request.urlopen(request, timeout=sink['options'].get('timeout', CONST_DEFAULT_HTTP_TIMEOUT_SECONDS)) as response:  # nosec B310
+        logging.info('Prometheus response status: %s', response.status)
+
+def get_prometheus_name(name: str) -> str:
+    """
+    Get a valid Prometheus metric or label name, replacing invalid characters by underscore.
+    :param name: Name to be converted
+    :return: Valid Prometheus name
+    """
+    prometheus_name: str = re.sub(r'[^a-zA-Z0-9_]', '_', name).lower()
+    return f'_{prometheus_name}' if prometheus_name[:1].isdigit() else prometheus_name
+
+def get_prometheus_label_value(value: str) -> str:
+    """
+    Get a Prometheus label value, escaping backslash, double quote and line feed.
+    :param value: Label value
+    :return: Escaped label value
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def send_metric_to_statsd(metrics_by_namespace: Namespace, settings: SettingsConfiguration, sink: SinkElement) -> None:
+    """
+    Send metrics to StatsD as gauges, batching several metrics in each UDP packet.
+    Dimensions are sent as DogStatsD tags.
+    :param metrics_by_namespace: Dictionary of metrics by namespace, where metric key is the key
+    :param settings: Settings configuration
+    :param sink: Sink configuration, with "host" and optional "port" and "prefix"
+    """
+    address: tuple[str, int] = (sink['options']['host'], sink['options'].get('port', CONST_DEFAULT_STATSD_PORT))
+    prefix: str = sink['options'].get('prefix', '')
+
+    packets: int = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd_socket:
+        packet: bytes = b''
+        for namespace, metrics in metrics_by_namespace.items():
+            for metric_data in metrics.values():
+                tags: str = ','.join(
+                    f'{name}:{value}'.replace(' ', '_')
+                    for name, value in ((metric_data.dimension_name, metric_data.dimension_value), *metric_data.dimensions)
+                )
+                line: bytes = f'{prefix}{namespace}.{metric_data.metric_name}:{metric_data.metric_value}|g|#{tags}'.encode('utf-8')
+                if packet and len(packet) + len(line) + 1 > CONST_STATSD_MAX_PACKET_BYTES:
+                    statsd_socket.sendto(packet, address)
+                    packets += 1
+                    packet = b''
+                packet = packet + b'\n' + line if packet else line
+        if packet:
+            statsd_socket.sendto(packet, address)
+            packets += 1
+    logging.info('Sent %s StatsD packets to %s', packets, address)
+
+def write_metric_to_file(metrics_by_namespace: Namespace, settings: SettingsConfiguration, sink: SinkElement) -> None:
+    """
+    Write metrics to a local file, as newline delimited JSON (NDJSON) or Parquet.
+    Parquet format requires "pyarrow" package, which is not available on Lambda runtime by default.
+    :param metrics_by_namespace: Dictionary of metrics by namespace, where metric key is the key
+    :param settings: Settings configuration
+    :param sink: Sink configuration, with optional "path", "format" and "append"
+    """
+    path: str = sink['options'].get('path', CONST_DEFAULT_FILE_PATH)
+    rows: list[dict[str, Any]] = [
+        {
+            'namespace': namespace,
+            'metricName': metric_data.metric_name,
+            'dimensions': dict(((metric_data.dimension_name, metric_data.dimension_value), *metric_data.dimensions)),
+            'value': metric_data.metric_value,
+            'timestamp': metric_data.timestamp.isoformat()
         }
-        logging.info('put_metric_data %s: %s metrics', namespace, len(batch))
-        cloudwatch_client.put_metric_data(**kwargs)
+        for namespace, metrics in metrics_by_namespace.items()
+        for metric_data in metrics.values()
+    ]
+
+    if sink['options'].get('format', CONST_FILE_FORMATS[0]) == 'parquet':
+        try:
+            import pyarrow  # type: ignore  # pylint: disable=import-outside-toplevel
+            import pyarrow.parquet  # type: ignore  # pylint: disable=import-outside-toplevel
+        except ImportError as error:
+            raise RuntimeError('File format "parquet" requires package "pyarrow" packaged with Lambda function') from error
+        for row in rows:
+            row['dimensions'] = json.dumps(row['dimensions'])
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), path)
+    else:
+        with open(path, 'a' if sink['options'].get('append', True) else 'w', encoding='utf-8') as metrics_file:
+            metrics_file.writelines(json.dumps(row) + '\n' for row in rows)
+    logging.info('Wrote %s metrics to file: %s', len(rows), path)
 
-def main() -> Namespace:
+def publish_metrics_by_namespace(metrics_by_namespace: Namespace, settings: SettingsConfiguration, state: State | None = None, run_time: float = 0.0, sinks: list[SinkElement] | None = None) -> dict[str, dict[str, Any]]:
+    """
+    Publish metrics to all configured sinks concurrently, so adding a sink doesn't make the run longer.
+    A sink that fails doesn't stop the other ones, but the run fails after all of them finish.
+    With delta publishing, CloudWatch only receives metrics that changed or were not published within heartbeat interval.
+    :param metrics_by_namespace: Dictionary of metrics by namespace, where metric key is the key
+    :param settings: Settings configuration
+    :param state: State from previous runs, with last published metrics, if it is configured
+    :param run_time: Run time as seconds since epoch, used with state
+    :param sinks: List of sinks to publish to, None to use all configured sinks
+    :return: Dictionary of statistics by sink type, with its duration and the ones returned by the sink
+    """
+    sinks = settings['sinks'] if sinks is None else sinks
+    if not sinks or not metrics_by_namespace:
+        return {}
+    cloudwatch_metrics: Namespace = metrics_by_namespace
+    if state is not None and settings['state']['deltaPublish']:
+        cloudwatch_metrics = get_changed_metrics(metrics_by_namespace, state, settings['state']['heartbeatSeconds'], run_time)
+
+    failed_sinks: list[str] = []
+    with ThreadPoolExecutor(max_workers=len(sinks), thread_name_prefix='sink') as executor:
+        futures: list[tuple[str, Future]] = []
+        for sink in sinks:
+            sink_metrics: Namespace = cloudwatch_metrics if sink['type'] == CONST_SINK_CLOUDWATCH else metrics_by_namespace
+            logging.info('Publish metrics to sink "%s" for namespaces: %s', sink['type'], list(sink_metrics))
+            futures.append((sink['type'], executor.submit(run_sink, sink_metrics, settings, sink)))
+        sink_stats: dict[str, dict[str, Any]] = {}
+        for sink_type, future in futures:
+            try:
+                sink_stats[sink_type] = future.result()
+            except Exception as error:
+                failed_sinks.append(sink_type)
+                logging.error('Unable to publish metrics to sink "%s": %s', sink_type, error)
+
+    # Metrics are only marked as published when CloudWatch received them, so they are sent again on next run otherwise
+    if state is not None and settings['state']['deltaPublish'] and any(sink['type'] == CONST_SINK_CLOUDWATCH for sink in sinks) and CONST_SINK_CLOUDWATCH not in failed_sinks:
+        set_published_metrics(metrics_by_namespace, cloudwatch_metrics, state, run_time)
+
+    if failed_sinks:
+        raise RuntimeError(f'Failed to publish metrics to sinks: {failed_sinks}')
+    return sink_stats
+
+def run_sink(metrics_by_namespace: Namespace, settings: SettingsConfiguration, sink: SinkElement) -> dict[str, Any]:
+    """
+    Publish metrics to one sink, measuring its duration.
+    :param metrics_by_namespace: Dictionary of metrics by namespace, where metric key is the key
+    :param settings: Settings configuration
+    :param sink: Sink configuration
+    :return: Dictionary of sink statistics
+    """
+    start: float = time.perf_counter()
+    sink_stats: dict[str, Any] | None = CONST_SINK_TYPE[sink['type']](metrics_by_namespace, settings, sink)
+    return {'durationSeconds': round(time.perf_counter() - start, 3), **(sink_stats or {})}
+
+def add_sink_stats(total_stats: dict[str, dict[str, Any]], sink_stats: dict[str, dict[str, Any]]) -> None:
+    """
+    Add statistics of one publish to the statistics of the run, as streaming publish calls sinks several times.
+    :param total_stats: Dictionary of statistics by sink type of the run
+    :param sink_stats: Dictionary of statistics by sink type of one publish
+    """
+    for sink_type, stats in sink_stats.items():
+        sink_total: dict[str, Any] = total_stats.setdefault(sink_type, {})
+        for name, value in stats.items():
+            sink_total[name] = round(sink_total.get(name, 0) + value, 3)
+
+def get_changed_metrics(metrics_by_namespace: Namespace, state: State, heartbeat_seconds: int, run_time: float) -> Namespace:
+    """
+    Get the metrics with a different value from the last published one, or not published within heartbeat interval.
+    :param metrics_by_namespace: Dictionary of metrics by namespace, where metric key is the key
+    :param state: State with last published metrics
+    :param heartbeat_seconds: Maximum number of seconds without publishing a metric
+    :param run_time: Run time as seconds since epoch
+    :return: Dictionary of metrics by namespace to be published
+    """
+    changed_by_namespace: Namespace = {}
+    total: int = 0
+    for namespace, metrics in metrics_by_namespace.items():
+        published_metrics: dict[str, Any] = state['metrics'].get(namespace, {})
+        changed_by_namespace[namespace] = {
+            metric_key: metric_data for metric_key, metric_data in metrics.items()
+            if (published := published_metrics.get(metric_key)) is None
+                or published['value'] != metric_data.metric_value
+                or run_time - published['published'] >= heartbeat_seconds
+        }
+        total += len(metrics)
+    logging.info('Delta publish: %s of %s metrics changed or due to heartbeat', sum(len(metrics) for metrics in changed_by_namespace.values()), total)
+    return changed_by_namespace
+
+def set_published_metrics(metrics_by_namespace: Namespace, published_by_namespace: Namespace, state: State, run_time: float) -> None:
+    """
+    Set last published metrics on state for each namespace. Metrics that don't exist anymore are removed from it.
+    :param metrics_by_namespace: Dictionary of all metrics from this run by namespace
+    :param published_by_namespace: Dictionary of metrics published on this run by namespace
+    :param state: State to be updated
+    :param run_time: Run time as seconds since epoch
+    """
+    previous_metrics: dict[str, Any] = state['metrics']
+    state['metrics'] = {**previous_metrics, **{
+        namespace: {
+            metric_key: {'value': metric_data.metric_value, 'published': run_time}
+            if metric_key in published_by_namespace.get(namespace, {}) else previous_metrics[namespace][metric_key]
+            for metric_key, metric_data in metrics.items()
+        }
+        for namespace, metrics in metrics_by_namespace.items()
+    }}
+
+CONST_SINK_TYPE: Final[dict[str, Callable]] = {
+    CONST_SINK_CLOUDWATCH: add_metric_to_cloudwatch,
+    CONST_SINK_EMF: write_metric_to_emf,
+    CONST_SINK_PROMETHEUS: push_metric_to_prometheus,
+    CONST_SINK_STATSD: send_metric_to_statsd,
+    CONST_SINK_FILE: write_metric_to_file
+}
+
+def get_collect_deadline(scheduler: SchedulerElement, context: Any) -> float | None:
+    """
+    Get the time budget to collect resources, from the Lambda function remaining time and scheduler settings.
+    Reserve is limited to a fraction of the remaining time, so a function with a short timeout still collects resources.
+    :param scheduler: Scheduler settings
+    :param context: Lambda context, None when it runs locally
+    :return: Deadline from time.monotonic, None if there is no time budget
+    """
+    deadlines: list[float] = []
+    now: float = time.monotonic()
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        remaining_seconds: float = context.get_remaining_time_in_millis() / 1000
+        if (reserve_seconds := min(scheduler['reserveSeconds'], remaining_seconds * CONST_MAX_RESERVE_FRACTION)) < scheduler['reserveSeconds']:
+            logging.warning('Lambda function remaining time is %.1f seconds, keeping %.1f seconds to publish metrics instead of "reserveSeconds" %s', remaining_seconds, reserve_seconds, scheduler['reserveSeconds'])
+        deadlines.append(now + remaining_seconds - reserve_seconds)
+    if scheduler['maxSeconds']:
+        deadlines.append(now + scheduler['maxSeconds'])
+    if not deadlines:
+        return None
+
+    if (deadline := min(deadlines)) <= now:
+        logging.warning('Time budget is already spent, no resource will be collected')
+    return deadline
+
+def main(context: Any = None, run_report: dict[str, Any] | None = None) -> Namespace:
     """
     Main function. To be called by lambda entry point or main entry point.
+    :param context: Lambda context, used to get the time budget of the invocation
+    :param run_report: Dictionary where the run report is set, when it is enabled on self monitoring settings
     :return: Dictionary of metrics by namespace
     """
+    global cold_start  # pylint: disable=global-statement
+    init_start: float = time.perf_counter()
+
     # Read config file to get service configurations
-    config_services : list[ResourceConfiguration] = get_service_configuration()
+    settings, config_services = get_service_configuration()
 
-    # Instantiate boto3 client for each service configuration.
-    clients: Boto3Clients = instantiate_boto3_client_for_service(config_services)
+    # boto3 clients are taken from the registry, or created on first use for each service, region and account, and kept across warm invocations
+    clients: ClientPool = ClientPool(settings)
+    account_ids: list[str] = get_account_ids(settings['accounts'], clients)
 
-    metrics_by_namespace: Namespace = initialize_metrics_by_namespace(config_services)
+    # All metrics from this run share the same timestamp
+    timestamp: datetime = datetime.utcnow()
+    metrics_by_namespace: Namespace = initialize_metrics_by_namespace(config_services, timestamp)
+    # State from previous runs, only when it is configured
+    state: State | None = load_state(settings['state']) if settings['state']['location'] else None
 
     # Get the list of resources for each service configuration
-    for config_service in config_services:
+    run_time: float = timestamp.replace(tzinfo=timezone.utc).timestamp()
+    collect_start: float = time.perf_counter()
+
+    # With streaming publish, each namespace is published to sinks that add metrics as soon as all its resources finish
+    streaming_sinks: list[SinkElement] = [sink for sink in settings['sinks'] if settings['publisher']['streaming'] and sink['type'] in CONST_STREAMING_SINKS]
+    streamed_namespaces: list[str] = []
+    publish_errors: list[str] = []
+    sink_stats: dict[str, dict[str, Any]] = {}
+    task_stats: list[tuple[CollectionTask, ResourceStats]] = []
+
+    def publish_namespace(namespace: str) -> None:
+        logging.info('Streaming publish of namespace "%s"', namespace)
+        streamed_namespaces.append(namespace)
+        try:
+            add_sink_stats(sink_stats, publish_metrics_by_namespace({namespace: metrics_by_namespace[namespace]}, settings, state, run_time, streaming_sinks))
+        except RuntimeError as error:
+            publish_errors.append(str(error))
+
+    # Metrics collected until an error or the end of time budget are still published
+    try:
+        collect_metrics_by_namespace(clients, config_services, account_ids, settings, metrics_by_namespace, timestamp, state, get_collect_deadline(settings['scheduler'], context), publish_namespace if streaming_sinks else None, task_stats)
+    finally:
         logging.info('#######################')
         logging.info(' ')
 
-        service_type: str = config_service['type']
-        resource_client: str = config_service['resource']['client']
-        resource_method: str = config_service['resource']['method']
-
-        resources: list[Any] = []
-        logging.info('Get resources from "%s", "%s", using type "%s"', resource_client, resource_method, service_type)
-        CONST_SERVICE_TYPE[service_type](clients, resources, config_service)
-
-        namespace: str = config_service['metric']['namespace']
-        logging.info('Set metrics for namespace "%s"', namespace)
-        set_metrics_by_namespace(resources, config_service, metrics_by_namespace)
-
-    logging.info('#######################')
-    logging.info(' ')
-
-    # Add metric to CloudWatch for each namespace
-    for namespace, metrics in metrics_by_namespace.items():
-        logging.info('Add metric to CloudWatch for namespace: %s', namespace)
-        add_metric_to_cloudwatch(namespace, metrics)
+        durations: dict[str, float] = {'init': collect_start - init_start, 'collect': time.perf_counter() - collect_start}
+        connection_stats: dict[str, Any] = clients.get_connection_stats()
+        logging.info('Connection summary: %s', json.dumps(connection_stats))
+        if settings['selfMonitoring']['metrics']:
+            metrics_by_namespace[settings['selfMonitoring']['namespace']] = get_self_metrics(task_stats, durations, settings['selfMonitoring']['namespace'], timestamp, connection_stats)
+
+        # Publish metrics for all namespaces to CloudWatch and/or other configured sinks
+        # State is saved even if a sink fails, as collected resources are still valid
+        publish_start: float = time.perf_counter()
+        try:
+            for sinks, metrics_to_publish in (
+                ([sink for sink in settings['sinks'] if sink not in streaming_sinks], metrics_by_namespace),
+                (streaming_sinks, {namespace: metrics for namespace, metrics in metrics_by_namespace.items() if namespace not in streamed_namespaces})
+            ):
+                try:
+                    add_sink_stats(sink_stats, publish_metrics_by_namespace(metrics_to_publish, settings, state, run_time, sinks))
+                except RuntimeError as error:
+                    publish_errors.append(str(error))
+        finally:
+            if state is not None:
+                # Namespaces that are not configured anymore are removed from state
+                state['metrics'] = {namespace: metrics for namespace, metrics in state['metrics'].items() if namespace in metrics_by_namespace}
+                save_state(settings['state'], state)
+        publish_end: float = time.perf_counter()
+        durations['publish'] = publish_end - publish_start
+        if run_report is not None and settings['selfMonitoring']['report']:
+            run_report.update(get_run_report(task_stats, durations, sink_stats, connection_stats))
+    if publish_errors:
+        raise RuntimeError('; '.join(publish_errors))
+
+    if cold_start:
+        logging.info('Cold start import duration: %.3fs', init_start - import_start)
+        cold_start = False
+    logging.info('Duration init: %.3fs, collect: %.3fs, publish: %.3fs, clients created: %d, reused: %d',
+        collect_start - init_start, publish_start - collect_start, publish_end - publish_start, clients.created, clients.reused)
 
     return metrics_by_namespace
 
@@ -675,19 +3407,28 @@ def main() -> Namespace:
 # Lambda entry point
 #======================================================================================================================
 
-def lambda_handler(event, context) -> Namespace:
+def lambda_handler(event, context) -> Namespace | dict[str, Any]:
     """Lambda function handler"""
     logging.info('lambda_handler start')
     logging.debug('Parameter event: %s', json.dumps(event))
     logging.debug('Parameter context: %s', context)
 
+    run_report: dict[str, Any] = {}
     try:
-        return_value: Namespace = main()
+        metrics_by_namespace: Namespace = profile_invocation(main, context, run_report)
     except Exception as error:
         logging.exception(error)
         raise error
 
-    logging.info('Function return: %s', return_value)
+    # Metric stores are returned as dictionaries of metrics
+    return_value: Namespace | dict[str, Any] = {namespace: dict(metrics) for namespace, metrics in metrics_by_namespace.items()}
+
+    # With run report enabled, metrics and report are returned together
+    if run_report:
+        logging.info('Run report: %s', json.dumps(run_report))
+        return_value = {'metrics': return_value, 'report': run_report}
+
+    logging.debug('Function return: %s', return_value)
     logging.info('lambda_handler end')
     return return_value
 